@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from torch import Tensor
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+
+Batch = Union["PackedBatch", List[Tensor]]
+
+
+# field offsets in packed buffer are aligned on the largest element size
+ALIGNMENT = 8
+
+_NP_DTYPES: Dict[torch.dtype, np.dtype] = {}
+
+
+def numpy_dtype(dtype: torch.dtype) -> np.dtype:
+    if dtype not in _NP_DTYPES:
+        _NP_DTYPES[dtype] = torch.empty(0, dtype=dtype).numpy().dtype
+    return _NP_DTYPES[dtype]
+
+
+def supports_byte_views() -> bool:
+    """Device tensors can be re-viewed at another dtype of different element size (recent torch only)"""
+    try:
+        torch.zeros(ALIGNMENT, dtype=torch.uint8).view(torch.int64)
+        return True
+    except (RuntimeError, TypeError):
+        return False
+
+
+class PackedBatch(object):
+    """
+    Batch tensors packed as raw bytes in one contiguous uint8 buffer, fields keeping their compact dtypes (int16 ids,
+    uint8 masks, int64 indices, float32 similarities/weights...) at aligned offsets.
+
+    Host to device transfer is then one single copy (non-blocking from pinned memory) and fields are re-viewed at
+    their dtype on the device. On CPU, fields are zero-copy views on the host buffer.
+    With a torch too old to view bytes at another dtype, fields are copied one by one to the device.
+
+    It still behaves as the list of host tensors for code iterating/indexing the batch.
+    """
+
+    byte_views = supports_byte_views()
+
+    def __init__(self, buffer: Tensor, layout: List[Tuple[torch.dtype, int, int, Tuple[int, ...]]]):
+        self.buffer = buffer
+        # (dtype, byte offset, number of bytes, shape) per field
+        self.layout = layout
+
+    @classmethod
+    def pack(cls, tensors: List[Tensor]) -> PackedBatch:
+        arrays: List[np.ndarray] = []
+        layout: List[Tuple[torch.dtype, int, int, Tuple[int, ...]]] = []
+        offset = 0
+        for t in tensors:
+            t = torch.as_tensor(t)
+            array = np.ascontiguousarray(t.numpy()).reshape(-1).view(np.uint8)
+            layout.append((t.dtype, offset, array.shape[0], tuple(t.shape)))
+            arrays.append(array)
+            offset += -(-array.shape[0] // ALIGNMENT) * ALIGNMENT
+        buffer = np.empty(offset, dtype=np.uint8)
+        for array, (_, offset, nbytes, _) in zip(arrays, layout):
+            buffer[offset : offset + nbytes] = array
+        return cls(torch.from_numpy(buffer), layout)
+
+    def pin_memory(self) -> PackedBatch:
+        """Called by DataLoader(pin_memory=True) in its pinning thread"""
+        return PackedBatch(self.buffer.pin_memory(), self.layout)
+
+    def split(self, buffer: Tensor) -> List[Tensor]:
+        """Fields viewed at their dtype on buffer (on any device)"""
+        return [
+            buffer[offset : offset + nbytes].view(dtype).view(shape)
+            for (dtype, offset, nbytes, shape) in self.layout
+        ]
+
+    def unpack(self) -> List[Tensor]:
+        """Zero-copy views on host buffer"""
+        if self.byte_views:
+            return self.split(self.buffer)
+        array = self.buffer.numpy()
+        return [
+            torch.from_numpy(array[offset : offset + nbytes].view(numpy_dtype(dtype)).reshape(shape))
+            for (dtype, offset, nbytes, shape) in self.layout
+        ]
+
+    def to(self, device: torch.device, non_blocking: bool = False) -> List[Tensor]:
+        if device.type == "cpu":
+            return self.unpack()
+        if not self.byte_views:
+            return [t.to(device, non_blocking=non_blocking) for t in self.unpack()]
+        return self.split(self.buffer.to(device, non_blocking=non_blocking))
+
+    def __getitem__(self, idx):
+        """Get host field(s)"""
+        return self.unpack()[idx]
+
+    def __iter__(self):
+        """Iterate host fields"""
+        return iter(self.unpack())
+
+    def __len__(self):
+        """Number of fields"""
+        return len(self.layout)
+
+
+class PackedCollate(object):
+    """Wrap a collate function (or the default one) to pack its output in a PackedBatch"""
+
+    def __init__(self, collate_fn: Optional[Callable[[List[Any]], List[Tensor]]] = None):
+        self.collate_fn = collate_fn if collate_fn is not None else default_collate
+
+    def __call__(self, batch: List[Any]) -> PackedBatch:
+        return PackedBatch.pack(self.collate_fn(batch))
+
+
+def batch_to_device(batch: Batch, device: torch.device, non_blocking: bool = False) -> List[Tensor]:
+    if isinstance(batch, PackedBatch):
+        return batch.to(device, non_blocking=non_blocking)
+    return [t.to(device, non_blocking=non_blocking) for t in batch]
+
+
+class DevicePrefetcher(object):
+    """
+    Iterate over dataloader batches already transferred to device.
+
+    On GPU (if prefetch), next batch is copied on a side stream while current batch is computed.
+    On CPU, packed batches are just split into zero-copy views.
+    """
+
+    def __init__(self, dataloader: DataLoader, device: torch.device, prefetch: bool = True):
+        self.dataloader = dataloader
+        self.device = device
+        self.prefetch = prefetch and device.type == "cuda"
+
+    def __len__(self):
+        """Number of batches"""
+        return len(self.dataloader)
+
+    def __iter__(self) -> Iterator[List[Tensor]]:
+        """Iterate batches on device"""
+        if not self.prefetch:
+            for batch in self.dataloader:
+                yield batch_to_device(batch, self.device, non_blocking=True)
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.dataloader)
+
+        def preload() -> Optional[List[Tensor]]:
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return batch_to_device(batch, self.device, non_blocking=True)
+
+        next_batch = preload()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            for t in batch:
+                # memory allocated on side stream is used on current stream
+                t.record_stream(current_stream)
+            next_batch = preload()
+            yield batch
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    benchmarks.py parsers [options]
+    benchmarks.py checkpointing [options]
+    benchmarks.py adapters [options]
+    benchmarks.py attention [options]
+
+Micro-benchmarks of dataset building & training steps on the test dataset of a HOCON config.
+
+    parsers: tree-sitter languages library build & parser creation per sample vs cached per-language parsers
+    checkpointing: training step time & peak GPU memory without/with gradient checkpointing of encoders at each
+                   granularity (on random tokens of max lengths)
+    adapters: parameters, checkpoint size & load time and training step time of Query1CodeN (one code encoder per
+              language) vs Query1CodeNAdapters (shared code encoder & per-language adapters) on mixed-language batches
+              (MRR is compared by training & evaluating query_1_code_n.training_ctx.Query1CodeNCtx vs
+              Query1CodeNAdaptersCtx with train.py & eval.py, with training.mix_languages)
+    attention: CPU inference throughput & training step time of code encoder with dense vs block_local attention (same
+               weights) on random codes of each --code_lengths (batch size 8 unless --batch_size)
+
+Options:
+    -h --help                        Show this screen.
+    --config FILE                    Specify HOCON config file.
+    --nb_samples N                   Number of code samples to benchmark on. [default: 2000]
+    --full                           Also time the whole AST build (build_language_ast) on test dataset. [default: False]
+    --batch_size N                   Batch size of training steps (0 for training batch size). [default: 0]
+    --nb_steps N                     Number of timed training steps. [default: 5]
+    --code_lengths L                 Comma-separated code lengths of attention benchmark. [default: 512,1024]
+    --debug                          Enable debug routines. [default: False]
+"""
+
+import copy
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+
+from docopt import docopt
+from dpu_utils.utils import run_and_debug
+from loguru import logger
+from pyhocon import ConfigFactory
+from transformers import AdamW, BertConfig, BertModel
+from tree_sitter import Language, Parser
+
+from codenets.codesearchnet.code_ast.ast_utils import TreeSitterParser, build_language_ast
+from codenets.codesearchnet.copied_code.utils import read_file_samples
+from codenets.codesearchnet.huggingface.local_attention import setup_attention
+from codenets.codesearchnet.huggingface.models import PreTrainedModelRecordable, enable_gradient_checkpointing
+from codenets.codesearchnet.poolers import MeanWeightedPooler
+from codenets.codesearchnet.query_1_code_n.model import Query1CodeN, Query1CodeNAdapters
+from codenets.codesearchnet.torchscript_export import random_tokens, vocab_size
+from codenets.codesearchnet.training_ctx import CodeSearchTrainingContext
+from codenets.recordable import RecordableTorchModule, RecordableTorchModuleMapping
+from codenets.utils import get_data_files_from_directory
+
+AST_LANGS = ["go", "java", "javascript", "python", "php", "ruby"]
+
+
+def timeit(name: str, fn: Callable[[], None], nb: int = 1) -> float:
+    """Run fn nb times and log mean time per run"""
+    start = time.time()
+    for _ in range(nb):
+        fn()
+    t = (time.time() - start) / nb
+    logger.info(f"{name}: {t * 1000:.3f} ms")
+    return t
+
+
+def read_code_samples(training_ctx: CodeSearchTrainingContext, nb_samples: int) -> List[Dict[str, str]]:
+    samples: List[Dict[str, str]] = []
+    for file_path in get_data_files_from_directory(training_ctx.test_dirs):
+        for raw_sample in read_file_samples(file_path):
+            samples.append({"language": raw_sample["language"], "code": raw_sample["code"]})
+            if len(samples) >= nb_samples:
+                return samples
+    return samples
+
+
+def bench_parsers(training_ctx: CodeSearchTrainingContext, nb_samples: int, full: bool) -> None:
+    data_params = training_ctx.test_data_params
+
+    def new_parser() -> TreeSitterParser:
+        return TreeSitterParser(
+            langs=AST_LANGS, added_nodes=data_params.ast_added_nodes, skip_node_types=data_params.ast_skip_node_types
+        )
+
+    t_first = timeit("TreeSitterParser() first (library built if missing)", new_parser)
+    t_next = timeit("TreeSitterParser() next (library cached)", new_parser, nb=10)
+    logger.info(f"=> parser construction speedup x{t_first / t_next:.1f}")
+
+    parser = new_parser()
+    samples = read_code_samples(training_ctx, nb_samples)
+    logger.info(f"Benchmarking on {len(samples)} code samples")
+
+    legacy_parser = Parser()
+
+    def legacy_parse_full() -> None:
+        # previous behaviour: language loaded & set on every sample
+        for sample in samples:
+            lang = sample["language"]
+            legacy_parser.set_language(Language(str(parser.library_path), lang))
+            code = f"{parser.added_nodes[lang]['prefix']} {sample['code']} {parser.added_nodes[lang]['suffix']}"
+            source = bytes(code, "utf8")
+            tree = legacy_parser.parse(source)
+            parser.breadth_first_path(lang, source, tree.walk(), skip_node_types=parser.skip_node_types[lang])
+
+    def cached_parse_full() -> None:
+        for sample in samples:
+            parser.parse_full(sample["language"], sample["code"])
+
+    t_legacy = timeit("parse_full with per-sample Language/set_language", legacy_parse_full)
+    t_cached = timeit("parse_full with cached per-language parsers", cached_parse_full)
+    logger.info(f"=> parse_full speedup x{t_legacy / t_cached:.2f}")
+
+    if full:
+        timeit(
+            "build_language_ast (test)",
+            lambda: build_language_ast("test", training_ctx.test_dirs, training_ctx.pickle_path, data_params),
+        )
+
+
+# (granularity, every) None being no checkpointing
+CHECKPOINTING_SETUPS: List[Optional[Tuple[str, int]]] = [None, ("attention", 1), ("layer", 2), ("layer", 1)]
+
+
+def bench_checkpointing(training_ctx: CodeSearchTrainingContext, batch_size: int, nb_steps: int) -> None:
+    model = training_ctx.model
+    model.train()
+    device = training_ctx.device
+    batch_size = batch_size if batch_size > 0 else training_ctx.train_batch_size
+    vocab = vocab_size(model)
+    data_params = training_ctx.train_data_params
+    query_inputs = [t.to(device) for t in random_tokens(batch_size, data_params.query_max_num_tokens, vocab)]
+    code_inputs = [t.to(device) for t in random_tokens(batch_size, data_params.code_max_num_tokens, vocab, seed=1)]
+    lang_id = next(iter(data_params.lang_ids.values()))
+    ones = torch.ones(batch_size, device=device)
+
+    def step() -> None:
+        query_embeddings = model.encode_query(*query_inputs)
+        code_embeddings = model.encode_code(lang_id, *code_inputs)
+        loss, _ = training_ctx.losses_scores_fn(query_embeddings, code_embeddings, ones, ones)
+        loss.backward()
+        model.zero_grad()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    logger.info(f"Benchmarking {nb_steps} training steps of batch size {batch_size} on {device}")
+    results = []
+    for setup in CHECKPOINTING_SETUPS:
+        if setup is None:
+            enable_gradient_checkpointing(model, enabled=False)
+            name = "no checkpointing"
+        else:
+            granularity, every = setup
+            enable_gradient_checkpointing(model, granularity=granularity, every=every)
+            name = f"checkpointing 1/{every} {granularity}"
+        step()  # warmup
+        if device.type == "cuda":
+            torch.cuda.reset_max_memory_allocated(device)
+        t = timeit(name, step, nb=nb_steps)
+        peak_mb = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == "cuda" else float("nan")
+        results.append((name, t, peak_mb))
+    enable_gradient_checkpointing(model, enabled=False)
+
+    _, base_t, base_mb = results[0]
+    for name, t, peak_mb in results:
+        logger.info(
+            f"{name:>30}: {batch_size / t:8.1f} samples/sec (x{base_t / t:.2f}), "
+            f"peak GPU memory {peak_mb:8.1f} MB (x{peak_mb / base_mb:.2f})"
+        )
+
+
+def bench_adapters(training_ctx: CodeSearchTrainingContext, batch_size: int, nb_steps: int) -> None:
+    conf = training_ctx.conf
+    device = training_ctx.device
+    batch_size = batch_size if batch_size > 0 else training_ctx.train_batch_size
+    data_params = training_ctx.train_data_params
+    lang_ids = list(data_params.lang_ids.values())
+
+    query_config = BertConfig(**conf["training.model.query_encoder"])
+    full_model = Query1CodeN(
+        query_encoder=PreTrainedModelRecordable(BertModel(query_config)),
+        code_encoders=RecordableTorchModuleMapping(
+            {
+                str(lang_id): PreTrainedModelRecordable(BertModel(BertConfig(**conf["training.model.code_encoder"])))
+                for lang_id in lang_ids
+            }
+        ),
+        pooler=MeanWeightedPooler(input_size=query_config.hidden_size),
+    )
+    adapters_model = Query1CodeNAdapters.from_hocon(conf)
+
+    vocab = min(vocab_size(full_model), vocab_size(adapters_model))
+    query_inputs = [t.to(device) for t in random_tokens(batch_size, data_params.query_max_num_tokens, vocab)]
+    code_inputs = [t.to(device) for t in random_tokens(batch_size, data_params.code_max_num_tokens, vocab, seed=1)]
+    languages = torch.tensor(lang_ids, device=device)[torch.randint(len(lang_ids), (batch_size,))]
+    ones = torch.ones(batch_size, device=device)
+
+    logger.info(f"Benchmarking {nb_steps} training steps of batch size {batch_size} mixing {len(lang_ids)} languages")
+    results = []
+    for name, model in [("Query1CodeN", full_model), ("Query1CodeNAdapters", adapters_model)]:
+        nb_params = sum(p.numel() for p in model.parameters())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model.save(tmp_dir)
+            checkpoint_mb = sum(f.stat().st_size for f in Path(tmp_dir).glob("**/*") if f.is_file()) / 2 ** 20
+            load_t = timeit(f"{name} load", lambda: type(model).load(tmp_dir))
+
+        model = model.to(device).train()
+        optimizer = AdamW(model.parameters(), lr=conf["training.lr"], correct_bias=False)
+
+        def step(model: RecordableTorchModule = model, optimizer: AdamW = optimizer) -> None:
+            query_embeddings, code_embeddings = model(languages, *query_inputs, *code_inputs)
+            loss, _ = training_ctx.losses_scores_fn(query_embeddings, code_embeddings, ones, ones)
+            loss.backward()
+            optimizer.step()
+            model.zero_grad()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+
+        step()  # warmup & optimizer state
+        optimizer_tensors = [t for state in optimizer.state.values() for t in state.values() if torch.is_tensor(t)]
+        optimizer_mb = sum(t.numel() * t.element_size() for t in optimizer_tensors) / 2 ** 20
+        step_t = timeit(f"{name} training step", step, nb=nb_steps)
+        results.append((name, nb_params, checkpoint_mb, optimizer_mb, load_t, step_t))
+        model.cpu()
+        del optimizer
+
+    _, base_params, base_mb, _, base_load_t, base_t = results[0]
+    for name, nb_params, checkpoint_mb, optimizer_mb, load_t, step_t in results:
+        logger.info(
+            f"{name:>20}: {nb_params:>11} params (x{nb_params / base_params:.2f}), "
+            f"checkpoint {checkpoint_mb:8.1f} MB (x{checkpoint_mb / base_mb:.2f}), "
+            f"optimizer state {optimizer_mb:8.1f} MB, load {load_t:6.2f} s (x{base_load_t / load_t:.2f} faster), "
+            f"{batch_size / step_t:8.1f} samples/sec (x{base_t / step_t:.2f})"
+        )
+
+
+def bench_attention(
+    training_ctx: CodeSearchTrainingContext, batch_size: int, nb_steps: int, lengths: List[int]
+) -> None:
+    conf = training_ctx.conf
+    batch_size = batch_size if batch_size > 0 else 8
+    encoder_key = "training.model.encoder" if "training.model.encoder" in conf else "training.model.code_encoder"
+    encoder_conf = dict(conf[encoder_key])
+    encoder_conf.pop("type", None)
+    encoder_conf["max_position_embeddings"] = max(max(lengths), encoder_conf.get("max_position_embeddings", 512))
+    encoder_conf["attention_type"] = "dense"
+
+    dense = BertModel(BertConfig(**encoder_conf))
+    local = copy.deepcopy(dense)
+    local.config.attention_type = "block_local"
+    local.config.attention_block_size = encoder_conf.get("attention_block_size", 64)
+    local.config.attention_global_tokens = encoder_conf.get("attention_global_tokens", 1)
+    setup_attention(local)
+
+    logger.info(f"Benchmarking code encoder {encoder_key} on CPU with batch size {batch_size}")
+    results = []
+    for length in lengths:
+        inputs = random_tokens(batch_size, length, encoder_conf["vocab_size"])
+        for name, model in [("dense", dense), ("block_local", local)]:
+
+            def infer(model: BertModel = model) -> None:
+                with torch.no_grad():
+                    model(*inputs)
+
+            def train_step(model: BertModel = model) -> None:
+                model(*inputs)[0].mean().backward()
+                model.zero_grad()
+
+            model.eval()
+            infer()  # warmup
+            infer_t = timeit(f"{name} attention inference [L={length}]", infer, nb=nb_steps)
+            model.train()
+            train_step()  # warmup
+            train_t = timeit(f"{name} attention training step [L={length}]", train_step, nb=nb_steps)
+            results.append((length, name, infer_t, train_t))
+
+    for length, name, infer_t, train_t in results:
+        dense_infer_t, dense_train_t = next(
+            (i, t) for bench_length, n, i, t in results if bench_length == length and n == "dense"
+        )
+        logger.info(
+            f"{name:>12} [L={length:>5}]: inference {batch_size / infer_t:8.1f} codes/sec "
+            f"(x{dense_infer_t / infer_t:.2f}), training {batch_size / train_t:8.1f} codes/sec "
+            f"(x{dense_train_t / train_t:.2f})"
+        )
+
+
+def run(args, tag_in_vcs=False) -> None:
+    conf_file = args["--config"]
+    conf = ConfigFactory.parse_file(conf_file)
+
+    logger.info(f"Restoring Training Context from config {conf_file}")
+    training_ctx = CodeSearchTrainingContext.build_context_from_hocon(conf)
+
+    if args["parsers"]:
+        bench_parsers(training_ctx, int(args["--nb_samples"]), args["--full"])
+    elif args["checkpointing"]:
+        bench_checkpointing(training_ctx, int(args["--batch_size"]), int(args["--nb_steps"]))
+    elif args["adapters"]:
+        bench_adapters(training_ctx, int(args["--batch_size"]), int(args["--nb_steps"]))
+    elif args["attention"]:
+        lengths = [int(length) for length in args["--code_lengths"].split(",")]
+        bench_attention(training_ctx, int(args["--batch_size"]), int(args["--nb_steps"]), lengths)
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    run_and_debug(lambda: run(args), args["--debug"])
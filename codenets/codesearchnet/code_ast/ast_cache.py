@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from loguru import logger
+
+# sqlite connections can't be shared by processes so they are opened once per process
+_CONNECTIONS: Dict[Tuple[int, str], sqlite3.Connection] = {}
+
+
+class AstCache:
+    """
+    On-disk cache of linearized ASTs shared by all processes building datasets.
+
+    Entries are keyed by hash of (code, language, grammar version, linearization params) and stored in a sqlite
+    database. When it grows over max_mb, least recently used entries are evicted.
+    """
+
+    def __init__(self, path: Union[str, Path], max_mb: int = 1024, check_every: int = 1000):
+        self.path = Path(path)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.check_every = check_every
+        self.nb_puts = 0
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        key = (os.getpid(), str(self.path))
+        conn = _CONNECTIONS.get(key)
+        if conn is None:
+            os.makedirs(self.path.parent, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=60, isolation_level=None)
+            # WAL lets readers & one writer work concurrently from several processes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS asts "
+                "(key TEXT PRIMARY KEY, tokens TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS asts_accessed ON asts (accessed)")
+            _CONNECTIONS[key] = conn
+        return conn
+
+    @staticmethod
+    def key(code: str, lang: str, grammar: str, params: Any) -> str:
+        """Hash of code & everything changing its linearization (params must be json serializable)"""
+        h = hashlib.sha1()
+        h.update(json.dumps([lang, grammar, params], sort_keys=True).encode("utf8"))
+        h.update(code.encode("utf8"))
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[List[Tuple[str, bool]]]:
+        row = self.connection.execute("SELECT tokens FROM asts WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute("UPDATE asts SET accessed = ? WHERE key = ?", (time.time(), key))
+        return [(tok, is_structural) for tok, is_structural in json.loads(row[0])]
+
+    def put(self, key: str, tokens: List[Tuple[str, bool]]) -> None:
+        value = json.dumps(tokens)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO asts (key, tokens, size, accessed) VALUES (?, ?, ?, ?)",
+            (key, value, len(value), time.time()),
+        )
+        self.nb_puts += 1
+        if self.nb_puts % self.check_every == 0:
+            self.evict()
+
+    def size(self) -> int:
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM asts").fetchone()[0]
+
+    def evict(self) -> None:
+        """Evict least recently used entries until cache is under 90% of its max size"""
+        size = self.size()
+        if size <= self.max_bytes:
+            return
+        target = int(0.9 * self.max_bytes)
+        nb = 0
+        while size > target:
+            count = self.connection.execute("SELECT COUNT(*) FROM asts").fetchone()[0]
+            # estimate number of entries to delete from mean entry size
+            nb_to_delete = int((size - target) * count / size) + 1
+            deleted = self.connection.execute(
+                "DELETE FROM asts WHERE key IN (SELECT key FROM asts ORDER BY accessed LIMIT ?)", (nb_to_delete,)
+            ).rowcount
+            if deleted <= 0:
+                break
+            nb += deleted
+            size = self.size()
+        logger.info(f"Evicted {nb} ASTs from cache {self.path} ({size} bytes left)")
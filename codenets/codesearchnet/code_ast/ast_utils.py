@@ -1,17 +1,84 @@
 from loguru import logger
 import time
-from typing import Dict, List, Tuple, IO, Set, Optional
+from typing import Counter, Deque, Dict, Iterable, Iterator, List, Tuple, IO, Set, Optional
+from collections import defaultdict, deque
+import itertools
+import math
 from pathlib import Path
 from tree_sitter import Language, Parser, Node
 import os
 import json
+import hashlib
+import numpy as np
 from pyhocon import ConfigTree
 
 from codenets.codesearchnet.data import DatasetParams
-from codenets.utils import get_data_files_from_directory
+from codenets.codesearchnet.code_ast.ast_cache import AstCache
+from codenets.codesearchnet.tokenizer_recs import TokenizerRecordable, MASK_DTYPE
+from codenets.utils import get_data_files_from_directory, sort_files_by_size
 from codenets.codesearchnet.copied_code.utils import read_file_samples
 
 
+def vendors_hash(vendors: List[Path]) -> str:
+    """Content hash of the vendor grammars sources (parser.c, scanners...) used to build the languages library"""
+    h = hashlib.sha1()
+    for vendor in sorted(vendors):
+        src_path = Path(vendor) / "src"
+        for f in sorted(src_path.rglob("*")):
+            if f.is_file() and f.suffix in (".c", ".cc", ".h"):
+                h.update(str(f.relative_to(src_path.parent.parent)).encode("utf8"))
+                h.update(f.read_bytes())
+    return h.hexdigest()
+
+
+def build_languages_library(vendors: List[Path], build_path: Path = Path("./build")) -> Path:
+    """
+    Build the shared library of tree-sitter languages named by the content hash of vendors sources.
+
+    The library is built only if no library was already built from the same sources.
+    """
+    library_path = build_path / f"languages-{vendors_hash(vendors)[:16]}.so"
+    if not library_path.exists():
+        start = time.time()
+        os.makedirs(build_path, exist_ok=True)
+        # build in a tmp file so that concurrent processes never load a partial library
+        tmp_path = library_path.with_suffix(f".{os.getpid()}.tmp")
+        Language.build_library(str(tmp_path), [str(v) for v in vendors])
+        os.replace(tmp_path, library_path)
+        logger.info(f"Built tree-sitter languages library {library_path} in {time.time() - start:.2f} sec")
+    return library_path
+
+
+# Ready parsers per (process, library, language): tree-sitter parsers can't be shared by processes
+_PARSERS: Dict[Tuple[int, str, str], Parser] = {}
+
+
+def get_parser(library_path: Path, lang: str) -> Parser:
+    """Get the parser of lang with its language already set, created once per process"""
+    key = (os.getpid(), str(library_path), lang)
+    parser = _PARSERS.get(key)
+    if parser is None:
+        parser = Parser()
+        parser.set_language(Language(str(library_path), lang))
+        _PARSERS[key] = parser
+    return parser
+
+
+# tree-sitter node types of function/method definitions per language
+FUNCTION_NODE_TYPES: Dict[str, Set[str]] = {
+    "go": {"function_declaration", "method_declaration"},
+    "java": {"method_declaration", "constructor_declaration"},
+    "javascript": {"function_declaration", "generator_function_declaration", "method_definition"},
+    "python": {"function_definition"},
+    "php": {"function_definition", "method_declaration"},
+    "ruby": {"method", "singleton_method"},
+}
+
+
+# version of linearized ASTs format (part of AST cache keys so that cached ASTs of previous formats aren't reused)
+AST_FORMAT_VERSION = 2
+
+
 class TreeSitterParser:
     def __init__(
         self,
@@ -19,6 +86,8 @@ class TreeSitterParser:
         added_nodes: Dict[str, Dict[str, str]],
         skip_node_types: Dict[str, List[str]],
         vendors_path: Path = Path("./vendor"),
+        build_path: Path = Path("./build"),
+        cache: Optional[AstCache] = None,
     ):
         super(TreeSitterParser, self).__init__()
 
@@ -32,24 +101,23 @@ class TreeSitterParser:
             if lang not in skip_node_types:
                 self.skip_node_types[lang] = []
 
-        Language.build_library(
-            # Store the library in the `build` directory
-            "build/my-languages.so",
-            # Include one or more languages
-            vendors,
-        )
-
-        self.parser = Parser()
+        # Store the library in the `build` directory, rebuilt only when vendors sources change
+        self.library_path = build_languages_library(vendors, build_path)
+        # linearized ASTs cache shared by processes (library name is the grammars version)
+        self.cache = cache
 
     def repr_field_node(
-        self, code, node, field: Optional[str] = None, skip_node_types: List[str] = []
+        self, source: bytes, node, field: Optional[str] = None, skip_node_types: List[str] = []
     ) -> Tuple[List[str], Set[str], bool]:
+        """Tokens of node, leaf code being sliced with tree-sitter byte offsets from utf8 encoded source"""
         skip_sub_nodes = False
         special_tokens: Set[str] = set()
         rpr: List[str]
         if field:
-            rpr = ["<field>", field]
-            special_tokens.add("<field>")
+            # field names are a closed set per grammar: one structural token per field (not plain words which, added
+            # as special tokens, would be matched inside leaves & queries by text tokenizers)
+            rpr = [f"<field:{field}>"]
+            special_tokens.add(f"<field:{field}>")
         else:
             rpr = []
 
@@ -60,7 +128,8 @@ class TreeSitterParser:
                     rpr.extend([f"{node.type}", "<nosub>"])
                     special_tokens.add("<nosub>")
                 else:
-                    rpr.extend([f"<{node.type}>", code[node.start_byte : node.end_byte], "<nosub>"])
+                    leaf = source[node.start_byte : node.end_byte].decode("utf8", errors="replace")
+                    rpr.extend([f"<{node.type}>", leaf, "<nosub>"])
                     special_tokens.update([f"<{node.type}>", "<nosub>"])
 
             else:
@@ -78,105 +147,220 @@ class TreeSitterParser:
 
         return rpr, special_tokens, skip_sub_nodes
 
-    def repr_level(self, code, cursor, skip_node_types: List[str] = []):
-        nodes: List[Node] = []
+    def iter_breadth_first_path(
+        self, lang, source: bytes, cursor, skip_node_types: List[str] = []
+    ) -> Iterator[Tuple[str, bool]]:
+        """
+        Lazily linearize the tree in breadth-first order as (token, is_special) without final `<end>`.
+
+        Nodes are rendered (and leaf code sliced from source) only when tokens are consumed so that
+        a consumer stopping at a token budget never walks the rest of the tree.
+        """
+        yield f"<{lang}>", True
+        toks, specs, skip = self.repr_field_node(source, cursor.node, skip_node_types=skip_node_types)
+        for tok in toks:
+            yield tok, tok in specs
+        if skip:
+            return
+
+        nodes: Deque[Node] = deque([cursor.node])
+        while len(nodes) > 0:
+            level_cursor = nodes.popleft().walk()
+            if not level_cursor.goto_first_child():
+                continue
+            while True:
+                field = level_cursor.current_field_name()
+                toks, specs, skip = self.repr_field_node(
+                    source, level_cursor.node, field, skip_node_types=skip_node_types
+                )
+                for tok in toks:
+                    yield tok, tok in specs
+                if not skip:
+                    nodes.append(level_cursor.node)
+                if not level_cursor.goto_next_sibling():
+                    break
+            yield "<lvl>", True
+
+    def breadth_first_path(
+        self, lang, source: bytes, cursor, skip_node_types: List[str] = []
+    ) -> Tuple[List[str], Set[str]]:
         all_tokens: List[str] = []
         special_tokens: Set[str] = set()
-
-        if cursor.goto_first_child():
-            field = cursor.current_field_name()
-            toks, specs, skip = self.repr_field_node(code, cursor.node, field, skip_node_types=skip_node_types)
-            all_tokens.extend(toks)
-            special_tokens.update(specs)
-            if not skip:
-                nodes.append(cursor.node)
-
-            while cursor.goto_next_sibling():
-                field = cursor.current_field_name()
-                toks, specs, skip = self.repr_field_node(code, cursor.node, field, skip_node_types=skip_node_types)
-                all_tokens.extend(toks)
-                special_tokens.update(specs)
-                if not skip:
-                    nodes.append(cursor.node)
-
-            all_tokens.append("<lvl>")
-            special_tokens.add("<lvl>")
-        return all_tokens, special_tokens, nodes
-
-    def breadth_first_path(self, lang, code, cursor, skip_node_types: List[str] = []) -> Tuple[List[str], Set[str]]:
-        all_tokens = [f"<{lang}>"]
-        special_tokens = set([f"<{lang}>"])
-        all_tokens_1, special_tokens_1, skip = self.repr_field_node(code, cursor.node, skip_node_types=skip_node_types)
-        all_tokens.extend(all_tokens_1)
-        special_tokens.update(special_tokens_1)
-
-        if not skip:
-            all_tokens_lvl, special_tokens_lvl, nodes = self.repr_level(code, cursor, skip_node_types=skip_node_types)
-            all_tokens.extend(all_tokens_lvl)
-            special_tokens.update(special_tokens_lvl)
-
-            while len(nodes) > 0:
-                node = nodes.pop(0)
-                cursor = node.walk()
-                all_tokens_2, special_tokens_2, nodes_2 = self.repr_level(code, cursor, skip_node_types=skip_node_types)
-                all_tokens.extend(all_tokens_2)
-                special_tokens.update(special_tokens_2)
-                nodes.extend(nodes_2)
+        for tok, is_special in self.iter_breadth_first_path(lang, source, cursor, skip_node_types=skip_node_types):
+            all_tokens.append(tok)
+            if is_special:
+                special_tokens.add(tok)
         all_tokens.append("<end>")
         special_tokens.add("<end>")
         return all_tokens, special_tokens
 
     def breadth_first_path_light(
-        self, lang, code, cursor, skip_node_types: List[str] = [], max_tokens: Optional[int] = None
+        self, lang, source: bytes, cursor, skip_node_types: List[str] = [], max_tokens: Optional[int] = None
     ) -> List[str]:
-        all_tokens = [f"<{lang}>"]
-        all_tokens_1, special_tokens_1, skip = self.repr_field_node(code, cursor.node, skip_node_types=skip_node_types)
-        all_tokens.extend(all_tokens_1)
-
-        if not skip:
-            all_tokens_lvl, special_tokens_lvl, nodes = self.repr_level(code, cursor, skip_node_types=skip_node_types)
-            all_tokens.extend(all_tokens_lvl)
-
-            while len(nodes) > 0:
-                if max_tokens is not None and len(all_tokens) >= max_tokens:
-                    break
-                node = nodes.pop(0)
-                cursor = node.walk()
-                all_tokens_2, special_tokens_2, nodes_2 = self.repr_level(code, cursor, skip_node_types=skip_node_types)
-                all_tokens.extend(all_tokens_2)
-                nodes.extend(nodes_2)
+        tokens = (
+            tok for tok, _ in self.iter_breadth_first_path(lang, source, cursor, skip_node_types=skip_node_types)
+        )
+        all_tokens: List[str]
         if max_tokens is not None:
-            all_tokens = all_tokens[: (max_tokens - 1)]
+            # stop walking as soon as token budget (keeping room for `<end>`) is reached
+            all_tokens = list(itertools.islice(tokens, max(max_tokens - 1, 0)))
+        else:
+            all_tokens = list(tokens)
         all_tokens.append("<end>")
         return all_tokens
 
+    def parse_stream(self, lang: str, code: str, max_tokens: Optional[int] = None) -> List[Tuple[str, bool]]:
+        """Same tokens as `parse` with their structural flag (node types, fields, level markers...)"""
+        if self.cache is None:
+            return self._parse_stream(lang, code, max_tokens)
+
+        key = AstCache.key(
+            code,
+            lang,
+            self.library_path.stem,
+            [AST_FORMAT_VERSION, dict(self.added_nodes[lang]), list(self.skip_node_types[lang]), max_tokens],
+        )
+        tokens = self.cache.get(key)
+        if tokens is None:
+            tokens = self._parse_stream(lang, code, max_tokens)
+            self.cache.put(key, tokens)
+        return tokens
+
+    def _parse_stream(self, lang: str, code: str, max_tokens: Optional[int] = None) -> List[Tuple[str, bool]]:
+        parser = get_parser(self.library_path, lang)
+
+        code = f"{self.added_nodes[lang]['prefix']} {code} {self.added_nodes[lang]['suffix']}"
+
+        source = bytes(code, "utf8")
+        tree = parser.parse(source)
+        stream = self.iter_breadth_first_path(lang, source, tree.walk(), skip_node_types=self.skip_node_types[lang])
+        tokens: List[Tuple[str, bool]]
+        if max_tokens is not None:
+            tokens = list(itertools.islice(stream, max(max_tokens - 1, 0)))
+        else:
+            tokens = list(stream)
+        tokens.append(("<end>", True))
+        return tokens
+
+    def extract_definitions(self, lang: str, source: bytes) -> List[Tuple[str, int, List[str]]]:
+        """
+        Extract function/method definitions of a whole source file as (identifier, start line, code tokens).
+
+        Code tokens are the source of leaves (comments excluded) like `function_tokens` of CodeSearchNet definitions.
+        """
+        parser = get_parser(self.library_path, lang)
+        tree = parser.parse(source)
+        function_types = FUNCTION_NODE_TYPES.get(lang, set())
+
+        definitions: List[Tuple[str, int, List[str]]] = []
+        nodes: Deque[Node] = deque([tree.root_node])
+        while len(nodes) > 0:
+            node = nodes.popleft()
+            if node.type in function_types:
+                name_node = node.child_by_field_name("name")
+                name = ""
+                if name_node is not None:
+                    name = source[name_node.start_byte : name_node.end_byte].decode("utf8", errors="replace")
+                tokens: List[str] = []
+                leaves: List[Node] = [node]
+                # depth-first to keep tokens in source order
+                while len(leaves) > 0:
+                    leaf = leaves.pop()
+                    if "comment" in leaf.type:
+                        continue
+                    if len(leaf.children) == 0:
+                        tok = source[leaf.start_byte : leaf.end_byte].decode("utf8", errors="replace")
+                        if len(tok) > 0:
+                            tokens.append(tok)
+                    else:
+                        leaves.extend(reversed(leaf.children))
+                definitions.append((name, node.start_point[0] + 1, tokens))
+            # nested functions (closures, methods of classes) are definitions too
+            nodes.extend(node.children)
+        return definitions
+
     def parse_full(self, lang: str, code: str) -> Tuple[List[str], Set[str]]:
-        LANGUAGE = Language("build/my-languages.so", lang)
-        self.parser.set_language(LANGUAGE)
+        if self.cache is not None:
+            stream = self.parse_stream(lang, code)
+            return [tok for tok, _ in stream], set(tok for tok, is_structural in stream if is_structural)
+
+        parser = get_parser(self.library_path, lang)
 
         code = f"{self.added_nodes[lang]['prefix']} {code} {self.added_nodes[lang]['suffix']}"
 
-        tree = self.parser.parse(bytes(code, "utf8"))
+        source = bytes(code, "utf8")
+        tree = parser.parse(source)
         cursor = tree.walk()
 
-        tokens, special_tokens = self.breadth_first_path(lang, code, cursor, skip_node_types=self.skip_node_types[lang])
+        tokens, special_tokens = self.breadth_first_path(
+            lang, source, cursor, skip_node_types=self.skip_node_types[lang]
+        )
         return tokens, special_tokens
 
     def parse(self, lang: str, code: str, max_tokens: Optional[int] = None) -> List[str]:
-        LANGUAGE = Language("build/my-languages.so", lang)
-        self.parser.set_language(LANGUAGE)
+        if self.cache is not None:
+            return [tok for tok, _ in self.parse_stream(lang, code, max_tokens)]
+
+        parser = get_parser(self.library_path, lang)
 
         code = f"{self.added_nodes[lang]['prefix']} {code} {self.added_nodes[lang]['suffix']}"
 
-        tree = self.parser.parse(bytes(code, "utf8"))
+        source = bytes(code, "utf8")
+        tree = parser.parse(source)
         cursor = tree.walk()
 
         tokens = self.breadth_first_path_light(
-            lang, code, cursor, skip_node_types=self.skip_node_types[lang], max_tokens=max_tokens
+            lang, source, cursor, skip_node_types=self.skip_node_types[lang], max_tokens=max_tokens
         )
         return tokens
 
 
+class StructuralTokenIds:
+    """
+    Encode linearized ASTs to ids: structural tokens (closed set of node types, fields & markers added as special
+    tokens to tokenizer) are mapped with a fixed table and only leaves (identifiers, literals, anonymous nodes)
+    are tokenized by the text tokenizer (memoized as leaves repeat a lot).
+    """
+
+    def __init__(self, tokenizer: TokenizerRecordable, special_tokens: List[str], max_cached_leaves: int = 100000):
+        self.tokenizer = tokenizer
+        self.table: Dict[str, int] = dict(zip(special_tokens, tokenizer.convert_tokens_to_ids(special_tokens)))
+        self.max_cached_leaves = max_cached_leaves
+        self.leaves: Dict[str, List[int]] = {}
+
+    def leaf_ids(self, leaf: str) -> List[int]:
+        ids = self.leaves.get(leaf)
+        if ids is None:
+            ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(leaf))
+            if len(self.leaves) >= self.max_cached_leaves:
+                self.leaves.clear()
+            self.leaves[leaf] = ids
+        return ids
+
+    def encode(self, tokens: List[Tuple[str, bool]], max_length: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Merge structural & leaves ids into (ids, mask) truncated/padded (with 0) to max_length"""
+        ids: List[int] = []
+        for tok, is_structural in tokens:
+            if len(ids) >= max_length:
+                break
+            if is_structural and tok in self.table:
+                ids.append(self.table[tok])
+            else:
+                ids.extend(self.leaf_ids(tok))
+        ids = ids[:max_length]
+        token_ids = np.zeros(max_length, dtype=self.tokenizer.ids_dtype())
+        token_ids[: len(ids)] = ids
+        token_mask = np.zeros(max_length, dtype=MASK_DTYPE)
+        token_mask[: len(ids)] = 1
+        return token_ids, token_mask
+
+
+def ast_cache_from_params(data_params: DatasetParams) -> Optional[AstCache]:
+    if data_params.ast_cache_path is None:
+        return None
+    return AstCache(data_params.ast_cache_path, max_mb=data_params.ast_cache_max_mb)
+
+
 def load_special_tokens(data_params: DatasetParams):
     special_tokens: List[str] = []
     for f in data_params.ast_special_tokens_files:
@@ -186,30 +370,72 @@ def load_special_tokens(data_params: DatasetParams):
     return special_tokens
 
 
+def file_ast_stats(file_path: Path, parser: TreeSitterParser) -> Tuple[Set[str], Dict[str, Counter]]:
+    """Parse all code samples of a data file and return its special tokens & histograms of AST lengths per language"""
+    logger.info(f"Reading {file_path}")
+    special_tokens: Set[str] = set()
+    lengths: Dict[str, Counter] = defaultdict(Counter)
+    for raw_sample in read_file_samples(file_path):
+        lang = raw_sample["language"]
+        tokens, sample_special_tokens = parser.parse_full(lang, raw_sample["code"])
+        special_tokens.update(sample_special_tokens)
+        lengths[lang][len(tokens)] += 1
+    return special_tokens, dict(lengths)
+
+
+def histogram_stats(histogram: Counter) -> Tuple[int, int, float, float]:
+    """(min, max, mean, stddev) of values counted in histogram"""
+    nb = sum(histogram.values())
+    mean = sum(v * c for v, c in histogram.items()) / nb
+    var = sum(c * (v - mean) ** 2 for v, c in histogram.items()) / (nb - 1) if nb > 1 else 0.0
+    return min(histogram), max(histogram), mean, math.sqrt(var)
+
+
 def build_language_ast(name: str, dirs: List[Path], pickle_path: Path, data_params: DatasetParams):
     start = time.time()
 
     if data_params.use_ast == "tree-sitter":
+        # parser is lightweight to send to workers, tree-sitter parsers are created per process (see get_parser)
         parser = TreeSitterParser(
             langs=["go", "java", "javascript", "python", "php", "ruby"],
             added_nodes=data_params.ast_added_nodes,
             skip_node_types=data_params.ast_skip_node_types,
+            cache=ast_cache_from_params(data_params),
         )
 
         all_special_tokens: Set[str] = set()
 
-        lengths: Dict[str, List[int]] = {"go": [], "java": [], "javascript": [], "python": [], "php": [], "ruby": []}
-
-        for (idx, file_path) in enumerate(get_data_files_from_directory(dirs)):
-            logger.info(f"Reading {file_path}")
-            raw_samples = list(read_file_samples(file_path))
-            for raw_sample in raw_samples:
-                lang = raw_sample["language"]
-                tokens, special_tokens = parser.parse_full(lang, raw_sample["code"])
+        lengths: Dict[str, Counter] = {
+            "go": Counter(),
+            "java": Counter(),
+            "javascript": Counter(),
+            "python": Counter(),
+            "php": Counter(),
+            "ruby": Counter(),
+        }
+
+        files = sort_files_by_size(get_data_files_from_directory(dirs))
+        per_file_stats: Iterable[Tuple[Set[str], Dict[str, Counter]]]
+        pool = None
+        if data_params.parallelize:
+            from pathos.pools import ProcessPool
+
+            pool = ProcessPool()
+            per_file_stats = pool.uimap(lambda f: file_ast_stats(f, parser), files)
+        else:
+            per_file_stats = (file_ast_stats(f, parser) for f in files)
 
+        try:
+            # reduce files special tokens & length histograms
+            for special_tokens, file_lengths in per_file_stats:
                 all_special_tokens.update(special_tokens)
-
-                lengths[lang].append(len(tokens))
+                for lang, histogram in file_lengths.items():
+                    lengths.setdefault(lang, Counter()).update(histogram)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+                pool.clear()
 
         end = time.time()
         logger.debug(f"all_special_tokens ({len(all_special_tokens)}) {all_special_tokens}")
@@ -221,14 +447,9 @@ def build_language_ast(name: str, dirs: List[Path], pickle_path: Path, data_para
         with open(json_file, "w") as f:
             json.dump(list(all_special_tokens), f)
 
-        import statistics
-
-        for lang, lgs in lengths.items():
-            if len(lgs) > 0:
-                max_lg = max(lgs)
-                min_lg = min(lgs)
-                mean_lg = statistics.mean(lgs)
-                std_lg = statistics.stdev(lgs)
+        for lang, histogram in lengths.items():
+            if len(histogram) > 0:
+                min_lg, max_lg, mean_lg, std_lg = histogram_stats(histogram)
                 logger.debug(f"{lang} [ min:{min_lg}, max:{max_lg}, mean:{mean_lg}, stddev:{std_lg} ]")
 
         time_p = end - start
@@ -3,7 +3,7 @@
 from dataclasses import dataclass, fields as datafields
 import numpy as np
 
-from typing import Dict, TypeVar, Type, List
+from typing import Dict, TypeVar, Type, List, Optional
 from dataclasses import field
 
 
@@ -28,10 +28,18 @@ class DatasetParams:
     use_lang_weights: bool = False  # for backward compat
     query_random_token_frequency: float = 0.2
     query_embeddings: str = "none"
+    query_embeddings_dtype: str = "float32"
+    query_embeddings_batch_size: int = 64
+    query_embeddings_chunk_size: int = 10000
+    query_embeddings_processes: int = 1
+    mmap_samples: bool = False
     use_ast: str = "none"
     ast_added_nodes: Dict[str, Dict[str, str]] = field(default_factory=dict)
     ast_skip_node_types: Dict[str, List[str]] = field(default_factory=dict)
     ast_special_tokens_files: List[str] = field(default_factory=list)
+    ast_structural_ids: bool = False
+    ast_cache_path: Optional[str] = None
+    ast_cache_max_mb: int = 1024
 
 
 T_InputFeatures = TypeVar("T_InputFeatures", bound="InputFeatures")
@@ -4,8 +4,11 @@
 
 from abc import abstractmethod
 
-from typing import Any, Dict, Iterable, List, Optional, Tuple, Union, Iterator, Callable
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union, Iterator, Callable, Set
 import re
+import bisect
+import dataclasses
+import time
 
 import numpy as np
 import random
@@ -21,13 +24,18 @@ import functools
 import sklearn
 from sklearn.metrics.pairwise import pairwise_distances, cosine_similarity
 import pandas as pd
-from tqdm import tqdm
 from enum import Enum
 
 from codenets.codesearchnet.data import InputFeatures
 from codenets.utils import _to_subtoken_stream
 from codenets.codesearchnet.copied_code.metadata import QueryType
 from codenets.codesearchnet.tokenizer_recs import TokenizerRecordable
+from codenets.codesearchnet.query_embeddings import (
+    angular_similarities,
+    build_query_embeddings,
+    convert_annoy_query_embeddings,
+    load_query_embeddings,
+)
 
 
 class DatasetType(Enum):
@@ -155,8 +163,93 @@ class ConcatNamedDataset(Dataset):
         pass
 
 
+# language ids are small positive integers
+LANGUAGE_DTYPE = np.int8
+
+
+class NpArraysSamples(object):
+    """
+    Samples stored column by column in a few large numpy buffers.
+
+    There is no Python object per sample so forked DataLoader workers don't touch (and copy-on-write)
+    the pages holding the samples. Buffers can also be memory-mapped from disk to be shared by all processes.
+
+    Args:
+        columns (Dict[str, np.ndarray]): one array per field, first dimension is the sample index
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = columns
+
+    @classmethod
+    def from_features(cls, features: List[InputFeatures]) -> "NpArraysSamples":
+        names = [f.name for f in dataclasses.fields(InputFeatures)]
+        columns = {name: _stack_column([getattr(feat, name) for feat in features]) for name in names}
+        columns["language"] = columns["language"].astype(LANGUAGE_DTYPE)
+        return cls(columns)
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame) -> "NpArraysSamples":
+        columns = {name: _stack_column(list(df[name].values)) for name in df.columns}
+        if "lang" in columns:
+            columns["lang"] = columns["lang"].astype(LANGUAGE_DTYPE)
+        return cls(columns)
+
+    def to_mmap(self, path: Path) -> "NpArraysSamples":
+        """Save columns as .npy files in path and reload them memory-mapped (read-only)"""
+        os.makedirs(path, exist_ok=True)
+        columns: Dict[str, np.ndarray] = {}
+        for name, column in self.columns.items():
+            if column.dtype == object:
+                # ragged column can't be memory-mapped
+                columns[name] = column
+                continue
+            np.save(str(path / f"{name}.npy"), column)
+            columns[name] = np.load(str(path / f"{name}.npy"), mmap_mode="r")
+        return NpArraysSamples(columns)
+
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self.columns.values())
+
+    def nbytes_int64(self) -> int:
+        """Size the same samples would take with int64 integers (to measure compact dtypes savings)"""
+        return sum(
+            column.size * 8 if column.dtype.kind in "iub" else column.nbytes for column in self.columns.values()
+        )
+
+    def row(self, idx: int) -> Dict[Any, Any]:
+        return {name: column[idx] for name, column in self.columns.items()}
+
+    def __len__(self):
+        """Get number of samples"""
+        return len(next(iter(self.columns.values()))) if len(self.columns) > 0 else 0
+
+
+def _stack_column(values: List[Any]) -> np.ndarray:
+    """Stack values of one field in one array (or an array of objects if values are ragged)"""
+    if len(values) > 0 and isinstance(values[0], np.ndarray):
+        try:
+            return np.stack(values)
+        except ValueError:
+            column = np.empty(len(values), dtype=object)
+            column[:] = values
+            return column
+    return np.array(values)
+
+
+def log_worker_memory(worker_id: int) -> None:
+    """DataLoader worker_init_fn reporting memory of the worker (USS is what the worker really costs)"""
+    import psutil
+
+    mem = psutil.Process().memory_full_info()
+    logger.info(
+        f"DataLoader worker {worker_id} [pid:{os.getpid()}] memory "
+        f"rss:{mem.rss >> 20}MB uss:{mem.uss >> 20}MB shared:{mem.shared >> 20}MB"
+    )
+
+
 class FeatsDataset(Dataset):
-    def __init__(self, samples: List[InputFeatures], transform: Callable[[InputFeatures, int], List[torch.Tensor]]):
+    def __init__(self, samples: NpArraysSamples, transform: Callable[[InputFeatures, int], List[torch.Tensor]]):
         self.samples = samples
         self.transform = transform
 
@@ -166,50 +259,45 @@ class FeatsDataset(Dataset):
 
     def __getitem__(self, idx) -> List[torch.Tensor]:
         """Get dataset item by idx"""
-        s = self.transform(self.samples[idx], idx)
+        s = self.transform(InputFeatures(**self.samples.row(idx)), idx)
         return s
 
 
 class DFDataset(Dataset):
-    def __init__(self, df: pd.DataFrame, transform: Callable[[pd.Series, int], List[torch.Tensor]]):
-        self.df = df
+    def __init__(self, samples: NpArraysSamples, transform: Callable[[Dict[Any, Any], int], List[torch.Tensor]]):
+        self.samples = samples
         self.transform = transform
 
     def __len__(self):
         """Get dataset length"""
-        return self.df.shape[0]
-        # return len(self.values)
+        return len(self.samples)
 
     def __getitem__(self, idx) -> List[torch.Tensor]:
         """Get dataset item by idx"""
-        s = self.transform(self.df.iloc[idx], idx)
+        s = self.transform(self.samples.row(idx), idx)
         return s
 
 
 class InputFeaturesToNpArray(object):
+    """Sample transform of Query1Code1/Query1CodeN datasets (7 fields batches without sample index)"""
+
     def __init__(self, lang_weights: Optional[Dict[int, float]]):
         self.lang_weights = lang_weights
 
-    def __call_(self, features: Iterable[InputFeatures]):
-        all_query_tokens = [f.query_tokens for f in features]
-        all_query_tokens_mask = [f.query_tokens_mask for f in features]
-        all_code_tokens = [f.code_tokens for f in features]
-        all_code_tokens_mask = [f.code_tokens_mask for f in features]
-        all_languages = [f.language for f in features]
-        all_similarity = [f.similarity for f in features]
+    def __call__(self, feat: InputFeatures, idx: int) -> List[np.ndarray]:
         if self.lang_weights is not None:
-            all_lang_weights = [self.lang_weights[f.language] for f in features]
+            lang_weights = self.lang_weights[feat.language]
         else:
-            all_lang_weights = [1.0 for _ in features]
-        return (
-            all_languages,
-            all_similarity,
-            all_query_tokens,
-            all_query_tokens_mask,
-            all_code_tokens,
-            all_code_tokens_mask,
-            all_lang_weights,
-        )
+            lang_weights = 1.0
+        return [
+            feat.language,
+            feat.similarity,
+            feat.query_tokens,
+            feat.query_tokens_mask,
+            feat.code_tokens,
+            feat.code_tokens_mask,
+            lang_weights,
+        ]
 
 
 class InputFeaturesToNpArray_RandomReplace(object):
@@ -258,7 +346,7 @@ class InputFeaturesToNpArray_RandomReplace(object):
                     self.common_tokens[language][token] for token in tokens_to_add
                 ]  # get the ID corresponding to the token we're adding
                 to_insert = 0
-                output_query = np.zeros(total_length, dtype=int)
+                output_query = np.zeros(total_length, dtype=query_tokens.dtype)
                 for idx in range(
                     min(length_without_padding, total_length - len(insert_indices))
                 ):  # iterate only through the beginning of the array where changes are being made
@@ -267,47 +355,13 @@ class InputFeaturesToNpArray_RandomReplace(object):
                         to_insert += 1
                     output_query[idx + to_insert] = query_tokens[idx]
                 query_tokens = output_query
-                # Add the needed number of non-padding values to the mask:
+                # Add the needed number of non-padding values to the mask (copy as samples buffers are shared)
+                query_tokens_mask = query_tokens_mask.copy()
                 query_tokens_mask[length_without_padding : length_without_padding + len(tokens_to_add)] = 1.0
 
         return [idx, language, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, lang_weights]
 
 
-class FullNpArrayToFinalNpArray(object):
-    def __init__(
-        self,
-        lang_weights: Optional[Dict[int, float]],
-        fraction_using_func_name: float,
-        query_random_token_frequency: float,
-        common_tokens: Dict[int, List[int]],
-    ):
-        self.lang_weights = lang_weights
-        self.fraction_using_func_name = fraction_using_func_name
-        self.query_random_token_frequency = query_random_token_frequency
-        self.common_tokens = common_tokens
-
-    def __call__(self, feat: pd.Series, idx: int) -> List[np.ndarray]:
-
-        if random.uniform(0.0, 1.0) < self.fraction_using_func_name:
-            query_tokens = feat[2]
-            query_tokens_mask = feat[3]
-        else:
-            query_tokens = feat[4]
-            query_tokens_mask = feat[5]
-
-        code_tokens = feat[6]
-        code_tokens_mask = feat[7]
-
-        language = feat[0]
-        similarity = feat[1]
-        if self.lang_weights is not None:
-            lang_weights = self.lang_weights[language]
-        else:
-            lang_weights = 1.0
-
-        return [idx, language, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, lang_weights]
-
-
 class PDSeriesToNpArray(object):
     def __init__(
         self,
@@ -321,7 +375,7 @@ class PDSeriesToNpArray(object):
         self.query_random_token_frequency = query_random_token_frequency
         self.common_tokens = common_tokens
 
-    def __call__(self, feat: pd.Series, idx: int) -> List[np.ndarray]:
+    def __call__(self, feat: Dict[Any, Any], idx: int) -> List[np.ndarray]:
 
         if random.uniform(0.0, 1.0) < self.fraction_using_func_name:
             query_tokens = feat["func_tokens"]
@@ -343,9 +397,20 @@ class PDSeriesToNpArray(object):
         return [idx, language, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, lang_weights]
 
 
+def compact_as_tensor(array: Union[np.ndarray, List[np.ndarray]]) -> torch.Tensor:
+    """
+    Convert to tensor keeping compact dtypes (sharing memory when possible).
+    Pytorch has no uint16 so uint16 token ids become int32, they are widened to long only at embedding lookup.
+    """
+    array = np.asarray(array)
+    if array.dtype == np.uint16:
+        array = array.astype(np.int32)
+    return torch.as_tensor(array)
+
+
 class Tensorize(object):
     def __call__(self, features: Iterable[np.ndarray]) -> List[torch.Tensor]:
-        res = [torch.as_tensor(f) for f in features]
+        res = [compact_as_tensor(f) for f in features]
         return res
 
 
@@ -403,6 +468,11 @@ class LangDataset(ConcatNamedDataset):
         embedding_model=None,
         tokenizer=None,
         emb_annoy_path: Path = None,
+        emb_dtype: str = "float32",
+        emb_batch_size: int = 64,
+        emb_chunk_size: int = 10000,
+        emb_processes: int = 1,
+        mmap_path: Optional[Path] = None,
     ):
         super(LangDataset, self).__init__()
 
@@ -470,93 +540,49 @@ class LangDataset(ConcatNamedDataset):
             self.lang_indexes[lang_id] = idx
             logger.info(f"Adding Language {lang} id:{idx} lang_id:{lang_id} [{nb} samples]")
             self.datasets_len.append((lang_id, lang, nb))
-            fs = list(features)
-            ds = FeatsDataset(filter_features(fs), transform)
+            samples = NpArraysSamples.from_features(filter_features(list(features)))
+            if mmap_path is not None:
+                samples = samples.to_mmap(mmap_path / lang)
+            logger.info(
+                f"Language {lang} samples stored in {samples.nbytes() >> 20}MB numpy buffers "
+                f"({samples.nbytes_int64() >> 20}MB with int64)"
+            )
+            ds = FeatsDataset(samples, transform)
             self.datasets.append(ds)
 
         self.concat_dataset: ConcatDataset = ConcatDataset(self.datasets)
         logger.info(f"Concat_dataset [{len(self.concat_dataset)} samples]")
 
-        all_embs_df: pd.DataFrame
-        if embedding_model is not None:
-            from annoy import AnnoyIndex
-
-            annoy_index = AnnoyIndex(768, "angular")
-            if emb_annoy_path is not None and emb_annoy_path.exists():
-                logger.debug(f"Loading Embeddings from AnnoyIndex {emb_annoy_path}")
-                # all_embs_df = pd.read_parquet(emb_parquet_path, columns=["embeddings"])
-
-                annoy_index.load(str(emb_annoy_path))
-
-            else:
-                logger.debug(f"Building Embeddings to AnnoyIndex {emb_annoy_path}")
-                for idx in tqdm(range(0, len(self.concat_dataset))):
-                    sample = self.concat_dataset[idx]
-                    ts = sample[3]
-                    mask = sample[4]
-                    toks = ts.cpu().numpy()[: len(mask[mask != 0])]
-                    s = tokenizer.decode_sequence(toks)
-                    s = re.sub(r"[^a-zA-Z0-9\s]+", "", s[5:]).strip()
-                    embs = embedding_model.encode([s])
-                    annoy_index.add_item(idx, embs[0])
-                annoy_index.build(10)  # 10 trees
-                annoy_index.save(str(emb_annoy_path))
-
-                # samples = [
-                #     self.concat_dataset[i]
-                #     for i in range(
-                #         idx,
-                #         idx + batch_size
-                #         if idx + batch_size < len(self.concat_dataset)
-                #         else len(self.concat_dataset),
-                #     )
-                # ]
-                # query_tokens_masks = [(sample[3], sample[4]) for sample in samples]
-                # toks = [ts.cpu().numpy()[: len(mask[mask != 0])] for (ts, mask) in query_tokens_masks]
-                # toks = tokenizer.decode_sequences(toks)
-                # # removes "<qy> "
-                # toks = [re.sub(r"[^a-zA-Z0-9\s]+", "", t[5:]).strip() for t in toks]
-                # # logger.debug(f"toks {toks}")
-                # embs = embedding_model.encode(toks)
-                # all_embs.extend([[emb] for emb in embs])
-
-                # all_embs_df = pd.DataFrame(all_embs, columns=["embeddings"])
-                # logger.debug(f"all_embs_df {all_embs_df.info()}")
-                # all_embs_df.to_parquet(emb_parquet_path)
-                logger.debug(f"Saved Embedding AnnoyIndex to {emb_annoy_path}")
-
-                # free model from mem
-                del embedding_model
-
-            # logger.debug(f"all_embs_df {all_embs_df.info()}")
-            # self.query_embeddings = query_embeddings
-            collate_fn: Optional[Callable[[List[Any]], List[Tensor]]]
-            # if self.query_embeddings is not None:
-
-            # ensuring we have the same order in embeddings as the datasets above
-            # all_embs: List[np.ndarray] = []
-            # for _, (lang, (_, _)) in enumerate(lang_features_sorted):
-            #     nb, embs = self.query_embeddings[lang]
-            #     all_embs.extend([[emb] for emb in embs])
-
-            # all_embs_df = pd.DataFrame(all_embs)
+        collate_fn: Optional[Callable[[List[Any]], List[Tensor]]]
+        emb_path = self.query_embeddings_path(emb_annoy_path)
+        if embedding_model is not None and emb_path is not None:
+            if not emb_path.exists():
+                if emb_annoy_path is not None and emb_annoy_path.exists():
+                    convert_annoy_query_embeddings(emb_annoy_path, emb_path, dtype=emb_dtype)
+                else:
+                    build_query_embeddings(
+                        sentences=self.decode_queries(tokenizer),
+                        path=emb_path,
+                        model=embedding_model,
+                        batch_size=emb_batch_size,
+                        chunk_size=emb_chunk_size,
+                        nb_processes=emb_processes,
+                        dtype=emb_dtype,
+                    )
+
+            query_embeddings = load_query_embeddings(emb_path)
+            # samples only know their index in their language dataset
+            lang_offsets = dict(
+                zip([lang_id for (lang_id, _, _) in self.datasets_len], [0] + self.get_cumulative_sizes()[:-1])
+            )
 
             def collate_fn_emb(batch):
                 all_tensors = [torch.stack([row[i] for row in batch]) for i in range(len(batch[0]))]
-                indices = all_tensors[0]
-                # logger.debug(f"indices {indices}")
-                similarities = torch.zeros(len(indices), len(indices))
-                for idx, i in enumerate(indices):
-                    dists = [1.0 - annoy_index.get_distance(i, j) for j in indices]
-                    similarities[idx, :] = torch.tensor(dists)
-                    similarities[:, idx] = torch.tensor(dists)
-                # similarities = torch.tensor([[1.0 - annoy_index.get_distance(i, j) for j in indices] for i in indices])
-                # batch_embs = np.stack(np.squeeze(all_embs_df.iloc[indices].values))
+                indices = np.array([row[0].item() + lang_offsets[row[1].item()] for row in batch])
+                similarities = angular_similarities(query_embeddings, indices)
                 margin = 0.25
-                # similarities = (torch.tensor(cosine_similarity(batch_embs, batch_embs)) - margin).clamp(min=0.0)
                 similarities = (similarities - margin).clamp(min=0.0)
                 similarities.fill_diagonal_(1.0)
-                # logger.debug(f"similarities {similarities}")
                 all_tensors[2] = similarities
 
                 return all_tensors
@@ -567,6 +593,27 @@ class LangDataset(ConcatNamedDataset):
 
         self.collate_fn = collate_fn
 
+    def decode_queries(self, tokenizer: TokenizerRecordable, batch_size: int = 1000) -> List[str]:
+        """Decode docstring queries of all samples in dataset order (removing '<qy> ' & punctuation)"""
+        queries: List[str] = []
+        for ds in self.datasets:
+            all_toks = ds.samples.columns["query_docstring_tokens"]
+            all_masks = ds.samples.columns["query_docstring_tokens_mask"]
+            for i in range(0, len(ds.samples), batch_size):
+                toks = [
+                    toks[: len(mask[mask != 0])]
+                    for toks, mask in zip(all_toks[i : i + batch_size], all_masks[i : i + batch_size])
+                ]
+                queries.extend(re.sub(r"[^a-zA-Z0-9\s]+", "", q[5:]).strip() for q in tokenizer.decode_sequences(toks))
+        return queries
+
+    @staticmethod
+    def query_embeddings_path(emb_annoy_path: Optional[Path]) -> Optional[Path]:
+        """Query embeddings matrix is stored next to the legacy AnnoyIndex path"""
+        if emb_annoy_path is None:
+            return None
+        return emb_annoy_path.with_suffix(".npy")
+
     def get_collate_fn(self) -> Optional[Callable[[List[Any]], List[Tensor]]]:
         return self.collate_fn
 
@@ -614,12 +661,13 @@ class LangDatasetDF(ConcatNamedDataset):
         self,
         lang_features_df: Dict[str, pd.DataFrame],
         lang_ids: Dict[str, int],
-        transform: Callable[[pd.Series, int], List[np.ndarray]],
+        transform: Callable[[Dict[Any, Any], int], List[np.ndarray]],
         use_lang_weights: bool = False,
         # query_embeddings: Optional[Dict[str, Tuple[int, Iterable[np.ndarray]]]] = None,
         embedding_model=None,
         tokenizer=None,
         emb_annoy_path: Path = None,
+        mmap_path: Optional[Path] = None,
     ):
         super(LangDatasetDF, self).__init__()
 
@@ -639,9 +687,14 @@ class LangDatasetDF(ConcatNamedDataset):
             self.lang_indexes[lang_id] = idx
             logger.info(f"Adding Language {lang} id:{idx} lang_id:{lang_id} [{df.shape[0]} samples]")
             self.datasets_len.append((lang_id, lang, df.shape[0]))
-            # fs = list(features)
-            # ds = FeatsDataset(filter_features(fs), transform)
-            ds = DFDataset(df, transform)
+            samples = NpArraysSamples.from_df(df)
+            if mmap_path is not None:
+                samples = samples.to_mmap(mmap_path / lang)
+            logger.info(
+                f"Language {lang} samples stored in {samples.nbytes() >> 20}MB numpy buffers "
+                f"({samples.nbytes_int64() >> 20}MB with int64)"
+            )
+            ds = DFDataset(samples, transform)
             self.datasets.append(ds)
 
         self.concat_dataset: ConcatDataset = ConcatDataset(self.datasets)
@@ -713,11 +766,17 @@ def compute_language_weightings_df(data: Dict[str, pd.DataFrame], lang_ids: Dict
 
 
 class BalancedBatchSchedulerSampler(torch.utils.data.sampler.Sampler):
-    """Iterate over tasks and provide a balanced batch per task in each mini-batch"""
+    """
+    Iterate over tasks and provide a balanced batch per task in each mini-batch
+
+    With mix_languages, samples are shuffled across languages so that every mini-batch mixes languages
+    (same balanced number of samples per language over an epoch)
+    """
 
-    def __init__(self, dataset: ConcatNamedDataset, batch_size: int):
+    def __init__(self, dataset: ConcatNamedDataset, batch_size: int, mix_languages: bool = False):
         self.dataset = dataset
         self.batch_size = batch_size
+        self.mix_languages = mix_languages
         self.number_of_datasets = dataset.get_datasets_nb()
 
         self.samplers_list: List[Sampler] = []
@@ -780,6 +839,9 @@ class BalancedBatchSchedulerSampler(torch.utils.data.sampler.Sampler):
                             cur_samples.append(cur_sample)
                 final_samples_list.extend(cur_samples)
 
+        if self.mix_languages:
+            final_samples_list = [final_samples_list[i] for i in torch.randperm(len(final_samples_list)).tolist()]
+
         logger.debug(f"Generated final_samples_list: {len(final_samples_list)}")
         self.final_samples_list = final_samples_list
         return final_samples_list
@@ -797,6 +859,111 @@ class BalancedBatchSchedulerSampler(torch.utils.data.sampler.Sampler):
         return iter(self.generate_sample_list())
 
 
+class HardNegativeBatchSchedulerSampler(BalancedBatchSchedulerSampler):
+    """
+    Balanced batch sampler mixing random samples with hard negatives mined from code embeddings.
+
+    Codes of each language dataset are encoded by `encode_codes` (typically the model being trained)
+    into an angular AnnoyIndex. Then, in every batch, a `mixing_ratio` part is replaced by clusters
+    made of a seed sample followed by the samples whose codes are the nearest neighbours of the seed code.
+    With in-batch negatives, each query then meets codes close to its own code.
+
+    Mining is lazy (batch by batch) so a refresh during an epoch is used by the next batches.
+    Indexes are built and queried on CPU.
+
+    Args:
+        dataset (ConcatNamedDataset): the dataset to sample
+        batch_size (int): the batch size
+        encode_codes (Callable[[int, Dataset], np.ndarray]): encode all codes of a language dataset [N x D]
+        refresh_interval (int): mine again every N training steps (0 means after each epoch)
+        mixing_ratio (float): the part of each batch filled with mined samples
+        nb_neighbours (int): number of nearest neighbours mined per seed sample
+        nb_trees (int): number of trees of the AnnoyIndex
+        min_distance (float): neighbours closer than that are considered as duplicates of the seed code
+    """
+
+    def __init__(
+        self,
+        dataset: ConcatNamedDataset,
+        batch_size: int,
+        encode_codes: Callable[[int, Dataset], np.ndarray],
+        refresh_interval: int = 0,
+        mixing_ratio: float = 0.5,
+        nb_neighbours: int = 8,
+        nb_trees: int = 10,
+        min_distance: float = 1e-3,
+    ):
+        self.encode_codes = encode_codes
+        self.refresh_interval = refresh_interval
+        self.mixing_ratio = mixing_ratio
+        self.nb_neighbours = nb_neighbours
+        self.nb_trees = nb_trees
+        self.min_distance = min_distance
+        # position of dataset in datasets_by_desc_size => AnnoyIndex on local sample indices
+        self.annoy_indexes: Dict[int, Any] = {}
+        super(HardNegativeBatchSchedulerSampler, self).__init__(dataset, batch_size)
+
+    def refresh(self) -> None:
+        """Encode all codes and rebuild the AnnoyIndexes used to mine hard negatives"""
+        from annoy import AnnoyIndex
+
+        start = time.time()
+        for i, (lang_id, lang, _) in enumerate(self.datasets_by_desc_size):
+            embeddings = self.encode_codes(lang_id, self.dataset.get_dataset_by_lang_id(lang_id))
+            annoy_index = AnnoyIndex(embeddings.shape[1], "angular")
+            for idx, emb in enumerate(embeddings):
+                annoy_index.add_item(idx, emb)
+            annoy_index.build(self.nb_trees)
+            self.annoy_indexes[i] = annoy_index
+            logger.debug(f"Built hard negatives AnnoyIndex for {lang} [{embeddings.shape[0]} codes]")
+        logger.info(f"Refreshed hard negatives indexes in {time.time() - start:.2f} sec")
+
+    def mine_batch(self, batch: List[int], push_index_val: List[int]) -> List[int]:
+        """
+        Replace part of a random batch by seed samples clustered with their nearest non-matching codes.
+        Batches can span several languages so each seed is mined in the index of its own language dataset.
+        """
+        nb_mined = int(len(batch) * self.mixing_ratio)
+        mined: List[int] = []
+        seen: Set[int] = set()
+        for seed in batch:
+            if len(mined) >= nb_mined:
+                break
+            if seed in seen:
+                continue
+            dataset_idx = bisect.bisect_right(push_index_val, seed) - 1
+            annoy_index = self.annoy_indexes.get(dataset_idx)
+            offset = push_index_val[dataset_idx]
+            # annoy doesn't check bounds of item indices
+            if annoy_index is None or seed - offset >= annoy_index.get_n_items():
+                continue
+            neighbours, distances = annoy_index.get_nns_by_item(
+                seed - offset, self.nb_neighbours + 1, include_distances=True
+            )
+            cluster = [seed] + [
+                offset + n for n, d in zip(neighbours, distances) if n != seed - offset and d >= self.min_distance
+            ]
+            for sample in cluster[: nb_mined - len(mined)]:
+                if sample not in seen:
+                    mined.append(sample)
+                    seen.add(sample)
+
+        rest = [sample for sample in batch if sample not in seen]
+        return mined + rest[: len(batch) - len(mined)]
+
+    def mine_batches(self, samples: List[int]) -> Iterator[int]:
+        push_index_val = [0] + self.dataset.get_cumulative_sizes()[:-1]
+        for start in range(0, len(samples), self.batch_size):
+            yield from self.mine_batch(samples[start : start + self.batch_size], push_index_val)
+
+    def __iter__(self):
+        """Return iter of samples"""
+        samples = self.generate_sample_list()
+        if len(self.annoy_indexes) == 0 or self.mixing_ratio <= 0.0:
+            return iter(samples)
+        return self.mine_batches(samples)
+
+
 def compose(*functions):
     # f ° g
     def compose2(g, f):
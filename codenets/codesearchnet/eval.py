@@ -18,25 +18,29 @@ azure://semanticcodesearch/csharpdata/split/csharpCrawl-train
 Options:
     -h --help                        Show this screen.
     --restore DIR                    specify restoration dir. [optional]
+    --quantize                       Evaluate model with int8 dynamically quantized Linear layers (on CPU).
+    --projection DIR                 Evaluate embeddings reduced by a projection (see projection.py).
     --debug                          Enable debug routines. [default: False]
 """
 
 import os
+import time
 import torch
 from docopt import docopt
 from dpu_utils.utils import run_and_debug
 from loguru import logger
 from tqdm import tqdm
 
-from torch.utils.data import DataLoader
-
 # from codenets.codesearchnet.single_branch_ctx import SingleBranchTrainingContext
-from codenets.codesearchnet.dataset_utils import BalancedBatchSchedulerSampler, DatasetType
+from codenets.codesearchnet.dataset_utils import DatasetType
+from codenets.codesearchnet.projection import project_training_ctx
+from codenets.codesearchnet.quantization import quantize_training_ctx
 from codenets.codesearchnet.training_ctx import (
     CodeSearchTrainingContext,
-    compute_loss_mrr,
+    compute_loss_mrr_ndcg,
     TotalLoss,
     TotalMrr,
+    TotalNdcg,
     TotalSize,
     BatchSize,
     BatchLoss,
@@ -61,69 +65,49 @@ def run(args, tag_in_vcs=False) -> None:
     # )
     # logger.info(f"Built val_dataloader [Length:{len(val_dataloader)} x Batch:{training_ctx.val_batch_size}]")
 
+    if args["--quantize"]:
+        quantize_training_ctx(training_ctx)
+    if args["--projection"] is not None:
+        project_training_ctx(training_ctx, args["--projection"])
+
     # Build Test Dataloader
-    test_dataset = training_ctx.build_lang_dataset(DatasetType.TEST)
-    test_dataloader = DataLoader(
-        dataset=test_dataset,
-        batch_size=training_ctx.val_batch_size,
-        sampler=BalancedBatchSchedulerSampler(dataset=test_dataset, batch_size=training_ctx.test_batch_size),
-    )
+    test_dataloader = training_ctx.build_lang_dataloader(DatasetType.TEST)
     logger.info(f"Built test_dataloader [Length:{len(test_dataloader)} x Batch:{training_ctx.test_batch_size}]")
 
     total_loss = TotalLoss(0.0)
     total_size = TotalSize(0)
     total_mrr = TotalMrr(0.0)
+    total_ndcg = TotalNdcg(0.0)
+    avg_loss, avg_mrr, avg_ndcg = 0.0, 0.0, 0.0
     training_ctx.eval_mode()
-    with torch.no_grad():
-        training_ctx.zero_grad()
-    with tqdm(total=len(test_dataloader)) as t_batch:
+    start = time.time()
+    with torch.no_grad(), tqdm(total=len(test_dataloader)) as t_batch:
         for batch_idx, batch in enumerate(test_dataloader):
-            languages, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask = [
-                t.to(training_ctx.device) for t in batch
-            ]
-
             batch_total_loss, similarity_scores = training_ctx.forward(batch, batch_idx)
 
             batch_size = BatchSize(batch[0].size()[0])
             batch_loss = BatchLoss(batch_total_loss.item())
-            total_loss, avg_loss, total_mrr, avg_mrr, total_size = compute_loss_mrr(
-                similarity_scores, batch_loss, batch_size, total_loss, total_mrr, total_size
+            total_loss, avg_loss, total_mrr, avg_mrr, total_ndcg, avg_ndcg, total_size = compute_loss_mrr_ndcg(
+                batch,
+                similarity_scores,
+                batch_loss,
+                batch_size,
+                total_loss,
+                total_mrr,
+                total_ndcg,
+                total_size,
+                training_ctx.device,
             )
-            #     languages=languages,
-            #     query_tokens=query_tokens,
-            #     query_tokens_mask=query_tokens_mask,
-            #     code_tokens=code_tokens,
-            #     code_tokens_mask=code_tokens_mask,
-            # )
-            # batch_total_losses, similarity_scores = training_ctx.losses_scores_fn(
-            #     query_embedding, code_embedding, similarity
-            # )
-            # batch_total_loss = torch.mean(batch_total_losses)
-
-            # nb_samples = batch[0].size()[0]
-
-            # # compute MRR
-            # # extract the logits from the diagonal of the matrix, which are the logits corresponding to the ground-truth
-            # correct_scores = similarity_scores.diagonal()
-            # # compute how many queries have bigger logits than the ground truth (the diagonal)
-            # # the elements that are incorrectly ranked
-            # compared_scores = similarity_scores.ge(correct_scores.unsqueeze(dim=-1)).float()
-            # compared_scores_nb = torch.sum(compared_scores, dim=1)
-            # per_sample_mrr = torch.div(1.0, compared_scores_nb)
-            # per_batch_mrr = torch.sum(per_sample_mrr) / nb_samples
-
-            # epoch_samples += nb_samples
-            # epoch_loss += batch_total_loss.item() * nb_samples
-            # loss = epoch_loss / max(1, epoch_samples)
-
-            # mrr_sum += per_batch_mrr.item() * nb_samples
-            # mrr = mrr_sum / max(1, epoch_samples)
-
-            t_batch.set_postfix({f"loss": f"{batch_total_loss.item():10}"})
+
+            t_batch.set_postfix({"loss": f"{avg_loss:10}", "mrr": f"{avg_mrr:10}"})
             t_batch.update(1)
+    used_time = time.time() - start
 
     logger.info(
-        f"total_loss:{total_loss}, avg_loss:{avg_loss}, total_mrr:{total_mrr}, avg_mrr:{avg_mrr}, total_size:{total_size}"
+        f"{'int8 quantized' if args['--quantize'] else 'float32'} model"
+        f"{' with projection' if args['--projection'] is not None else ''}: "
+        f"total_loss:{total_loss}, avg_loss:{avg_loss}, avg_mrr:{avg_mrr}, avg_ndcg:{avg_ndcg}, "
+        f"total_size:{total_size}, samples_per_sec:{int(total_size / max(used_time, 1e-6))}"
     )
 
 
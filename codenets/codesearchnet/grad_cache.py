@@ -0,0 +1,90 @@
+from typing import Callable, ContextManager, List, Optional, Sequence, Tuple
+
+import torch
+from torch import Tensor
+from torch.utils.checkpoint import get_device_states, set_device_states
+
+from codenets.codesearchnet.mixed_precision import MixedPrecision
+
+# encodes a chunk of model inputs into (query embeddings, code embeddings)
+EncodeFn = Callable[[List[Tensor]], Tuple[Tensor, Tensor]]
+# computes (loss, similarity scores) of whole logical batch from (query embeddings, code embeddings)
+LossFn = Callable[[Tensor, Tensor], Tuple[Tensor, Tensor]]
+
+
+class RandContext:
+    """
+    Records CPU & GPU random states at creation and replays them when entered so that the re-encoding of a chunk
+    with gradients draws the same dropout masks as its first no-grad encoding.
+    """
+
+    def __init__(self, *tensors: Tensor):
+        self.fwd_cpu_state = torch.get_rng_state()
+        self.fwd_gpu_devices, self.fwd_gpu_states = get_device_states(*tensors)
+        self._fork: Optional[ContextManager] = None
+
+    def __enter__(self) -> None:
+        self._fork = torch.random.fork_rng(devices=self.fwd_gpu_devices, enabled=True)
+        self._fork.__enter__()
+        torch.set_rng_state(self.fwd_cpu_state)
+        set_device_states(self.fwd_gpu_devices, self.fwd_gpu_states)
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if self._fork is not None:
+            self._fork.__exit__(exc_type, exc_val, exc_tb)
+            self._fork = None
+
+
+def grad_cache_backward(
+    encode: EncodeFn,
+    loss_fn: LossFn,
+    inputs: Sequence[Tensor],
+    chunk_size: int,
+    mixed_precision: Optional[MixedPrecision] = None,
+) -> Tuple[Tensor, Tensor]:
+    """
+    Backward pass of a contrastive loss over a large logical batch at the memory cost of a chunk (Gradient Cache):
+    1. encode all chunks without gradients and keep embeddings only,
+    2. compute loss of whole batch (all in-batch negatives) & gradients of loss w.r.t. embeddings,
+    3. re-encode each chunk with gradients and backprop its cached embeddings gradients into model parameters.
+
+    Parameters gradients are accumulated (and scaled in float16 mixed precision), optimizer step is left to caller.
+
+    Args:
+        encode: encoding of a chunk of inputs into (query, code) embeddings
+        loss_fn: (loss, similarity scores) of whole batch from all (query, code) embeddings
+        inputs: model inputs of whole batch (batch dimension first)
+        chunk_size: number of samples encoded with gradients at once
+        mixed_precision: gradient scaler of float16 training if any
+
+    Returns:
+        Tuple[Tensor, Tensor]: (detached loss, detached similarity scores) of whole batch
+    """
+    chunks = list(zip(*[t.split(chunk_size) for t in inputs]))
+
+    rand_states: List[RandContext] = []
+    query_chunks: List[Tensor] = []
+    code_chunks: List[Tensor] = []
+    with torch.no_grad():
+        for chunk in chunks:
+            rand_states.append(RandContext(*chunk))
+            query_emb, code_emb = encode(list(chunk))
+            query_chunks.append(query_emb)
+            code_chunks.append(code_emb)
+
+    query_embeddings = torch.cat(query_chunks).detach().requires_grad_()
+    code_embeddings = torch.cat(code_chunks).detach().requires_grad_()
+    loss, similarity_scores = loss_fn(query_embeddings, code_embeddings)
+    if mixed_precision is not None:
+        mixed_precision.backward(loss)
+    else:
+        loss.backward()
+
+    query_grads = query_embeddings.grad.split(chunk_size)
+    code_grads = code_embeddings.grad.split(chunk_size)
+    for chunk, rand_state, query_grad, code_grad in zip(chunks, rand_states, query_grads, code_grads):
+        with rand_state:
+            query_emb, code_emb = encode(list(chunk))
+        torch.autograd.backward([query_emb, code_emb], [query_grad, code_grad])
+
+    return loss.detach(), similarity_scores.detach()
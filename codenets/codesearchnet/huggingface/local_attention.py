@@ -0,0 +1,157 @@
+import math
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from loguru import logger
+from torch import Tensor, nn
+from transformers import PreTrainedModel
+from transformers.modeling_bert import BertSelfAttention
+
+ATTENTION_TYPES = ["dense", "block_local"]
+
+# additive mask value of BERT extended attention masks
+MASKED = -10000.0
+
+
+class BlockLocalSelfAttention(nn.Module):
+    """
+    Drop-in replacement of BertSelfAttention (same query/key/value parameters) with block-local + global attention:
+    - sequence is split in blocks of block_size tokens, each token attending to tokens of its block & both neighbour
+      blocks (window of 3 blocks),
+    - the first nb_global_tokens tokens (<lg>, <qy>...) attend to all tokens and all tokens attend to them.
+
+    Attention is linear in sequence length instead of quadratic. Sequences fitting in one block use dense attention.
+    With output_attentions, returned probabilities are the local ones [B x H x nb_blocks x block_size x keys].
+    """
+
+    def __init__(self, self_attention: BertSelfAttention, block_size: int = 64, nb_global_tokens: int = 1):
+        super(BlockLocalSelfAttention, self).__init__()
+        self.output_attentions = self_attention.output_attentions
+        self.num_attention_heads = self_attention.num_attention_heads
+        self.attention_head_size = self_attention.attention_head_size
+        self.all_head_size = self_attention.all_head_size
+        self.query = self_attention.query
+        self.key = self_attention.key
+        self.value = self_attention.value
+        self.dropout = self_attention.dropout
+        self.block_size = block_size
+        self.nb_global_tokens = nb_global_tokens
+
+    def transpose_for_scores(self, x: Tensor) -> Tensor:
+        """[B x S x all_head_size] -> [B x H x S x head_size]"""
+        new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
+        return x.view(*new_x_shape).permute(0, 2, 1, 3)
+
+    def dense_attention(
+        self, q: Tensor, k: Tensor, v: Tensor, attention_mask: Optional[Tensor], head_mask: Optional[Tensor]
+    ) -> Tuple[Tensor, Tensor]:
+        scores = torch.matmul(q, k.transpose(-1, -2)) / math.sqrt(self.attention_head_size)
+        if attention_mask is not None:
+            scores = scores + attention_mask
+        probs = self.dropout(F.softmax(scores, dim=-1))
+        if head_mask is not None:
+            probs = probs * head_mask
+        return torch.matmul(probs, v), probs
+
+    def local_attention(
+        self, q: Tensor, k: Tensor, v: Tensor, key_mask: Tensor, head_mask: Optional[Tensor]
+    ) -> Tuple[Tensor, Tensor]:
+        """Block-local attention of q [B x H x S x d] on neighbour blocks & global tokens of k, v"""
+        bs, nb_heads, seq_len, head_size = q.shape
+        b = self.block_size
+        g = self.nb_global_tokens
+        pad = (b - seq_len % b) % b
+        nb_blocks = (seq_len + pad) // b
+
+        # global tokens are attended through global keys only, not again in local windows
+        local_mask = key_mask.clone()
+        local_mask[:, :g] = MASKED
+        # pad sequence with 1 masked block on each side so that every block has 2 neighbours
+        q_blocks = F.pad(q, (0, 0, 0, pad)).view(bs, nb_heads, nb_blocks, b, head_size)
+        k_pad = F.pad(k, (0, 0, b, pad + b))
+        v_pad = F.pad(v, (0, 0, b, pad + b))
+        mask_pad = F.pad(local_mask, (b, pad + b), value=MASKED)
+
+        def windows(x: Tensor) -> Tensor:
+            """[B x H x (nb_blocks + 2) * b x d] -> [B x H x nb_blocks x 3 * b x d]"""
+            x = x.view(bs, nb_heads, nb_blocks + 2, b, head_size)
+            return torch.cat([x[:, :, :-2], x[:, :, 1:-1], x[:, :, 2:]], dim=3)
+
+        masks = mask_pad.view(bs, nb_blocks + 2, b)
+        window_mask = torch.cat([masks[:, :-2], masks[:, 1:-1], masks[:, 2:]], dim=2)  # [B x nb_blocks x 3b]
+
+        global_k = k[:, :, :g].unsqueeze(2).expand(bs, nb_heads, nb_blocks, g, head_size)
+        global_v = v[:, :, :g].unsqueeze(2).expand(bs, nb_heads, nb_blocks, g, head_size)
+        global_mask = key_mask[:, :g].unsqueeze(1).expand(bs, nb_blocks, g)
+
+        keys = torch.cat([global_k, windows(k_pad)], dim=3)  # [B x H x nb_blocks x (g + 3b) x d]
+        values = torch.cat([global_v, windows(v_pad)], dim=3)
+        mask = torch.cat([global_mask, window_mask], dim=2)[:, None, :, None, :]  # [B x 1 x nb_blocks x 1 x (g + 3b)]
+
+        scores = torch.matmul(q_blocks, keys.transpose(-1, -2)) / math.sqrt(head_size) + mask
+        probs = self.dropout(F.softmax(scores, dim=-1))
+        if head_mask is not None:
+            probs = probs * head_mask.unsqueeze(-1)
+        context = torch.matmul(probs, values).view(bs, nb_heads, nb_blocks * b, head_size)[:, :, :seq_len]
+        return context, probs
+
+    def forward(  # type: ignore
+        self,
+        hidden_states: Tensor,
+        attention_mask: Optional[Tensor] = None,
+        head_mask: Optional[Tensor] = None,
+        encoder_hidden_states: Optional[Tensor] = None,
+        encoder_attention_mask: Optional[Tensor] = None,
+    ):
+        if encoder_hidden_states is not None:
+            raise ValueError("Block-local attention doesn't support cross-attention")
+
+        q = self.transpose_for_scores(self.query(hidden_states))
+        k = self.transpose_for_scores(self.key(hidden_states))
+        v = self.transpose_for_scores(self.value(hidden_states))
+        seq_len = hidden_states.shape[1]
+
+        if seq_len <= self.block_size:
+            context, probs = self.dense_attention(q, k, v, attention_mask, head_mask)
+        else:
+            if attention_mask is None:
+                key_mask = hidden_states.new_zeros(hidden_states.shape[:2])
+            else:
+                # extended BERT mask [B x 1 x 1 x S] of 0 (attended) or -10000 (masked)
+                key_mask = attention_mask.view(hidden_states.shape[0], seq_len).to(hidden_states.dtype)
+            context, probs = self.local_attention(q, k, v, key_mask, head_mask)
+            # global tokens attend to whole sequence
+            g = self.nb_global_tokens
+            global_context, _ = self.dense_attention(q[:, :, :g], k, v, attention_mask, head_mask)
+            context = torch.cat([global_context, context[:, :, g:]], dim=2)
+
+        context = context.permute(0, 2, 1, 3).contiguous()
+        context = context.view(*context.size()[:-2], self.all_head_size)
+        return (context, probs) if self.output_attentions else (context,)
+
+
+def setup_attention(model: PreTrainedModel) -> int:
+    """
+    Replace self-attention of BERT encoder layers according to model config `attention_type` (dense by default),
+    `attention_block_size` & `attention_global_tokens`, which are recorded with the model config.
+    Returns number of replaced self-attention modules.
+    """
+    attention_type = getattr(model.config, "attention_type", "dense")
+    if attention_type == "dense":
+        return 0
+    if attention_type not in ATTENTION_TYPES:
+        raise ValueError(f"Unknown attention_type {attention_type} (expected one of {ATTENTION_TYPES})")
+    encoder = getattr(model, "encoder", None)
+    if encoder is None or not hasattr(encoder, "layer"):
+        raise ValueError(f"attention_type {attention_type} is only supported by BERT encoders")
+
+    block_size = getattr(model.config, "attention_block_size", 64)
+    nb_global_tokens = getattr(model.config, "attention_global_tokens", 1)
+    nb = 0
+    for layer in encoder.layer:
+        if isinstance(layer.attention.self, BertSelfAttention):
+            layer.attention.self = BlockLocalSelfAttention(layer.attention.self, block_size, nb_global_tokens)
+            nb += 1
+    logger.info(f"Using {attention_type} attention (blocks of {block_size}, {nb_global_tokens} global tokens)")
+    return nb
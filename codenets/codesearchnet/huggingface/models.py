@@ -1,11 +1,16 @@
 from __future__ import annotations
 
+import functools
 import os
 from pathlib import Path
-from typing import Union, TypeVar, Type, Generic
+from typing import List, Union, TypeVar, Type, Generic
 from loguru import logger
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
 from transformers import PreTrainedModel
 
+from codenets.codesearchnet.huggingface.local_attention import setup_attention
 from codenets.recordable import RecordableTorchModule
 from codenets.utils import full_classname, instance_full_classname, runtime_import
 
@@ -14,6 +19,41 @@ PretrainedRec_T = TypeVar("PretrainedRec_T", bound="PreTrainedModelRecordable")
 Pretrained_T = TypeVar("Pretrained_T", bound="PreTrainedModel")
 
 
+CHECKPOINT_GRANULARITIES = ["layer", "attention"]
+
+
+def _checkpointed_forward(module: nn.Module, *args, **kwargs):
+    """Forward of module recomputed during backward instead of keeping its activations"""
+    if (
+        len(kwargs) == 0
+        and torch.is_grad_enabled()
+        and any(isinstance(arg, torch.Tensor) and arg.requires_grad for arg in args)
+    ):
+        # module isn't passed as a checkpoint input which can only be tensors
+        return checkpoint(functools.partial(type(module).forward, module), *args)
+    return type(module).forward(module, *args, **kwargs)
+
+
+def transformer_layers(model: PreTrainedModel, granularity: str = "layer") -> List[nn.Module]:
+    """
+    Layers of BERT/ALBERT encoders (granularity "layer") or only their self-attention blocks ("attention").
+    ALBERT layers are shared so they are checkpointed at each of their applications.
+    """
+    encoder = model.encoder
+    if hasattr(encoder, "layer"):
+        layers = list(encoder.layer)
+    elif hasattr(encoder, "albert_layer_groups"):
+        layers = [layer for group in encoder.albert_layer_groups for layer in group.albert_layers]
+    else:
+        raise ValueError(f"Unsupported encoder {type(encoder)} for gradient checkpointing")
+    if granularity == "layer":
+        return layers
+    elif granularity == "attention":
+        return [layer.attention for layer in layers]
+    else:
+        raise ValueError(f"gradient checkpointing granularity can be {CHECKPOINT_GRANULARITIES}")
+
+
 class PreTrainedModelRecordable(Generic[Pretrained_T], RecordableTorchModule):
     """
     Wrap any generic HuggingFace PreTrainedModel as a Recordable Torch module
@@ -22,6 +62,8 @@ class PreTrainedModelRecordable(Generic[Pretrained_T], RecordableTorchModule):
 
     def __init__(self, model: Pretrained_T):
         super().__init__()
+        # non-dense attention (see local_attention) is configured in model config to be restored with the model
+        setup_attention(model)
         self.model = model
 
     def save(self, output_dir: Union[Path, str]) -> bool:
@@ -47,10 +89,43 @@ class PreTrainedModelRecordable(Generic[Pretrained_T], RecordableTorchModule):
 
         return cls(model)
 
+    def gradient_checkpointing(self, enabled: bool = True, granularity: str = "layer", every: int = 1) -> int:
+        """
+        Patch forward of one encoder layer (or self-attention block) out of every to recompute its activations in
+        backward pass instead of storing them (less memory for more compute). Returns number of patched modules.
+        """
+        modules = transformer_layers(self.model, granularity)
+        # always reset all granularities before patching
+        for module in transformer_layers(self.model, "layer") + transformer_layers(self.model, "attention"):
+            module.__dict__.pop("forward", None)
+        if not enabled:
+            return 0
+        patched = modules[::every]
+        for module in patched:
+            module.forward = functools.partial(_checkpointed_forward, module)
+        return len(patched)
+
     def forward(self, *args, **kwargs):
+        # token ids are kept in compact dtypes until here as embedding lookup requires long indices
+        if len(args) > 0:
+            args = (args[0].long(),) + tuple(args[1:])
+        elif kwargs.get("input_ids") is not None:
+            kwargs["input_ids"] = kwargs["input_ids"].long()
         return self.model.forward(*args, **kwargs)
 
 
+def enable_gradient_checkpointing(
+    model: nn.Module, enabled: bool = True, granularity: str = "layer", every: int = 1
+) -> None:
+    """(De)activate gradient checkpointing of all HuggingFace encoders of a model"""
+    nb = 0
+    for module in model.modules():
+        if isinstance(module, PreTrainedModelRecordable):
+            nb += module.gradient_checkpointing(enabled, granularity, every)
+    if enabled:
+        logger.info(f"Gradient checkpointing of {nb} {granularity} modules (1 out of {every})")
+
+
 # BertModelRecordable = PreTrainedModelRecordable[BertModel]
 
 
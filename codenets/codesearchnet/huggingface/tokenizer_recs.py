@@ -9,7 +9,7 @@ from tokenizers import BPETokenizer
 from codenets.recordable import Recordable, instance_full_classname, full_classname, RecordableMapping
 from codenets.codesearchnet.data import DatasetParams
 from codenets.codesearchnet.copied_code.metadata import Metadata, append_metadata, build_tokenizer_metadata
-from codenets.codesearchnet.tokenizer_recs import TokenizerRecordable
+from codenets.codesearchnet.tokenizer_recs import TokenizerRecordable, MASK_DTYPE, ids_dtype
 from codenets.codesearchnet.copied_code.utils import read_file_samples
 from codenets.utils import get_data_files_from_directory
 from codenets.codesearchnet.training_ctx import default_sample_update
@@ -39,8 +39,8 @@ class PreTrainedTokenizerRecordable(TokenizerRecordable):
             return_token_type_ids=False,
             return_attention_mask=True,
         )
-        token_ids = np.array(encoded["input_ids"])
-        token_mask = np.array(encoded["attention_mask"])
+        token_ids = np.array(encoded["input_ids"], dtype=self.ids_dtype())
+        token_mask = np.array(encoded["attention_mask"], dtype=MASK_DTYPE)
         return token_ids, token_mask
 
     def encode_sentences(
@@ -53,8 +53,8 @@ class PreTrainedTokenizerRecordable(TokenizerRecordable):
             return_token_type_ids=False,
             return_attention_mask=True,
         )
-        token_ids = np.array(encoded["input_ids"])
-        token_mask = np.array(encoded["attention_mask"])
+        token_ids = np.array(encoded["input_ids"], dtype=self.ids_dtype())
+        token_mask = np.array(encoded["attention_mask"], dtype=MASK_DTYPE)
         return (token_ids, token_mask)
 
     def encode_tokens(
@@ -67,8 +67,8 @@ class PreTrainedTokenizerRecordable(TokenizerRecordable):
             return_token_type_ids=False,
             return_attention_mask=True,
         )
-        token_ids = np.array(encoded["input_ids"])
-        token_mask = np.array(encoded["attention_mask"])
+        token_ids = np.array(encoded["input_ids"], dtype=self.ids_dtype())
+        token_mask = np.array(encoded["attention_mask"], dtype=MASK_DTYPE)
         return (token_ids, token_mask)
 
     def decode_sequence(self, tokens_sequence: List[int]) -> str:
@@ -81,6 +81,9 @@ class PreTrainedTokenizerRecordable(TokenizerRecordable):
         self.vocab.add_special_tokens(special_tokens)
         return True
 
+    def ids_dtype(self) -> np.dtype:
+        return ids_dtype(len(self.vocab))
+
 
 class BertTokenizerRecordable(PreTrainedTokenizerRecordable):
     def __init__(self, vocab: BertTokenizer):
@@ -124,7 +127,7 @@ class HuggingfaceBPETokenizerRecordable(TokenizerRecordable):
         if max_length is not None:
             enc.truncate(max_length)
             enc.pad(max_length)
-        return np.array(enc.ids), np.array(enc.attention_mask)
+        return np.array(enc.ids, dtype=self.ids_dtype()), np.array(enc.attention_mask, dtype=MASK_DTYPE)
 
     def encode_sentences(
         self, sentences: List[str], max_length: Optional[int] = None
@@ -134,8 +137,9 @@ class HuggingfaceBPETokenizerRecordable(TokenizerRecordable):
             for enc in encs:
                 enc.truncate(max_length)
                 enc.pad(max_length)
-        tokens_ids = [np.array(enc.ids) for enc in encs]
-        attention_mask = [np.array(enc.attention_mask) for enc in encs]
+        dtype = self.ids_dtype()
+        tokens_ids = [np.array(enc.ids, dtype=dtype) for enc in encs]
+        attention_mask = [np.array(enc.attention_mask, dtype=MASK_DTYPE) for enc in encs]
         return (tokens_ids, attention_mask)
 
     def encode_tokens(
@@ -177,6 +181,9 @@ class HuggingfaceBPETokenizerRecordable(TokenizerRecordable):
         self.vocab.add_special_tokens(special_tokens)
         return True
 
+    def ids_dtype(self) -> np.dtype:
+        return ids_dtype(self.vocab.get_vocab_size())
+
 
 def build_huggingface_token_files(
     data_dirs: List[Path],
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    live_index.py [options] REPO_DIR OUTPUT_DIR
+
+Keep the index of a local source repository (built by repo_index.py in OUTPUT_DIR) up-to-date while it is edited
+and answer queries read from stdin (one per line).
+
+File events are debounced, only functions of changed files are re-extracted & re-encoded. They are appended
+to the per-language indexes and functions of changed/deleted files are tombstoned. Indexes are periodically
+compacted (rebuilt & saved in OUTPUT_DIR) in background.
+
+Options:
+    -h --help                        Show this screen.
+    --restore DIR                    specify restoration dir.
+    --debounce SEC                   Seconds without event on a file before updating it. [default: 2.0]
+    --compaction_interval SEC        Seconds between compaction checks. [default: 60]
+    --compaction_threshold N         Number of appended/deleted functions triggering a compaction. [default: 1000]
+    --max_file_size N                Skip bigger files (generated, minified...) in bytes. [default: 1000000]
+    --batch_length N                 Number of definitions encoded per batch. [default: 512]
+    --nb_trees N                     Number of trees of AnnoyIndex. [default: 10]
+    --topk N                         Number of results per query. [default: 10]
+    --debug                          Enable debug routines. [default: False]
+"""
+
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+from annoy import AnnoyIndex
+from docopt import docopt
+from dpu_utils.utils import run_and_debug
+from loguru import logger
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
+
+from codenets.codesearchnet.code_ast.ast_utils import TreeSitterParser
+from codenets.codesearchnet.dataset_utils import compact_as_tensor
+from codenets.codesearchnet.repo_index import (
+    EXTENSION_LANGUAGES,
+    SKIPPED_DIRS,
+    definitions_dataframes,
+    encode_definitions,
+    extract_files_definitions,
+)
+from codenets.codesearchnet.training_ctx import CodeSearchTrainingContext
+
+
+class LangLiveIndex:
+    """
+    Code embeddings index of one language supporting appends & deletions between compactions.
+
+    Rows have stable ids. The AnnoyIndex (immutable once built) covers the rows alive at last compaction,
+    rows appended since are searched by brute force and deleted indexed rows are tombstones filtered from results.
+    Compaction builds the new AnnoyIndex out of the lock so queries are never blocked by it.
+    """
+
+    def __init__(self, nb_trees: int = 10):
+        self.nb_trees = nb_trees
+        self.lock = threading.RLock()
+        self.dim: Optional[int] = None
+        self.next_row = 0
+        # row -> (identifier, url, function_tokens)
+        self.definitions: Dict[int, Tuple[str, str, List[str]]] = {}
+        # row -> normalized embedding
+        self.embeddings: Dict[int, np.ndarray] = {}
+        self.file_rows: Dict[str, Set[int]] = {}
+
+        self.index: Optional[AnnoyIndex] = None
+        self.indexed_rows: List[int] = []
+        self.indexed_upto = 0
+        self.tombstones: Set[int] = set()
+        self.appended_rows: Set[int] = set()
+
+    @classmethod
+    def load(cls, output_dir: Path, language: str, nb_trees: int = 10) -> "LangLiveIndex":
+        """Load definitions, embeddings & index saved by repo_index.py (or a compaction)"""
+        lang_index = cls(nb_trees)
+        definitions_df = pd.read_pickle(output_dir / f"{language}_definitions.pkl")
+        embeddings = np.load(str(output_dir / f"{language}_code_embeddings.npy"))
+        lang_index.append(definitions_df, embeddings)
+
+        index_file = output_dir / f"{language}_index.ann"
+        if index_file.exists() and len(definitions_df) > 0:
+            index = AnnoyIndex(embeddings.shape[1], "angular")
+            index.load(str(index_file))
+            lang_index.swap_index(index, list(range(len(definitions_df))), len(definitions_df))
+        else:
+            lang_index.compact()
+        return lang_index
+
+    @staticmethod
+    def url_path(url: str) -> str:
+        return url.rsplit("#L", 1)[0]
+
+    def append(self, definitions_df: pd.DataFrame, embeddings: np.ndarray) -> None:
+        with self.lock:
+            columns = definitions_df[["identifier", "url", "function_tokens"]].itertuples(index=False)
+            for (identifier, url, tokens), emb in zip(columns, embeddings):
+                if self.dim is None:
+                    self.dim = emb.shape[0]
+                row = self.next_row
+                self.next_row += 1
+                self.definitions[row] = (identifier, url, tokens)
+                self.embeddings[row] = emb / max(float(np.linalg.norm(emb)), 1e-12)
+                self.file_rows.setdefault(self.url_path(url), set()).add(row)
+                self.appended_rows.add(row)
+
+    def delete_file(self, path: str) -> int:
+        """Delete functions of file (relative path in repository), returns number of deleted functions"""
+        with self.lock:
+            rows = self.file_rows.pop(path, set())
+            for row in rows:
+                del self.definitions[row]
+                del self.embeddings[row]
+                if row in self.appended_rows:
+                    self.appended_rows.remove(row)
+                else:
+                    self.tombstones.add(row)
+            return len(rows)
+
+    def nb_updates(self) -> int:
+        with self.lock:
+            return len(self.tombstones) + len(self.appended_rows)
+
+    def swap_index(self, index: Optional[AnnoyIndex], rows: List[int], upto: int) -> None:
+        """Replace index covering rows (all rows < upto alive when it was built)"""
+        with self.lock:
+            self.index = index
+            self.indexed_rows = rows
+            self.indexed_upto = upto
+            # rows deleted while index was built are still in it
+            self.tombstones = set(row for row in rows if row not in self.definitions)
+            self.appended_rows = set(row for row in self.appended_rows if row >= upto)
+
+    def compact(self, output_dir: Optional[Path] = None, language: Optional[str] = None) -> None:
+        """Rebuild index with alive rows (and save it with its definitions & embeddings if output_dir)"""
+        with self.lock:
+            rows = sorted(self.definitions.keys())
+            definitions = [self.definitions[row] for row in rows]
+            vectors = [self.embeddings[row] for row in rows]
+            upto = self.next_row
+
+        start = time.time()
+        index: Optional[AnnoyIndex] = None
+        if len(rows) > 0 and self.dim is not None:
+            index = AnnoyIndex(self.dim, "angular")
+            for i, vector in enumerate(vectors):
+                index.add_item(i, vector)
+            index.build(self.nb_trees)
+
+        if output_dir is not None and language is not None and index is not None:
+            definitions_df = pd.DataFrame(definitions, columns=["identifier", "url", "function_tokens"])
+            definitions_df.to_pickle(output_dir / f"{language}_definitions.pkl")
+            np.save(str(output_dir / f"{language}_code_embeddings.npy"), np.stack(vectors))
+            index.save(str(output_dir / f"{language}_index.ann"))
+
+        self.swap_index(index, rows, upto)
+        logger.info(f"Compacted {language or ''} index of {len(rows)} functions in {time.time() - start:.2f} sec")
+
+    def query(self, query_embedding: np.ndarray, topk: int) -> List[Tuple[str, str, float]]:
+        """Top-k (identifier, url, angular distance) closest functions"""
+        with self.lock:
+            results: Dict[int, float] = {}
+            if self.index is not None:
+                idxs, distances = self.index.get_nns_by_vector(
+                    query_embedding, topk + len(self.tombstones), include_distances=True
+                )
+                for i, distance in zip(idxs, distances):
+                    row = self.indexed_rows[i]
+                    if row not in self.tombstones:
+                        results[row] = distance
+
+            if len(self.appended_rows) > 0:
+                appended_rows = list(self.appended_rows)
+                q = query_embedding / max(float(np.linalg.norm(query_embedding)), 1e-12)
+                cos = np.stack([self.embeddings[row] for row in appended_rows]) @ q
+                # same distance as annoy angular
+                distances = np.sqrt(np.clip(2.0 - 2.0 * cos, 0.0, None))
+                for row, distance in zip(appended_rows, distances):
+                    results[row] = float(distance)
+
+            best = sorted(results.items(), key=lambda r: r[1])[:topk]
+            return [(self.definitions[row][0], self.definitions[row][1], distance) for row, distance in best]
+
+
+class LiveIndex(FileSystemEventHandler):
+    """Watch a repository and keep its per-language LangLiveIndex up-to-date"""
+
+    def __init__(
+        self,
+        training_ctx: CodeSearchTrainingContext,
+        repo_dir: Path,
+        output_dir: Path,
+        debounce: float = 2.0,
+        compaction_interval: float = 60.0,
+        compaction_threshold: int = 1000,
+        max_file_size: int = 1000000,
+        batch_length: int = 512,
+        nb_trees: int = 10,
+    ):
+        super(LiveIndex, self).__init__()
+        self.training_ctx = training_ctx
+        self.repo_dir = repo_dir.resolve()
+        self.output_dir = output_dir
+        self.debounce = debounce
+        self.compaction_interval = compaction_interval
+        self.compaction_threshold = compaction_threshold
+        self.max_file_size = max_file_size
+        self.batch_length = batch_length
+        self.nb_trees = nb_trees
+
+        self.languages = list(training_ctx.train_data_params.lang_ids.keys())
+        self.lang_indexes: Dict[str, LangLiveIndex] = {}
+        for language in self.languages:
+            if (output_dir / f"{language}_definitions.pkl").exists():
+                self.lang_indexes[language] = LangLiveIndex.load(output_dir, language, nb_trees)
+        self.parser = TreeSitterParser(langs=self.languages, added_nodes={}, skip_node_types={})
+
+        # model is used by updates & queries threads
+        self.model_lock = threading.Lock()
+        self.pending: Dict[str, float] = {}
+        self.pending_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.observer = Observer()
+        self.threads: List[threading.Thread] = []
+
+    def language_of(self, path: str) -> Optional[str]:
+        lang = EXTENSION_LANGUAGES.get(os.path.splitext(path)[1])
+        if lang is None or lang not in self.languages:
+            return None
+        parts = Path(os.path.relpath(path, self.repo_dir)).parts[:-1]
+        if any(part.startswith(".") or part in SKIPPED_DIRS for part in parts):
+            return None
+        return lang
+
+    def on_any_event(self, event: FileSystemEvent) -> None:
+        if event.is_directory:
+            return
+        paths = [event.src_path]
+        if hasattr(event, "dest_path"):
+            paths.append(event.dest_path)
+        now = time.time()
+        with self.pending_lock:
+            for path in paths:
+                if self.language_of(path) is not None:
+                    self.pending[path] = now
+
+    def pop_settled_files(self) -> List[str]:
+        """Files without event for debounce seconds"""
+        now = time.time()
+        with self.pending_lock:
+            settled = [path for path, t in self.pending.items() if now - t >= self.debounce]
+            for path in settled:
+                del self.pending[path]
+        return settled
+
+    def get_lang_index(self, language: str) -> LangLiveIndex:
+        if language not in self.lang_indexes:
+            self.lang_indexes[language] = LangLiveIndex(self.nb_trees)
+        return self.lang_indexes[language]
+
+    def update_files(self, paths: List[str]) -> None:
+        start = time.time()
+        file_langs: Dict[str, str] = {}
+        for path in paths:
+            language = self.language_of(path)
+            if language is None:
+                continue
+            deleted = self.get_lang_index(language).delete_file(os.path.relpath(path, self.repo_dir))
+            logger.debug(f"Tombstoned {deleted} functions of {path}")
+            if os.path.isfile(path) and os.path.getsize(path) <= self.max_file_size:
+                file_langs[path] = language
+
+        definitions = extract_files_definitions([(Path(path), lang) for path, lang in file_langs.items()], self.parser)
+        nb = 0
+        for language, definitions_df in definitions_dataframes(definitions, file_langs, self.repo_dir).items():
+            with self.model_lock, torch.no_grad():
+                embeddings = encode_definitions(
+                    self.training_ctx, language, definitions_df, batch_length=self.batch_length
+                )
+            self.get_lang_index(language).append(definitions_df, embeddings)
+            nb += len(definitions_df)
+        logger.info(f"Updated {len(paths)} files ({nb} functions) in {time.time() - start:.2f} sec")
+
+    def _updates_loop(self) -> None:
+        while not self.stop_event.wait(self.debounce / 2):
+            paths = self.pop_settled_files()
+            if len(paths) > 0:
+                try:
+                    self.update_files(paths)
+                except Exception as e:
+                    logger.error(f"Failed updating {paths}: {e}")
+
+    def _compaction_loop(self) -> None:
+        while not self.stop_event.wait(self.compaction_interval):
+            for language, lang_index in list(self.lang_indexes.items()):
+                if lang_index.nb_updates() >= self.compaction_threshold:
+                    lang_index.compact(self.output_dir, language)
+
+    def start(self) -> None:
+        self.training_ctx.eval_mode()
+        self.observer.schedule(self, str(self.repo_dir), recursive=True)
+        self.observer.start()
+        self.threads = [
+            threading.Thread(target=self._updates_loop, daemon=True),
+            threading.Thread(target=self._compaction_loop, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+        logger.info(f"Watching {self.repo_dir}")
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.observer.stop()
+        self.observer.join()
+        for thread in self.threads:
+            thread.join()
+        # save pending updates
+        for language, lang_index in self.lang_indexes.items():
+            if lang_index.nb_updates() > 0:
+                lang_index.compact(self.output_dir, language)
+
+    def query(self, query: str, topk: int = 10) -> List[Tuple[str, str, str, float]]:
+        """Top-k (language, identifier, url, distance) functions of all languages for query"""
+        queries_tokens, queries_masks = self.training_ctx.tokenize_query_sentences(
+            [f"<qy> {query}"], max_length=self.training_ctx.conf["dataset.common_params.query_max_num_tokens"]
+        )
+        with self.model_lock, torch.no_grad():
+            query_embedding = (
+                self.training_ctx.encode_query(
+                    query_tokens=compact_as_tensor(queries_tokens).to(self.training_ctx.device),
+                    query_tokens_mask=compact_as_tensor(queries_masks).to(self.training_ctx.device),
+                )
+                .cpu()
+                .numpy()[0]
+            )
+        results: List[Tuple[str, str, str, float]] = []
+        for language, lang_index in list(self.lang_indexes.items()):
+            for identifier, url, distance in lang_index.query(query_embedding, topk):
+                results.append((language, identifier, url, distance))
+        return sorted(results, key=lambda r: r[3])[:topk]
+
+
+def run(args, tag_in_vcs=False) -> None:
+    os.environ["WANDB_MODE"] = "dryrun"
+
+    restore_dir = args["--restore"]
+    logger.info(f"Restoring Training Context from directory {restore_dir}")
+    training_ctx = CodeSearchTrainingContext.build_context_from_dir(restore_dir)
+
+    live_index = LiveIndex(
+        training_ctx,
+        repo_dir=Path(args["REPO_DIR"]),
+        output_dir=Path(args["OUTPUT_DIR"]),
+        debounce=float(args["--debounce"]),
+        compaction_interval=float(args["--compaction_interval"]),
+        compaction_threshold=int(args["--compaction_threshold"]),
+        max_file_size=int(args["--max_file_size"]),
+        batch_length=int(args["--batch_length"]),
+        nb_trees=int(args["--nb_trees"]),
+    )
+    live_index.start()
+    topk = int(args["--topk"])
+    try:
+        for line in sys.stdin:
+            query = line.strip()
+            if len(query) == 0:
+                continue
+            start = time.time()
+            results = live_index.query(query, topk)
+            for (language, identifier, url, distance) in results:
+                print(f"{distance:.4f}\t{language}\t{identifier}\t{url}")
+            logger.info(f"Query answered in {(time.time() - start) * 1000:.1f} ms")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        live_index.stop()
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    run_and_debug(lambda: run(args), args["--debug"])
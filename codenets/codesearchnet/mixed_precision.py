@@ -0,0 +1,130 @@
+import contextlib
+from typing import Any, ContextManager, Dict, Optional
+
+import torch
+from loguru import logger
+from pyhocon import ConfigTree
+from torch import Tensor
+from torch.optim import Optimizer
+
+
+def autocast_available(device: torch.device) -> bool:
+    """Autocast appeared with torch 1.6 for cuda and torch 1.10 for CPU (bfloat16 only)"""
+    if device.type == "cuda":
+        return hasattr(torch.cuda, "amp") and hasattr(torch.cuda.amp, "autocast")
+    return hasattr(torch, "autocast")
+
+
+def cpu_supports_bf16() -> bool:
+    """True if CPU has native bfloat16 instructions (avx512_bf16, amx...) used by mkldnn"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def cuda_supports_bf16() -> bool:
+    """True if torch autocast accepts a dtype (torch >= 1.10) and GPU supports bfloat16 (Ampere+)"""
+    return hasattr(torch, "autocast") and hasattr(torch.cuda, "is_bf16_supported") and torch.cuda.is_bf16_supported()
+
+
+class MixedPrecision:
+    """
+    Opt-in autocast of forward passes configured by `training.mixed_precision`:
+    - float16 with a gradient scaler on GPU,
+    - bfloat16 on CPUs or GPUs supporting it (no scaler needed as bfloat16 has float32 range).
+
+    When it is not enabled or not supported by torch version/device, everything runs in float32.
+    Losses are always computed in float32 from autocast embeddings (see `float_embeddings`).
+    """
+
+    def __init__(self, device: torch.device, enabled: bool = False, dtype: str = "auto"):
+        self.device = device
+        self.dtype: Optional[torch.dtype] = None
+        self.scaler: Optional[Any] = None
+
+        if not enabled:
+            return
+        if not autocast_available(device):
+            logger.warning(f"Mixed precision isn't supported by torch {torch.__version__} on {device}, using float32")
+            return
+
+        if dtype == "auto":
+            dtype = "float16" if device.type == "cuda" else "bfloat16"
+        if dtype == "bfloat16" and device.type == "cpu" and not cpu_supports_bf16():
+            logger.warning("CPU doesn't support bfloat16, using float32")
+            return
+        if dtype == "float16" and device.type != "cuda":
+            logger.warning("float16 mixed precision is only supported on GPU, using float32")
+            return
+        if dtype == "bfloat16" and device.type == "cuda" and not cuda_supports_bf16():
+            # torch.cuda.amp.autocast of older torch versions always runs in float16
+            logger.warning(f"bfloat16 autocast isn't supported by torch {torch.__version__} on {device}, using float32")
+            return
+
+        self.dtype = getattr(torch, dtype)
+        if self.dtype == torch.float16:
+            # float16 gradients underflow without loss scaling
+            self.scaler = torch.cuda.amp.GradScaler()
+        logger.info(f"Activating {dtype} mixed precision on {device}")
+
+    @classmethod
+    def from_conf(cls, conf: ConfigTree, device: torch.device) -> "MixedPrecision":
+        if "training.mixed_precision" not in conf:
+            return cls(device)
+        return cls(
+            device,
+            enabled=conf.get_bool("training.mixed_precision.enabled", False),
+            dtype=conf.get_string("training.mixed_precision.dtype", "auto"),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.dtype is not None
+
+    def autocast(self) -> ContextManager:
+        """Context in which forward passes run in mixed precision"""
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        if self.device.type == "cuda" and self.dtype == torch.float16:
+            return torch.cuda.amp.autocast()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def float_embeddings(self, *embeddings: Tensor) -> Any:
+        """Cast back autocast embeddings to float32 before losses (softmax, sort, log2, pow...)"""
+        if self.dtype is None:
+            return embeddings
+        return tuple(e.float() for e in embeddings)
+
+    def backward(self, loss: Tensor) -> None:
+        """Backward pass from loss (scaled in float16)"""
+        if self.scaler is None:
+            loss.backward()
+        else:
+            self.scaler.scale(loss).backward()
+
+    def step(self, optimizer: Optimizer) -> None:
+        """Optimizer step from (scaled in float16) gradients"""
+        if self.scaler is None:
+            optimizer.step()
+        else:
+            # skips step if gradients contain inf/nan and adapts scale
+            self.scaler.step(optimizer)
+            self.scaler.update()
+
+    def backward_optimize(self, loss: Tensor, optimizer: Optimizer) -> Tensor:
+        """Backward pass from loss & optimizer step (with loss scaling in float16)"""
+        self.backward(loss)
+        self.step(optimizer)
+        return loss
+
+    def state_dict(self) -> Optional[Dict[str, Any]]:
+        return self.scaler.state_dict() if self.scaler is not None else None
+
+    def load_state_dict(self, state_dict: Optional[Dict[str, Any]]) -> None:
+        if state_dict is None:
+            return
+        if self.scaler is None:
+            logger.warning("Ignoring recorded gradient scaler state as float16 mixed precision isn't activated")
+            return
+        self.scaler.load_state_dict(state_dict)
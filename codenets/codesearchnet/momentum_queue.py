@@ -0,0 +1,127 @@
+import copy
+from typing import Dict, Optional
+
+import torch
+from loguru import logger
+from pyhocon import ConfigTree
+from torch import Tensor, nn
+
+# submodules only encoding queries, not needed by the momentum model which only encodes codes
+QUERY_MODULES = ["query_encoder"]
+
+
+def code_model_copy(model: nn.Module) -> nn.Module:
+    """
+    Deep copy of model without its query-only submodules (set to None in the copy), so that momentum model only
+    holds code encoder(s) & pooler (a siamese model shares its encoder between queries & codes and is fully copied).
+    """
+    # deepcopy memo maps already copied objects to their copy: query modules are "copied" as None
+    memo = {id(module): None for name, module in model.named_children() if name in QUERY_MODULES}
+    return copy.deepcopy(model, memo)
+
+
+class MomentumQueue(object):
+    """
+    MoCo-style cross-batch negatives: a momentum (EMA) copy of the code side of the model (code encoder(s) & pooler)
+    encodes codes of each training batch and the last `size` code embeddings are kept in a FIFO queue to be used as
+    extra negatives of the next batches.
+
+    With per_language, there is one queue per language (batches must then contain one language, mixed batches raise).
+
+    The momentum model isn't recorded: when training is resumed, it restarts from the restored model & empty queues.
+    """
+
+    def __init__(self, model: nn.Module, size: int = 4096, momentum: float = 0.999, per_language: bool = False):
+        self.size = size
+        self.momentum = momentum
+        self.per_language = per_language
+        self.model = code_model_copy(model)
+        # keys are encoded without dropout to be consistent from batch to batch
+        self.model.eval()
+        for param in self.model.parameters():
+            param.requires_grad = False
+        self.queues: Dict[str, Tensor] = {}
+        self.ptrs: Dict[str, int] = {}
+        self.nb_filled: Dict[str, int] = {}
+
+    @classmethod
+    def from_conf(cls, conf: ConfigTree, model: nn.Module) -> Optional["MomentumQueue"]:
+        if "training.momentum_queue" not in conf:
+            return None
+        logger.info("Activating momentum queue of negative codes")
+        return cls(
+            model,
+            size=conf.get_int("training.momentum_queue.size", 4096),
+            momentum=conf.get_float("training.momentum_queue.momentum", 0.999),
+            per_language=conf.get_bool("training.momentum_queue.per_language", False),
+        )
+
+    @torch.no_grad()
+    def update_model(self, model: nn.Module) -> None:
+        """EMA update of momentum model from matching parameters of trained model (after each optimizer step)"""
+        params = dict(model.named_parameters())
+        for name, momentum_param in self.model.named_parameters():
+            momentum_param.mul_(self.momentum).add_(params[name].detach(), alpha=1.0 - self.momentum)
+
+    def negatives(self, key: str) -> Optional[Tensor]:
+        """Queued code embeddings [K x D] (None if queue is still empty)"""
+        if self.nb_filled.get(key, 0) == 0:
+            return None
+        return self.queues[key][: self.nb_filled[key]].clone()
+
+    def enqueue(self, key: str, embeddings: Tensor) -> None:
+        embeddings = embeddings[-self.size :]
+        if key not in self.queues:
+            self.queues[key] = torch.zeros(
+                (self.size, embeddings.shape[1]), dtype=embeddings.dtype, device=embeddings.device
+            )
+            self.ptrs[key] = 0
+            self.nb_filled[key] = 0
+        queue = self.queues[key]
+        ptr = self.ptrs[key]
+        nb = embeddings.shape[0]
+        end = min(ptr + nb, self.size)
+        queue[ptr:end] = embeddings[: end - ptr]
+        # wrap around
+        queue[: nb - (end - ptr)] = embeddings[end - ptr :]
+        self.ptrs[key] = (ptr + nb) % self.size
+        self.nb_filled[key] = min(self.nb_filled[key] + nb, self.size)
+
+    @torch.no_grad()
+    def encode_codes(self, languages: Tensor, code_tokens: Tensor, code_tokens_mask: Tensor) -> Tensor:
+        """Momentum embeddings of codes"""
+        if hasattr(self.model, "encode_codes"):
+            # multi-branch model dispatching codes of mixed-language batches to their encoders
+            return self.model.encode_codes(languages, code_tokens, code_tokens_mask)
+        return self.model.encode_code(int(languages[0].item()), code_tokens, code_tokens_mask)
+
+    @torch.no_grad()
+    def negatives_and_enqueue(
+        self, languages: Tensor, code_tokens: Tensor, code_tokens_mask: Tensor, chunk_size: int = 0
+    ) -> Optional[Tensor]:
+        """
+        Return negatives queued by previous batches then enqueue momentum embeddings of codes of current batch
+        (which are already in-batch negatives).
+        With chunk_size > 0 (gradient cache), codes are encoded by chunks to keep peak memory of a chunk.
+        """
+        key = "all"
+        if self.per_language:
+            lang_ids = languages.view(-1).unique().tolist()
+            if len(lang_ids) > 1:
+                # negatives are shared by all queries of the batch so they can't come from several queues
+                raise ValueError(f"Momentum queue per language can't be used with batches mixing languages {lang_ids}")
+            key = str(lang_ids[0])
+        negatives = self.negatives(key)
+        if chunk_size > 0:
+            code_embeddings = torch.cat(
+                [
+                    self.encode_codes(*chunk)
+                    for chunk in zip(
+                        languages.split(chunk_size), code_tokens.split(chunk_size), code_tokens_mask.split(chunk_size)
+                    )
+                ]
+            )
+        else:
+            code_embeddings = self.encode_codes(languages, code_tokens, code_tokens_mask)
+        self.enqueue(key, code_embeddings.float())
+        return negatives
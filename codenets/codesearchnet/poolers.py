@@ -29,6 +29,7 @@ class MeanPooler(EmbeddingPooler):
 
     def forward(self, seq_outputs: torch.Tensor, tokens_mask: torch.Tensor) -> torch.Tensor:  # type: ignore
         # TO TEST
+        tokens_mask = tokens_mask.to(seq_outputs.dtype)
         lg = torch.sum(tokens_mask, dim=-1)
         mask = tokens_mask.unsqueeze(dim=-1)
         seq_outputs_masked = seq_outputs * mask
@@ -46,7 +47,7 @@ class MeanWeightedPooler(EmbeddingPooler):
 
     def forward(self, seq_outputs: torch.Tensor, tokens_mask: torch.Tensor) -> torch.Tensor:  # type: ignore
         token_weights = self.activation(self.dense(seq_outputs))  # B x T x 1
-        token_weights = token_weights * tokens_mask.unsqueeze(dim=-1)  # B x T x 1
+        token_weights = token_weights * tokens_mask.to(token_weights.dtype).unsqueeze(dim=-1)  # B x T x 1
         # sum on the T dimension
         seq_weighted_sum = torch.sum(seq_outputs * token_weights, dim=1)  # B x D
         output = seq_weighted_sum / torch.sum(token_weights, dim=1).clamp(min=self.eps)
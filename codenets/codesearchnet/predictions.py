@@ -19,13 +19,16 @@ Options:
     -h --help                        Show this screen.
     --restore DIR                    specify restoration dir.
     --wandb_run_id <entity_name>/<project_name>/<run_id> Specify Wandb Run
+    --quantize                       Encode with int8 dynamically quantized Linear layers (on CPU).
+    --query_student DIR              Encode queries with a distilled student (see query_student.py).
+    --projection DIR                 Reduce embeddings dimension with a projection (see projection.py).
     --debug                          Enable debug routines. [default: False]
 """
 
 import os
 import sys
 from pathlib import Path
-from typing import Tuple
+from typing import Iterable, List, Tuple
 import torch
 import numpy as np
 from docopt import docopt
@@ -38,16 +41,56 @@ import shutil
 from wandb.apis import InternalApi
 import wandb
 from codenets.codesearchnet.training_ctx import CodeSearchTrainingContext
+from codenets.codesearchnet.dataset_utils import compact_as_tensor
+from codenets.codesearchnet.projection import project_training_ctx
+from codenets.codesearchnet.quantization import quantize_training_ctx
+from codenets.codesearchnet.query_student import use_query_student
+from codenets.codesearchnet.query_code_siamese.dataset import batch_iter
+
+
+def encode_code_tokens(
+    training_ctx: CodeSearchTrainingContext, lang_id: int, function_tokens: Iterable[List[str]], batch_length: int = 1024
+) -> np.ndarray:
+    """Tokenize & encode batches of code tokens (already prefixed by language & lang token) into embeddings matrix"""
+    code_embeddings: List[np.ndarray] = []
+    for batch in tqdm(batch_iter(list(function_tokens), batch_size=batch_length)):
+        codes_encoded, codes_masks = training_ctx.tokenize_code_tokens(
+            batch, max_length=training_ctx.conf["dataset.common_params.code_max_num_tokens"]
+        )
+
+        codes_encoded_t = compact_as_tensor(codes_encoded).to(training_ctx.device)
+        codes_masks_t = compact_as_tensor(codes_masks).to(training_ctx.device)
+
+        code_embeddings.append(
+            training_ctx.encode_code(lang_id=lang_id, code_tokens=codes_encoded_t, code_tokens_mask=codes_masks_t)
+            .cpu()
+            .numpy()
+        )
+    return np.concatenate(code_embeddings)
+
+
+def build_code_index(code_embeddings: np.ndarray, nb_trees: int = 10) -> AnnoyIndex:
+    """Build angular AnnoyIndex of code embeddings"""
+    logger.info(f"Building Annoy Index of length {code_embeddings.shape[1]}")
+    indices: AnnoyIndex = AnnoyIndex(code_embeddings.shape[1], "angular")
+    for index, emb in enumerate(tqdm(code_embeddings)):
+        indices.add_item(index, emb)
+    indices.build(nb_trees)
+    return indices
 
 
 def compute_code_encodings_from_defs(
-    language: str, training_ctx: CodeSearchTrainingContext, lang_token: str, batch_length: int = 1024
+    language: str,
+    training_ctx: CodeSearchTrainingContext,
+    lang_token: str,
+    batch_length: int = 1024,
+    encodings_suffix: str = "",
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
     logger.info(f"Computing Encoding for language: {language}")
     lang_id = training_ctx.train_data_params.lang_ids[language]
     h5_file = (
         training_ctx.pickle_path
-        / f"{language}_{training_ctx.training_full_name}_dedupe_definitions_v2_codes_encoded.h5"
+        / f"{language}_{training_ctx.training_full_name}_dedupe_definitions_v2_codes_encoded{encodings_suffix}.h5"
     )
     root_data_path = Path(training_ctx.conf["dataset.root_dir"])
 
@@ -62,43 +105,19 @@ def compute_code_encodings_from_defs(
     if not os.path.exists(h5_file):
         logger.info(f"Building encodings of code from {def_file}")
 
-        # function_tokens = definitions_df["function_tokens"]
         # add language and lang_token (<lg>) to tokens
-        definitions_df["function_tokens"] = definitions_df["function_tokens"].apply(
-            lambda row: [language, lang_token] + row
-        )
-        function_tokens_batch = definitions_df["function_tokens"].groupby(
-            np.arange(len(definitions_df["function_tokens"])) // batch_length
-        )
-
-        code_embeddings = []
-        for g, df_batch in tqdm(function_tokens_batch):
-            # logger.debug(f"df_batch {df_batch.values}")
-            codes_encoded, codes_masks = training_ctx.tokenize_code_tokens(
-                df_batch.values, max_length=training_ctx.conf["dataset.common_params.code_max_num_tokens"]
-            )
-
-            codes_encoded_t = torch.tensor(codes_encoded, dtype=torch.long).to(training_ctx.device)
-            codes_masks_t = torch.tensor(codes_masks, dtype=torch.long).to(training_ctx.device)
-
-            # logger.debug(f"codes_encoded_t {codes_encoded_t}")
-            # logger.debug(f"codes_masks_t {codes_masks_t}")
-
-            emb_df = pd.DataFrame(
-                training_ctx.encode_code(lang_id=lang_id, code_tokens=codes_encoded_t, code_tokens_mask=codes_masks_t)
-                .cpu()
-                .numpy()
+        code_embeddings_df = pd.DataFrame(
+            encode_code_tokens(
+                training_ctx,
+                lang_id,
+                ([language, lang_token] + row for row in definitions_df["function_tokens"]),
+                batch_length=batch_length,
             )
-            # logger.debug(f"codes_encoded_t:{codes_encoded_t.shape} codes_masks_t:{codes_masks_t.shape}")
-            if g < 2:
-                logger.debug(f"emb_df {emb_df.head()}")
-            code_embeddings.append(emb_df)
+        )
 
         # free memory or it explodes on 32GB...
         del definitions_df["function_tokens"]
 
-        code_embeddings_df = pd.concat(code_embeddings)
-
         logger.debug(f"code_embeddings_df {code_embeddings_df.head(20)}")
 
         code_embeddings_df.to_hdf(h5_file, key="code_embeddings_df", mode="w")
@@ -132,6 +151,16 @@ def run(args, tag_in_vcs=False) -> None:
     restore_dir = args["--restore"]
     logger.info(f"Restoring Training Context from directory{restore_dir}")
     training_ctx = CodeSearchTrainingContext.build_context_from_dir(restore_dir)
+    # quantized or projected encodings are cached apart from full float32 ones
+    encodings_suffix = ""
+    if args["--quantize"]:
+        quantize_training_ctx(training_ctx)
+        encodings_suffix = "_qint8"
+    if args["--query_student"] is not None:
+        use_query_student(training_ctx, args["--query_student"])
+    if args["--projection"] is not None:
+        project_training_ctx(training_ctx, args["--projection"])
+        encodings_suffix += f"_d{training_ctx.model.projection.output_dim}"
 
     queries = pd.read_csv(training_ctx.queries_file)
     queries = list(map(lambda q: f"<qy> {q}", queries["query"].values))
@@ -144,8 +173,8 @@ def run(args, tag_in_vcs=False) -> None:
     with torch.no_grad():
         query_embeddings = (
             training_ctx.encode_query(
-                query_tokens=torch.tensor(queries_tokens, dtype=torch.long).to(training_ctx.device),
-                query_tokens_mask=torch.tensor(queries_masks, dtype=torch.long).to(training_ctx.device),
+                query_tokens=compact_as_tensor(queries_tokens).to(training_ctx.device),
+                query_tokens_mask=compact_as_tensor(queries_masks).to(training_ctx.device),
             )
             .cpu()
             .numpy()
@@ -162,14 +191,9 @@ def run(args, tag_in_vcs=False) -> None:
             # (codes_encoded_df, codes_masks_df, definitions) = get_language_defs(language, training_ctx, language_token)
 
             code_embeddings, definitions = compute_code_encodings_from_defs(
-                language, training_ctx, language_token, batch_length=512
+                language, training_ctx, language_token, batch_length=512, encodings_suffix=encodings_suffix
             )
-            logger.info(f"Building Annoy Index of length {len(code_embeddings.values[0])}")
-            indices: AnnoyIndex = AnnoyIndex(len(code_embeddings.values[0]), "angular")
-            # idx = 0
-            for index, emb in enumerate(tqdm(code_embeddings.values)):
-                indices.add_item(index, emb)
-            indices.build(10)
+            indices = build_code_index(code_embeddings.values, nb_trees=10)
 
             for i, (query, query_embedding) in enumerate(tqdm(zip(queries, query_embeddings))):
                 idxs, distances = indices.get_nns_by_vector(query_embedding, topk, include_distances=True)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    projection.py [options] OUTPUT_DIR
+
+Reduce the dimension of query & code embeddings of a trained model with a linear projection shared by both encoders
+so that code embeddings stores & Annoy indices are smaller and faster to search:
+- pca: PCA fitted on training query & code embeddings,
+- trained: PCA projection then fine-tuned with the training loss of the model (encoders are frozen).
+
+Embeddings of the model are computed once, the projection is saved into OUTPUT_DIR as an `EmbeddingProjection` that
+`ProjectedModelRecordable`/`project_training_ctx` apply to the outputs of encode_query/encode_code (see `eval.py` &
+`predictions.py` --projection option).
+
+Test MRR/NDCG, embeddings memory & Annoy search latency of full dimension vs projected embeddings are reported.
+
+Options:
+    -h --help                        Show this screen.
+    --restore DIR                    specify restoration dir.
+    --dim N                          Projected embeddings dimension. [default: 128]
+    --method NAME                    Projection method: pca or trained. [default: pca]
+    --epochs N                       Number of training epochs of trained projection. [default: 5]
+    --lr F                           Learning rate of trained projection. [default: 0.001]
+    --max_batches N                  Max number of training batches to fit projection (0 for all). [default: 0]
+    --nb_trees N                     Number of trees of benchmarked Annoy indices. [default: 10]
+    --debug                          Enable debug routines. [default: False]
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, MutableMapping, Optional, Tuple, Union
+
+import torch
+from annoy import AnnoyIndex
+from docopt import docopt
+from dpu_utils.utils import run_and_debug
+from loguru import logger
+from torch import Tensor, nn
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from transformers import AdamW
+
+from codenets.codesearchnet.batch_transfer import batch_to_device
+from codenets.codesearchnet.dataset_utils import DatasetType
+from codenets.codesearchnet.training_ctx import (
+    BatchLoss,
+    BatchSize,
+    CodeSearchTrainingContext,
+    TotalLoss,
+    TotalMrr,
+    TotalNdcg,
+    TotalSize,
+    compute_loss_mrr_ndcg,
+)
+from codenets.recordable import (
+    Recordable,
+    RecordableTorchModule,
+    runtime_load_recordable_mapping,
+    save_recordable_mapping,
+)
+from codenets.utils import full_classname, instance_full_classname
+
+METHODS = ["pca", "trained"]
+
+# (query embeddings, code embeddings, similarity, code language weights) of a batch, on CPU
+EmbeddedBatch = Tuple[Tensor, Tensor, Tensor, Tensor]
+
+
+def symmetric_eigen(matrix: Tensor) -> Tuple[Tensor, Tensor]:
+    """Eigenvalues (descending) & eigenvectors (columns) of a symmetric matrix"""
+    if hasattr(torch, "linalg") and hasattr(torch.linalg, "eigh"):
+        eigenvalues, eigenvectors = torch.linalg.eigh(matrix)
+    else:
+        eigenvalues, eigenvectors = torch.symeig(matrix, eigenvectors=True)
+    order = torch.argsort(eigenvalues, descending=True)
+    return eigenvalues[order], eigenvectors[:, order]
+
+
+class EmbeddingProjection(RecordableTorchModule):
+    """
+    Linear projection of query & code embeddings to a smaller dimension (shared by both to stay in the same space).
+    It is recorded as a whole (default RecordableTorchModule save).
+    """
+
+    def __init__(self, input_dim: int, output_dim: int):
+        super(EmbeddingProjection, self).__init__()
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        self.linear = nn.Linear(input_dim, output_dim)
+
+    @classmethod
+    def from_pca(cls, embeddings: Iterable[Tensor], output_dim: int) -> EmbeddingProjection:
+        """
+        Projection on the output_dim first principal components of embeddings given as chunks [n x D].
+        Only the D x D covariance matrix is accumulated (in float64) so all embeddings are never held together.
+        """
+        nb = 0
+        total: Optional[Tensor] = None
+        outer: Optional[Tensor] = None
+        for chunk in embeddings:
+            chunk = chunk.double()
+            if total is None or outer is None:
+                total = chunk.new_zeros(chunk.shape[1])
+                outer = chunk.new_zeros(chunk.shape[1], chunk.shape[1])
+            total += chunk.sum(dim=0)
+            outer += chunk.t() @ chunk
+            nb += chunk.shape[0]
+        if total is None or outer is None:
+            raise ValueError("Can't fit principal components without embeddings")
+        input_dim = total.shape[0]
+        if output_dim > min(nb, input_dim):
+            raise ValueError(f"Can't fit {output_dim} principal components on {nb} embeddings of size {input_dim}")
+        mean = total / nb
+        covariance = (outer - nb * mean.unsqueeze(1) @ mean.unsqueeze(0)) / max(1, nb - 1)
+        eigenvalues, eigenvectors = symmetric_eigen(covariance)
+        eigenvalues = eigenvalues.clamp(min=0.0)
+        components = eigenvectors[:, :output_dim].t()  # [d x D]
+        explained = eigenvalues[:output_dim].sum() / eigenvalues.sum()
+        logger.info(f"PCA {input_dim} -> {output_dim} explains {explained.item() * 100:.2f}% of embeddings variance")
+
+        projection = cls(input_dim, output_dim)
+        with torch.no_grad():
+            projection.linear.weight.copy_(components.float())
+            projection.linear.bias.copy_((-components @ mean).float())
+        return projection
+
+    def forward(self, embeddings: Tensor) -> Tensor:  # type: ignore
+        return self.linear(embeddings)
+
+
+class ProjectedModelRecordable(RecordableTorchModule):
+    """Drop-in code search model projecting query & code embeddings of a model with an EmbeddingProjection"""
+
+    def __init__(self, model: RecordableTorchModule, projection: EmbeddingProjection):
+        super(ProjectedModelRecordable, self).__init__()
+        self.model = model
+        self.projection = projection
+
+    def save(self, output_dir: Union[Path, str]) -> bool:
+        d = Path(output_dir) / instance_full_classname(self)
+        records: MutableMapping[str, Recordable] = {"model": self.model, "projection": self.projection}
+        return save_recordable_mapping(output_dir=d, records=records)
+
+    @classmethod
+    def load(cls, restore_dir: Union[Path, str]) -> ProjectedModelRecordable:
+        d = Path(restore_dir) / full_classname(cls)
+        records = runtime_load_recordable_mapping(d)
+        return cls(**records)
+
+    def forward(self, *args, **kwargs) -> Tuple[Tensor, Tensor]:  # type: ignore
+        query_embeddings, code_embeddings = self.model(*args, **kwargs)
+        return self.projection(query_embeddings), self.projection(code_embeddings)
+
+    def encode_query(self, query_tokens: Tensor, query_tokens_mask: Tensor) -> Tensor:
+        return self.projection(self.model.encode_query(query_tokens, query_tokens_mask))
+
+    def encode_code(self, lang_id: int, code_tokens: Tensor, code_tokens_mask: Tensor) -> Tensor:
+        return self.projection(self.model.encode_code(lang_id, code_tokens, code_tokens_mask))
+
+
+def project_training_ctx(
+    training_ctx: CodeSearchTrainingContext, projection_dir: Union[Path, str]
+) -> CodeSearchTrainingContext:
+    """
+    Project query & code embeddings of training context model with an EmbeddingProjection saved in projection_dir
+    Please note that IT MUTATES training_ctx
+    """
+    projection = EmbeddingProjection.load(projection_dir).to(training_ctx.device)
+    training_ctx.model = ProjectedModelRecordable(training_ctx.model, projection)
+    logger.info(f"Projecting embeddings to dimension {projection.output_dim} with projection from {projection_dir}")
+    return training_ctx
+
+
+def encode_batch(model: nn.Module, batch: List[Tensor]) -> Tuple[Tensor, Tensor]:
+    """(query, code) embeddings of a training batch (with or without leading sample indices)"""
+    languages, _, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, _ = batch[-7:]
+    if hasattr(model, "encode_codes"):
+        code_embeddings = model.encode_codes(languages, code_tokens, code_tokens_mask)
+    else:
+        code_embeddings = model.encode_code(int(languages[0].item()), code_tokens, code_tokens_mask)
+    return model.encode_query(query_tokens, query_tokens_mask), code_embeddings
+
+
+@torch.no_grad()
+def compute_embeddings(
+    training_ctx: CodeSearchTrainingContext, dataloader: DataLoader, max_batches: int = 0
+) -> List[EmbeddedBatch]:
+    """Embeddings, similarity & language weights of dataloader batches (token tensors aren't kept)"""
+    training_ctx.model.eval()
+    batches: List[EmbeddedBatch] = []
+    for batch_idx, batch in enumerate(tqdm(dataloader)):
+        if max_batches > 0 and batch_idx >= max_batches:
+            break
+        query_embeddings, code_embeddings = encode_batch(
+            training_ctx.model, batch_to_device(batch, training_ctx.device, non_blocking=True)
+        )
+        similarity, code_lang_weights = batch[-6], batch[-1]
+        batches.append((query_embeddings.float().cpu(), code_embeddings.float().cpu(), similarity, code_lang_weights))
+    return batches
+
+
+def train_projection(
+    training_ctx: CodeSearchTrainingContext,
+    projection: EmbeddingProjection,
+    batches: List[EmbeddedBatch],
+    epochs: int,
+    lr: float,
+) -> EmbeddingProjection:
+    """Fine-tune projection with training loss of context on embeddings of frozen model"""
+    device = training_ctx.device
+    projection.to(device).train()
+    optimizer = AdamW(projection.parameters(), lr=lr)
+    for epoch in range(epochs):
+        total_loss = 0.0
+        for query_embeddings, code_embeddings, similarity, code_lang_weights in tqdm(batches):
+            optimizer.zero_grad()
+            loss, _ = training_ctx.losses_scores_fn(
+                projection(query_embeddings.to(device)),
+                projection(code_embeddings.to(device)),
+                similarity.to(device),
+                code_lang_weights.to(device),
+            )
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item()
+        logger.info(f"epoch {epoch} projection avg_loss:{total_loss / max(1, len(batches))}")
+    return projection.eval()
+
+
+@torch.no_grad()
+def evaluate_embeddings(
+    training_ctx: CodeSearchTrainingContext,
+    batches: List[EmbeddedBatch],
+    projection: Optional[EmbeddingProjection] = None,
+) -> Dict[str, float]:
+    """Loss/MRR/NDCG of (optionally projected) embeddings of batches"""
+    device = training_ctx.device
+    total_loss, total_mrr, total_ndcg, total_size = TotalLoss(0.0), TotalMrr(0.0), TotalNdcg(0.0), TotalSize(0)
+    avg_loss, avg_mrr, avg_ndcg = 0.0, 0.0, 0.0
+    for query_embeddings, code_embeddings, similarity, code_lang_weights in batches:
+        query_embeddings, code_embeddings = query_embeddings.to(device), code_embeddings.to(device)
+        if projection is not None:
+            query_embeddings, code_embeddings = projection(query_embeddings), projection(code_embeddings)
+        loss, similarity_scores = training_ctx.losses_scores_fn(
+            query_embeddings, code_embeddings, similarity.to(device), code_lang_weights.to(device)
+        )
+        # compute_loss_mrr_ndcg only reads similarity (3rd field of a full batch)
+        metrics_batch = [torch.empty(0), torch.empty(0), similarity] + [torch.empty(0)] * 5
+        total_loss, avg_loss, total_mrr, avg_mrr, total_ndcg, avg_ndcg, total_size = compute_loss_mrr_ndcg(
+            metrics_batch,
+            similarity_scores,
+            BatchLoss(loss.item()),
+            BatchSize(query_embeddings.shape[0]),
+            total_loss,
+            total_mrr,
+            total_ndcg,
+            total_size,
+            device,
+        )
+    return {"loss": avg_loss, "mrr": avg_mrr, "ndcg": avg_ndcg}
+
+
+def benchmark_index(name: str, code_embeddings: Tensor, query_embeddings: Tensor, nb_trees: int, k: int = 100) -> None:
+    """Log embeddings memory, Annoy index build time & search latency of query_embeddings"""
+    nb, dim = code_embeddings.shape
+    start = time.time()
+    index: AnnoyIndex = AnnoyIndex(dim, "angular")
+    for i, emb in enumerate(code_embeddings.tolist()):
+        index.add_item(i, emb)
+    index.build(nb_trees)
+    build_t = time.time() - start
+
+    queries = query_embeddings.tolist()
+    start = time.time()
+    for emb in queries:
+        index.get_nns_by_vector(emb, k)
+    search_t = (time.time() - start) / max(1, len(queries))
+    logger.info(
+        f"{name}: {nb} codes x {dim} float32 = {nb * dim * 4 / 1e6:.2f} MB "
+        f"({dim * 4 * 1e6 / 1e9:.2f} GB per million codes), annoy build {build_t:.2f} s, "
+        f"search top-{k} {search_t * 1000:.3f} ms/query"
+    )
+
+
+def run(args, tag_in_vcs=False) -> None:
+    os.environ["WANDB_MODE"] = "dryrun"
+
+    output_dir = Path(args["OUTPUT_DIR"])
+    os.makedirs(output_dir, exist_ok=True)
+    dim = int(args["--dim"])
+    method = args["--method"]
+    if method not in METHODS:
+        raise ValueError(f"Unknown projection method {method} (expected one of {METHODS})")
+
+    restore_dir = args["--restore"]
+    logger.info(f"Restoring Training Context from directory {restore_dir}")
+    training_ctx = CodeSearchTrainingContext.build_context_from_dir(restore_dir)
+    training_ctx.eval_mode()
+
+    logger.info("Computing training embeddings")
+    train_batches = compute_embeddings(
+        training_ctx, training_ctx.build_lang_dataloader(DatasetType.TRAIN), int(args["--max_batches"])
+    )
+    projection = EmbeddingProjection.from_pca((torch.cat([q, c]) for q, c, _, _ in train_batches), dim)
+    if method == "trained":
+        # eval_mode disables gradients globally
+        with torch.enable_grad():
+            projection = train_projection(
+                training_ctx, projection, train_batches, int(args["--epochs"]), float(args["--lr"])
+            )
+    projection = projection.to(training_ctx.device).eval()
+    projection.save(output_dir)
+    logger.info(f"Saved {method} projection to dimension {dim} to {output_dir}")
+
+    logger.info("Computing test embeddings")
+    test_batches = compute_embeddings(training_ctx, training_ctx.build_lang_dataloader(DatasetType.TEST))
+    full_results = evaluate_embeddings(training_ctx, test_batches)
+    projected_results = evaluate_embeddings(training_ctx, test_batches, projection)
+    logger.info(f"test full dimension {projection.input_dim}: {full_results}")
+    logger.info(f"test projected dimension {dim}: {projected_results}")
+
+    with torch.no_grad():
+        query_embeddings = torch.cat([q for q, _, _, _ in test_batches])
+        code_embeddings = torch.cat([c for _, c, _, _ in test_batches])
+        benchmark_index("full", code_embeddings, query_embeddings, int(args["--nb_trees"]))
+        benchmark_index(
+            "projected",
+            projection.cpu()(code_embeddings),
+            projection.cpu()(query_embeddings),
+            int(args["--nb_trees"]),
+        )
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    run_and_debug(lambda: run(args), args["--debug"])
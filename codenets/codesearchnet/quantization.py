@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    quantization.py [options] OUTPUT_DIR
+
+Quantize Linear layers of query & code encoders of a trained model (QueryCodeSiamese, Query1Code1 or Query1CodeN) to
+int8 with post-training dynamic quantization, benchmark code encoding throughput of float32 vs int8 models on CPU and
+save the quantized model as a `QuantizedModelRecordable` into OUTPUT_DIR.
+
+Dynamically quantized models only run on CPU. Their MRR/NDCG impact is evaluated with `eval.py --quantize`.
+
+Options:
+    -h --help                        Show this screen.
+    --restore DIR                    specify restoration dir.
+    --batch_size N                   Batch size of benchmark. [default: 128]
+    --nb_batches N                   Number of benchmarked batches. [default: 10]
+    --nb_threads N                   Number of CPU threads (0 for torch default). [default: 0]
+    --debug                          Enable debug routines. [default: False]
+"""
+
+from __future__ import annotations
+
+import copy
+import os
+from pathlib import Path
+from typing import Any, Set, Type
+
+import torch
+from docopt import docopt
+from dpu_utils.utils import run_and_debug
+from loguru import logger
+from torch import nn
+
+from codenets.codesearchnet.torchscript_export import benchmark, random_tokens, vocab_size
+from codenets.codesearchnet.training_ctx import CodeSearchTrainingContext
+from codenets.losses import load_loss_and_similarity_function
+from codenets.recordable import RecordableTorchModule
+
+
+def quantize_model(
+    model: nn.Module, layers: Set[Type[nn.Module]] = {nn.Linear}, dtype: torch.dtype = torch.qint8
+) -> nn.Module:
+    """Dynamically quantized CPU copy of model (weights of layers are quantized ahead, activations on the fly)"""
+    model = copy.deepcopy(model).cpu().eval()
+    return torch.quantization.quantize_dynamic(model, layers, dtype=dtype)
+
+
+class QuantizedModelRecordable(RecordableTorchModule):
+    """
+    Recordable variant of a code search model whose encoders have been dynamically quantized.
+
+    Quantized modules can't be rebuilt from configuration so the whole quantized model is recorded (default
+    RecordableTorchModule save) and it exposes the same forward/encode_query/encode_code as the wrapped model.
+    """
+
+    def __init__(self, model: nn.Module):
+        super(QuantizedModelRecordable, self).__init__()
+        self.model = model
+
+    @classmethod
+    def from_model(cls, model: nn.Module) -> QuantizedModelRecordable:
+        return cls(quantize_model(model))
+
+    def forward(self, *args: Any, **kwargs: Any):  # type: ignore
+        return self.model(*args, **kwargs)
+
+    def encode_query(self, query_tokens: torch.Tensor, query_tokens_mask: torch.Tensor) -> torch.Tensor:
+        return self.model.encode_query(query_tokens, query_tokens_mask)
+
+    def encode_code(self, lang_id: int, code_tokens: torch.Tensor, code_tokens_mask: torch.Tensor) -> torch.Tensor:
+        return self.model.encode_code(lang_id, code_tokens, code_tokens_mask)
+
+
+def quantize_training_ctx(training_ctx: CodeSearchTrainingContext) -> CodeSearchTrainingContext:
+    """
+    Replace model of training context by its quantized version and move context to CPU (for evaluation/predictions)
+    Please note that IT MUTATES training_ctx
+    """
+    if isinstance(training_ctx.model, QuantizedModelRecordable):
+        return training_ctx
+    training_ctx.model = QuantizedModelRecordable.from_model(training_ctx.model)
+    training_ctx.device = torch.device("cpu")
+    training_ctx.losses_scores_fn = load_loss_and_similarity_function(
+        training_ctx.conf["training.loss"], training_ctx.device
+    )
+    logger.info("Quantized model Linear layers to int8, running on CPU")
+    return training_ctx
+
+
+def run(args, tag_in_vcs=False) -> None:
+    os.environ["WANDB_MODE"] = "dryrun"
+
+    output_dir = Path(args["OUTPUT_DIR"])
+    batch_size = int(args["--batch_size"])
+    nb_batches = int(args["--nb_batches"])
+    nb_threads = int(args["--nb_threads"])
+    if nb_threads > 0:
+        torch.set_num_threads(nb_threads)
+
+    restore_dir = args["--restore"]
+    logger.info(f"Restoring Training Context from directory {restore_dir}")
+    training_ctx = CodeSearchTrainingContext.build_context_from_dir(restore_dir)
+    training_ctx.eval_mode()
+
+    model = training_ctx.model.cpu().eval()
+    quantized = QuantizedModelRecordable.from_model(model)
+
+    code_max_length = training_ctx.conf["dataset.common_params.code_max_num_tokens"]
+    code_inputs = random_tokens(batch_size, code_max_length, vocab_size(model))
+    language, lang_id = next(iter(training_ctx.train_data_params.lang_ids.items()))
+    with torch.no_grad():
+        float_emb = model.encode_code(lang_id, *code_inputs)
+        int8_emb = quantized.encode_code(lang_id, *code_inputs)
+        cos = torch.nn.functional.cosine_similarity(float_emb, int8_emb, dim=-1)
+        logger.info(f"code {language}: mean cosine similarity float32/int8 embeddings {cos.mean().item():.4f}")
+
+        float_t = benchmark(
+            f"float32 {language} code encoder", lambda: model.encode_code(lang_id, *code_inputs), nb_batches
+        )
+        int8_t = benchmark(
+            f"int8 {language} code encoder", lambda: quantized.encode_code(lang_id, *code_inputs), nb_batches
+        )
+    logger.info(
+        f"=> code encoding throughput float32 {batch_size / float_t:.1f} vs int8 {batch_size / int8_t:.1f} codes/sec "
+        f"(speedup x{float_t / int8_t:.2f})"
+    )
+
+    quantized.save(output_dir)
+    logger.info(f"Saved quantized model to {output_dir}")
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    run_and_debug(lambda: run(args), args["--debug"])
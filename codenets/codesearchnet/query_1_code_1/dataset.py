@@ -21,6 +21,7 @@ from codenets.codesearchnet.dataset_utils import (
     Compose,
     InputFeaturesToNpArray,
     Tensorize,
+    compute_language_weightings,
 )
 from codenets.codesearchnet.copied_code.metadata import QueryType
 from codenets.codesearchnet.data import InputFeatures
@@ -312,9 +313,14 @@ def build_lang_dataset_single_code_tokenizer(
         logger.debug(f"Pickled dataset {name} [{nb} raw samples] to {pickle_file}")
 
     # logger.debug(f"Samples {loaded_samples['python'][:2]}")
-    transform = Compose([InputFeaturesToNpArray, Tensorize])
+    lang_weights = compute_language_weightings(loaded_samples, data_params.lang_ids) if use_lang_weights else None
+    transform = Compose([InputFeaturesToNpArray(lang_weights), Tensorize()])
     dataset = LangDataset(
-        loaded_samples, lang_ids=data_params.lang_ids, transform=transform, use_lang_weights=use_lang_weights
+        loaded_samples,
+        lang_ids=data_params.lang_ids,
+        transform=transform,
+        use_lang_weights=use_lang_weights,
+        tokenizer=query_tokenizer,
     )
     logger.debug(f"Loaded {name} lang dataset [{len(dataset)} samples]")
     return dataset
@@ -19,6 +19,7 @@ from codenets.codesearchnet.data import DatasetParams
 from codenets.codesearchnet.training_ctx import CodeSearchTrainingContext, DatasetType
 from codenets.codesearchnet.tokenizer_recs import TokenizerRecordable
 from codenets.codesearchnet.training_ctx import ModelAndAdamWRecordable, default_sample_update
+from codenets.codesearchnet.batch_transfer import batch_to_device
 
 # from codenets.codesearchnet.tokenizer_recs import load_query_code_tokenizers_from_hocon_single_code_tokenizer
 from codenets.codesearchnet.query_1_code_1.model import Query1Code1
@@ -43,8 +44,8 @@ class Query1Code1ModelAndAdamW(ModelAndAdamWRecordable):
 
     model_type = Query1Code1
 
-    def __init__(self, model: Query1Code1, optimizer: AdamW):
-        super(Query1Code1ModelAndAdamW, self).__init__(model, optimizer)
+    def __init__(self, model: Query1Code1, optimizer: AdamW, scaler_state: Optional[Dict] = None):
+        super(Query1Code1ModelAndAdamW, self).__init__(model, optimizer, scaler_state)
 
 
 class Query1Code1Ctx(CodeSearchTrainingContext):
@@ -58,10 +59,15 @@ class Query1Code1Ctx(CodeSearchTrainingContext):
         self.model = model_optimizer_rec.model
         self.model = self.model.to(device=self.device)
         self.optimizer = model_optimizer_rec.optimizer
+        self.mixed_precision.load_state_dict(model_optimizer_rec.scaler_state)
+        # scaler state is recorded with model & optimizer
+        model_optimizer_rec.mixed_precision = self.mixed_precision
         # trick to pass params to refresh params on the right device
         # as there is no function for that in pytorch
         # need to find a nicer solution...
         self.optimizer.load_state_dict(self.optimizer.state_dict())
+        self.setup_gradient_checkpointing()
+        self.build_momentum_queue()
 
     @classmethod
     def from_hocon_custom(cls: Type["Query1Code1Ctx"], conf: ConfigTree) -> Mapping[str, Recordable]:
@@ -110,26 +116,32 @@ class Query1Code1Ctx(CodeSearchTrainingContext):
         Returns:
             Tuple[Tensor, Tensor, Tensor]: (global loss tensor for all samples in batch, losses per sample in batch, tensor matrix of similarity scores between all samples)
         """
-        languages, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, code_lang_weights = [
-            t.to(self.device) for t in batch
-        ]
-        (query_embedding, code_embedding) = self.model(
-            languages=languages,
-            query_tokens=query_tokens,
-            query_tokens_mask=query_tokens_mask,
-            code_tokens=code_tokens,
-            code_tokens_mask=code_tokens_mask,
+        languages, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, code_lang_weights = batch_to_device(
+            batch, self.device, non_blocking=True
         )
+        with self.mixed_precision.autocast():
+            (query_embedding, code_embedding) = self.model(
+                languages=languages,
+                query_tokens=query_tokens,
+                query_tokens_mask=query_tokens_mask,
+                code_tokens=code_tokens,
+                code_tokens_mask=code_tokens_mask,
+            )
+        query_embedding, code_embedding = self.mixed_precision.float_embeddings(query_embedding, code_embedding)
+        extra_negatives = None
+        if self.momentum_queue is not None and self.model.training:
+            extra_negatives = self.momentum_queue.negatives_and_enqueue(languages, code_tokens, code_tokens_mask)
         batch_total_loss, similarity_scores = self.losses_scores_fn(
-            query_embedding, code_embedding, similarity, code_lang_weights
+            query_embedding, code_embedding, similarity, code_lang_weights, extra_negatives=extra_negatives
         )
 
         return (batch_total_loss, similarity_scores)
 
     def backward_optimize(self, loss: Tensor) -> Tensor:
         """Perform backward pass from loss"""
-        loss.backward()
-        self.optimizer.step()
+        self.mixed_precision.backward_optimize(loss, self.optimizer)
+        if self.momentum_queue is not None:
+            self.momentum_queue.update_model(self.model)
         return loss
 
     def zero_grad(self) -> bool:
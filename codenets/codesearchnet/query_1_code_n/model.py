@@ -2,11 +2,13 @@ from __future__ import annotations
 
 import os
 from pathlib import Path
-from typing import MutableMapping, Optional, Union, Mapping, cast, Dict, List
+from typing import MutableMapping, Optional, Union, Mapping, cast, Dict, List, Type
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from loguru import logger
+from torch import nn
 from transformers import AdamW, BertConfig, BertModel
 
 from codenets.codesearchnet.data import DatasetParams
@@ -16,6 +18,7 @@ from codenets.codesearchnet.poolers import MeanWeightedPooler
 from codenets.codesearchnet.huggingface.models import PreTrainedModelRecordable
 from codenets.recordable import (
     HoconConfigRecordable,
+    LazyRecordableTorchModuleMapping,
     Recordable,
     RecordableMapping,
     RecordableTorchModule,
@@ -39,7 +42,7 @@ class Query1CodeN(RecordableTorchModule):
     def __init__(
         self,
         query_encoder: RecordableTorchModule,
-        code_encoders: RecordableTorchModuleMapping,
+        code_encoders: Union[RecordableTorchModuleMapping, LazyRecordableTorchModuleMapping],
         pooler: Optional[RecordableTorchModule] = None,
     ):
         super(Query1CodeN, self).__init__()
@@ -58,10 +61,27 @@ class Query1CodeN(RecordableTorchModule):
         return save_recordable_mapping(output_dir=d, records=records)
 
     @classmethod
-    def load(cls, restore_dir: Union[Path, str]) -> Query1CodeN:
+    def load(
+        cls, restore_dir: Union[Path, str], lazy: bool = False, max_resident: int = 0, nb_workers: int = 4
+    ) -> Query1CodeN:
+        """
+        Load Query1CodeN from restore_dir.
+        With lazy, code encoders are only loaded when their language is first encoded (for inference only) and with
+        max_resident > 0, at most max_resident code encoders are kept in memory (least recently used being evicted)
+        """
         d = Path(restore_dir) / full_classname(cls)
-        records = runtime_load_recordable_mapping(d)
-        return cls(**records)
+        if not lazy:
+            records = runtime_load_recordable_mapping(d)
+            return cls(**records)
+
+        eager_keys = [key for key in os.listdir(d) if key != "code_encoders"]
+        lazy_records: MutableMapping[str, Recordable] = dict(
+            runtime_load_recordable_mapping(d, accepted_keys=eager_keys)
+        )
+        lazy_records["code_encoders"] = LazyRecordableTorchModuleMapping.load(
+            d / "code_encoders", max_resident=max_resident, nb_workers=nb_workers
+        )
+        return cls(**lazy_records)  # type: ignore
 
     def forward(  # type: ignore
         self,
@@ -71,18 +91,11 @@ class Query1CodeN(RecordableTorchModule):
         code_tokens: np.ndarray,
         code_tokens_mask: np.ndarray,
     ):
-        lang_id = str(languages[0].item())
-        query_seq_outputs = self.query_encoder(query_tokens, query_tokens_mask)  # [B x S x H]
-        code_seq_outputs = self.code_encoders[lang_id](code_tokens, code_tokens_mask)  # [B x S x H]
-
-        if self.pooler is not None:
-            return (
-                self.pooler(query_seq_outputs[0], query_tokens_mask),
-                self.pooler(code_seq_outputs[0], code_tokens_mask),
-            )
-        else:
-            # use already pooled data (need to be pretrained as it uses 1st (CLS) token logit)
-            return query_seq_outputs[1], code_seq_outputs[1]
+        # batches can mix languages, each code going through the encoder of its language
+        return (
+            self.encode_query(query_tokens, query_tokens_mask),
+            self.encode_codes(languages, code_tokens, code_tokens_mask),
+        )
 
     def encode_query(self, query_tokens: np.ndarray, query_tokens_mask: np.ndarray) -> np.ndarray:
         query_seq_outputs = self.query_encoder(query_tokens, query_tokens_mask)
@@ -99,6 +112,201 @@ class Query1CodeN(RecordableTorchModule):
         else:
             return code_seq_outputs[1]
 
+    def encode_codes(self, languages: torch.Tensor, code_tokens: torch.Tensor, code_tokens_mask: torch.Tensor):
+        """
+        Encode codes of a batch mixing languages: codes are gathered by language, each language encoder is run once
+        on its sub-batch and embeddings are scattered back in batch order
+        """
+        languages = languages.view(-1)
+        lang_ids = languages.unique().tolist()
+        if len(lang_ids) == 1:
+            return self.encode_code(lang_ids[0], code_tokens, code_tokens_mask)
+
+        if isinstance(self.code_encoders, LazyRecordableTorchModuleMapping):
+            # load encoders of all languages of the batch in parallel
+            self.code_encoders.preload([str(lang_id) for lang_id in lang_ids])
+        code_embeddings: Optional[torch.Tensor] = None
+        for lang_id in lang_ids:
+            idx = (languages == lang_id).nonzero().view(-1)
+            lang_embeddings = self.encode_code(
+                lang_id, code_tokens.index_select(0, idx), code_tokens_mask.index_select(0, idx)
+            )
+            if code_embeddings is None:
+                code_embeddings = lang_embeddings.new_zeros((code_tokens.shape[0], lang_embeddings.shape[1]))
+            # out-of-place so that gradients flow back to each language encoder
+            code_embeddings = code_embeddings.index_copy(0, idx, lang_embeddings)
+        return code_embeddings
+
+
+class LanguageAdapter(nn.Module):
+    """Bottleneck adapter (down-projection, GELU, up-projection & residual) starting as identity"""
+
+    def __init__(self, hidden_size: int, bottleneck_size: int):
+        super(LanguageAdapter, self).__init__()
+        self.layer_norm = nn.LayerNorm(hidden_size)
+        self.down = nn.Linear(hidden_size, bottleneck_size)
+        self.up = nn.Linear(bottleneck_size, hidden_size)
+        nn.init.zeros_(self.up.weight)
+        nn.init.zeros_(self.up.bias)
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:  # type: ignore
+        return hidden_states + self.up(F.gelu(self.down(self.layer_norm(hidden_states))))
+
+
+class LanguageAdapters(RecordableTorchModule):
+    """
+    Per-language stacks of bottleneck adapters applied to the sequence outputs of a shared code encoder.
+    With language_embeddings, the shared encoder also receives the language id as token type id so that each language
+    gets its own learnt embedding added to all its tokens.
+    It is recorded as a whole (default RecordableTorchModule save).
+    """
+
+    def __init__(
+        self,
+        lang_ids: List[int],
+        hidden_size: int,
+        bottleneck_size: int = 64,
+        nb_layers: int = 1,
+        language_embeddings: bool = True,
+    ):
+        super(LanguageAdapters, self).__init__()
+        self.language_embeddings = language_embeddings
+        self.adapters = nn.ModuleDict(
+            {
+                str(lang_id): nn.Sequential(*[LanguageAdapter(hidden_size, bottleneck_size) for _ in range(nb_layers)])
+                for lang_id in lang_ids
+            }
+        )
+
+    def token_type_ids(self, languages: torch.Tensor, code_tokens: torch.Tensor) -> Optional[torch.Tensor]:
+        """Language id of each code token [B x S] (None without language embeddings)"""
+        if not self.language_embeddings:
+            return None
+        return languages.view(-1, 1).expand_as(code_tokens).long()
+
+    def forward(self, languages: torch.Tensor, hidden_states: torch.Tensor) -> torch.Tensor:  # type: ignore
+        """Adapt hidden states [B x S x H] of each code with the adapters of its language"""
+        languages = languages.view(-1)
+        lang_ids = languages.unique().tolist()
+        if len(lang_ids) == 1:
+            return self.adapters[str(lang_ids[0])](hidden_states)
+
+        adapted = hidden_states
+        for lang_id in lang_ids:
+            idx = (languages == lang_id).nonzero().view(-1)
+            # out-of-place so that gradients flow back to each language adapters
+            adapted = adapted.index_copy(0, idx, self.adapters[str(lang_id)](hidden_states.index_select(0, idx)))
+        return adapted
+
+
+class Query1CodeNAdapters(RecordableTorchModule):
+    """
+    A lightweight variant of Query1CodeN with:
+    - one single-branch query encoder
+    - one code encoder shared by all languages, specialized by per-language adapters (& optional language embeddings)
+    - one optional pooler to pool output embeddings from any branch
+
+    Mixed-language batches go through the shared code encoder at once, only adapters are dispatched by language.
+    """
+
+    def __init__(
+        self,
+        query_encoder: RecordableTorchModule,
+        code_encoder: RecordableTorchModule,
+        code_adapters: LanguageAdapters,
+        pooler: Optional[RecordableTorchModule] = None,
+    ):
+        super(Query1CodeNAdapters, self).__init__()
+        self.query_encoder = query_encoder
+        self.code_encoder = code_encoder
+        self.code_adapters = code_adapters
+        self.pooler = pooler
+
+    def save(self, output_dir: Union[Path, str]) -> bool:
+        d = Path(output_dir) / instance_full_classname(self)
+        records: MutableMapping[str, Recordable] = {
+            "query_encoder": self.query_encoder,
+            "code_encoder": self.code_encoder,
+            "code_adapters": self.code_adapters,
+        }
+        if self.pooler is not None:
+            records["pooler"] = self.pooler
+        return save_recordable_mapping(output_dir=d, records=records)
+
+    @classmethod
+    def load(cls, restore_dir: Union[Path, str]) -> Query1CodeNAdapters:
+        d = Path(restore_dir) / full_classname(cls)
+        records = runtime_load_recordable_mapping(d)
+        return cls(**records)
+
+    def forward(  # type: ignore
+        self,
+        languages: np.ndarray,
+        query_tokens: np.ndarray,
+        query_tokens_mask: np.ndarray,
+        code_tokens: np.ndarray,
+        code_tokens_mask: np.ndarray,
+    ):
+        return (
+            self.encode_query(query_tokens, query_tokens_mask),
+            self.encode_codes(languages, code_tokens, code_tokens_mask),
+        )
+
+    def encode_query(self, query_tokens: np.ndarray, query_tokens_mask: np.ndarray) -> np.ndarray:
+        query_seq_outputs = self.query_encoder(query_tokens, query_tokens_mask)
+
+        if self.pooler:
+            return self.pooler(query_seq_outputs[0], query_tokens_mask)
+        else:
+            return query_seq_outputs[1]
+
+    def encode_code(self, lang_id: int, code_tokens, code_tokens_mask: np.ndarray) -> np.ndarray:
+        languages = torch.full((code_tokens.shape[0],), lang_id, dtype=torch.long, device=code_tokens.device)
+        return self.encode_codes(languages, code_tokens, code_tokens_mask)
+
+    def encode_codes(self, languages: torch.Tensor, code_tokens: torch.Tensor, code_tokens_mask: torch.Tensor):
+        """Encode codes of a batch mixing languages: shared encoder on whole batch then adapters of each language"""
+        code_seq_outputs = self.code_encoder(
+            code_tokens, code_tokens_mask, self.code_adapters.token_type_ids(languages, code_tokens)
+        )
+        hidden_states = self.code_adapters(languages, code_seq_outputs[0])
+        if self.pooler:
+            return self.pooler(hidden_states, code_tokens_mask)
+        else:
+            # adapted hidden state of 1st (CLS) token
+            return hidden_states[:, 0]
+
+    @classmethod
+    def from_hocon(cls: Type[Query1CodeNAdapters], config: ConfigTree) -> Query1CodeNAdapters:
+        """
+        Load Query1CodeNAdapters from a config tree: encoders are configured like Query1Code1 and adapters by
+        training.model.code_adapters (bottleneck_size, nb_layers, language_embeddings)
+        """
+        lang_ids = list(DatasetParams(**config["dataset.train.params"]).lang_ids.values())
+        adapters_conf = config.get("training.model.code_adapters", ConfigTree())
+        language_embeddings = adapters_conf.get_bool("language_embeddings", True)
+
+        query_bert_config = BertConfig(**config["training.model.query_encoder"])
+        query_encoder = PreTrainedModelRecordable(BertModel(query_bert_config))
+        code_bert_config = BertConfig(**config["training.model.code_encoder"])
+        if language_embeddings:
+            # token type embeddings are used as language embeddings
+            code_bert_config.type_vocab_size = max(code_bert_config.type_vocab_size, max(lang_ids) + 1)
+        code_encoder = PreTrainedModelRecordable(BertModel(code_bert_config))
+
+        return cls(
+            query_encoder=query_encoder,
+            code_encoder=code_encoder,
+            code_adapters=LanguageAdapters(
+                lang_ids,
+                hidden_size=code_bert_config.hidden_size,
+                bottleneck_size=adapters_conf.get_int("bottleneck_size", 64),
+                nb_layers=adapters_conf.get_int("nb_layers", 1),
+                language_embeddings=language_embeddings,
+            ),
+            pooler=MeanWeightedPooler(input_size=query_bert_config.hidden_size),
+        )
+
 
 def multibranch_bert_from_hocon(config: ConfigTree) -> Query1CodeN:
     """Load Query1CodeN from a config tree"""
@@ -9,19 +9,22 @@ import time
 
 # from torch import nn
 import numpy as np
+from torch.utils.data import DataLoader
 from transformers import AdamW
 from pyhocon import ConfigTree
 from tokenizers import BPETokenizer
 from tokenizers.normalizers import BertNormalizer
 from codenets.recordable import Recordable, RecordableMapping
-from codenets.codesearchnet.dataset_utils import LangDataset
+from codenets.codesearchnet.dataset_utils import LangDataset, BalancedBatchSchedulerSampler, log_worker_memory
 from codenets.codesearchnet.data import DatasetParams
 from codenets.codesearchnet.training_ctx import CodeSearchTrainingContext, DatasetType
 from codenets.codesearchnet.tokenizer_recs import TokenizerRecordable
 from codenets.codesearchnet.training_ctx import ModelAndAdamWRecordable, default_sample_update
+from codenets.codesearchnet.batch_transfer import PackedCollate, batch_to_device
 
 # from codenets.codesearchnet.tokenizer_recs import load_query_code_tokenizers_from_hocon_single_code_tokenizer
 from codenets.codesearchnet.query_1_code_1.model import Query1Code1
+from codenets.codesearchnet.query_1_code_n.model import Query1CodeN, Query1CodeNAdapters, multibranch_bert_from_hocon
 from codenets.codesearchnet.query_1_code_1.dataset import build_lang_dataset_single_code_tokenizer
 from codenets.codesearchnet.huggingface.tokenizer_recs import (
     HuggingfaceBPETokenizerRecordable,
@@ -43,8 +46,8 @@ class Query1Code1ModelAndAdamW(ModelAndAdamWRecordable):
 
     model_type = Query1Code1
 
-    def __init__(self, model: Query1Code1, optimizer: AdamW):
-        super(Query1Code1ModelAndAdamW, self).__init__(model, optimizer)
+    def __init__(self, model: Query1Code1, optimizer: AdamW, scaler_state: Optional[Dict] = None):
+        super(Query1Code1ModelAndAdamW, self).__init__(model, optimizer, scaler_state)
 
 
 # def build_huggingface_bpetokenizers_from_hocon(
@@ -72,10 +75,15 @@ class Query1Code1Ctx(CodeSearchTrainingContext):
         self.model = model_optimizer_rec.model
         self.model = self.model.to(device=self.device)
         self.optimizer = model_optimizer_rec.optimizer
+        self.mixed_precision.load_state_dict(model_optimizer_rec.scaler_state)
+        # scaler state is recorded with model & optimizer
+        model_optimizer_rec.mixed_precision = self.mixed_precision
         # trick to pass params to refresh params on the right device
         # as there is no function for that in pytorch
         # need to find a nicer solution...
         self.optimizer.load_state_dict(self.optimizer.state_dict())
+        self.setup_gradient_checkpointing()
+        self.build_momentum_queue()
 
     @classmethod
     def from_hocon_custom(cls: Type["Query1Code1Ctx"], conf: ConfigTree) -> Mapping[str, Recordable]:
@@ -123,18 +131,23 @@ class Query1Code1Ctx(CodeSearchTrainingContext):
         Returns:
             Tuple[Tensor, Tensor, Tensor]: (global loss tensor for all samples in batch, losses per sample in batch, tensor matrix of similarity scores between all samples)
         """
-        languages, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, code_lang_weights = [
-            t.to(self.device) for t in batch
-        ]
-        (query_embedding, code_embedding) = self.model(
-            languages=languages,
-            query_tokens=query_tokens,
-            query_tokens_mask=query_tokens_mask,
-            code_tokens=code_tokens,
-            code_tokens_mask=code_tokens_mask,
+        languages, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, code_lang_weights = batch_to_device(
+            batch, self.device, non_blocking=True
         )
+        with self.mixed_precision.autocast():
+            (query_embedding, code_embedding) = self.model(
+                languages=languages,
+                query_tokens=query_tokens,
+                query_tokens_mask=query_tokens_mask,
+                code_tokens=code_tokens,
+                code_tokens_mask=code_tokens_mask,
+            )
+        query_embedding, code_embedding = self.mixed_precision.float_embeddings(query_embedding, code_embedding)
+        extra_negatives = None
+        if self.momentum_queue is not None and self.model.training:
+            extra_negatives = self.momentum_queue.negatives_and_enqueue(languages, code_tokens, code_tokens_mask)
         per_sample_losses, similarity_scores = self.losses_scores_fn(
-            query_embedding, code_embedding, similarity, code_lang_weights
+            query_embedding, code_embedding, similarity, code_lang_weights, extra_negatives=extra_negatives
         )
         avg_loss = torch.sum(per_sample_losses) / torch.sum(code_lang_weights)
 
@@ -142,10 +155,25 @@ class Query1Code1Ctx(CodeSearchTrainingContext):
 
     def backward_optimize(self, loss: Tensor) -> Tensor:
         """Perform backward pass from loss"""
-        loss.backward()
-        self.optimizer.step()
+        self.mixed_precision.backward_optimize(loss, self.optimizer)
+        if self.momentum_queue is not None:
+            self.momentum_queue.update_model(self.model)
         return loss
 
+    def grad_cache_loss(
+        self,
+        query_embedding: Tensor,
+        code_embedding: Tensor,
+        similarity: Tensor,
+        code_lang_weights: Tensor,
+        extra_negatives: Optional[Tensor],
+    ) -> Tuple[Tensor, Tensor]:
+        per_sample_losses, similarity_scores = self.losses_scores_fn(
+            query_embedding, code_embedding, similarity, code_lang_weights, extra_negatives=extra_negatives
+        )
+        # same normalization as forward
+        return torch.sum(per_sample_losses) / torch.sum(code_lang_weights), similarity_scores
+
     def zero_grad(self) -> bool:
         """Set all necessary elements to zero_grad"""
         self.model.zero_grad()
@@ -196,10 +224,39 @@ class Query1Code1Ctx(CodeSearchTrainingContext):
             query_tokenizer=self.query_tokenizer,
             code_tokenizer=self.code_tokenizer,
             lang_token="<lg>",
+            use_lang_weights=self.train_data_params.use_lang_weights,
             pickle_path=self.pickle_path,
             parallelize=self.train_data_params.parallelize,
         )
 
+    def build_lang_dataloader(self, dataset_type: DatasetType) -> DataLoader:
+        """
+        Build language dataloader of balanced batches: single-language batches or, with training.mix_languages,
+        batches mixing languages (codes being dispatched to their language by model encode_codes)
+        """
+        dataset = self.build_lang_dataset(dataset_type)
+
+        batch_size: int
+        if dataset_type == DatasetType.TRAIN:
+            batch_size = self.train_batch_size
+        elif dataset_type == DatasetType.VAL:
+            batch_size = self.val_batch_size
+        elif dataset_type == DatasetType.TEST:
+            batch_size = self.test_batch_size
+
+        return DataLoader(
+            dataset=dataset,
+            batch_size=batch_size,
+            sampler=BalancedBatchSchedulerSampler(
+                dataset=dataset, batch_size=batch_size, mix_languages=self.mix_languages
+            ),
+            collate_fn=PackedCollate(dataset.get_collate_fn()),
+            # samples are stored in shared numpy buffers so workers don't duplicate the dataset
+            num_workers=self.num_workers,
+            worker_init_fn=log_worker_memory if self.num_workers > 0 else None,
+            pin_memory=self.device.type == "cuda",
+        )
+
     def build_tokenizers(
         self,
         from_dataset_type: DatasetType,
@@ -221,6 +278,84 @@ class Query1Code1Ctx(CodeSearchTrainingContext):
         return True
 
 
+class Query1CodeNModelAndAdamW(ModelAndAdamWRecordable):
+    """Recordable for Query1CodeN + AdamW Optimizer (see Query1Code1ModelAndAdamW)"""
+
+    model_type = Query1CodeN
+
+    def __init__(self, model: Query1CodeN, optimizer: AdamW, scaler_state: Optional[Dict] = None):
+        super(Query1CodeNModelAndAdamW, self).__init__(model, optimizer, scaler_state)
+
+
+class Query1CodeNCtx(Query1Code1Ctx):
+    """
+    Training context of Query1CodeN: same single code tokenizer & datasets as Query1Code1Ctx, codes being encoded by
+    the code encoder of their language (configured by root `bert` & `lang_ids`)
+    """
+
+    @classmethod
+    def from_hocon_custom(cls: Type["Query1CodeNCtx"], conf: ConfigTree) -> Mapping[str, Recordable]:
+        res = load_tokenizers_from_hocon(conf)
+        if res is not None:
+            query_tokenizer, code_tokenizer = res
+        else:
+            raise ValueError("Couldn't load Tokenizers from conf")
+
+        device = torch.device(conf["training.device"])
+        model = multibranch_bert_from_hocon(conf)
+        model = model.to(device=device)
+
+        optimizer = AdamW(model.parameters(), lr=conf["training.lr"], correct_bias=False)
+
+        records = {
+            # need to pair model and optimizer as optimizer need it to be reloaded
+            "model_optimizer": Query1CodeNModelAndAdamW(model, optimizer),
+            "query_tokenizer": query_tokenizer,
+            "code_tokenizer": code_tokenizer,
+        }
+
+        return records
+
+
+class Query1CodeNAdaptersModelAndAdamW(ModelAndAdamWRecordable):
+    """Recordable for Query1CodeNAdapters + AdamW Optimizer (see Query1Code1ModelAndAdamW)"""
+
+    model_type = Query1CodeNAdapters
+
+    def __init__(self, model: Query1CodeNAdapters, optimizer: AdamW, scaler_state: Optional[Dict] = None):
+        super(Query1CodeNAdaptersModelAndAdamW, self).__init__(model, optimizer, scaler_state)
+
+
+class Query1CodeNAdaptersCtx(Query1Code1Ctx):
+    """
+    Training context of Query1CodeNAdapters: same single code tokenizer & datasets as Query1Code1Ctx, codes being
+    encoded by a shared code encoder & adapters of their language
+    """
+
+    @classmethod
+    def from_hocon_custom(cls: Type["Query1CodeNAdaptersCtx"], conf: ConfigTree) -> Mapping[str, Recordable]:
+        res = load_tokenizers_from_hocon(conf)
+        if res is not None:
+            query_tokenizer, code_tokenizer = res
+        else:
+            raise ValueError("Couldn't load Tokenizers from conf")
+
+        device = torch.device(conf["training.device"])
+        model = Query1CodeNAdapters.from_hocon(conf)
+        model = model.to(device=device)
+
+        optimizer = AdamW(model.parameters(), lr=conf["training.lr"], correct_bias=False)
+
+        records = {
+            # need to pair model and optimizer as optimizer need it to be reloaded
+            "model_optimizer": Query1CodeNAdaptersModelAndAdamW(model, optimizer),
+            "query_tokenizer": query_tokenizer,
+            "code_tokenizer": code_tokenizer,
+        }
+
+        return records
+
+
 def load_tokenizers_from_hocon(conf: ConfigTree) -> Optional[Tuple[TokenizerRecordable, TokenizerRecordable]]:
     build_path = Path(conf["tokenizers.build_path"])
 
@@ -12,7 +12,8 @@ from tqdm import tqdm
 import pandas as pd
 from dpu_utils.codeutils import split_identifier_into_parts
 
-from codenets.utils import _to_subtoken_stream, get_data_files_from_directory
+from codenets.utils import _to_subtoken_stream, get_data_files_from_directory, sort_files_by_size
+from codenets.recordable import runtime_load_recordable
 from codenets.codesearchnet.data import DatasetParams
 from codenets.codesearchnet.tokenizer_recs import TokenizerRecordable
 from codenets.codesearchnet.copied_code.utils import read_file_samples
@@ -23,14 +24,13 @@ from codenets.codesearchnet.dataset_utils import (
     Compose,
     InputFeaturesToNpArray_RandomReplace,
     PDSeriesToNpArray,
-    FullNpArrayToFinalNpArray,
     Tensorize,
     compute_language_weightings,
     compute_language_weightings_df,
 )
 from codenets.codesearchnet.copied_code.metadata import QueryType
 from codenets.codesearchnet.data import InputFeatures
-from codenets.codesearchnet.code_ast.ast_utils import load_special_tokens, TreeSitterParser
+from codenets.codesearchnet.code_ast.ast_utils import load_special_tokens, StructuralTokenIds, TreeSitterParser
 
 
 def convert_and_pad_token_sequence(
@@ -383,6 +383,11 @@ def build_lang_dataset_siamese_tokenizer(
         embedding_model=embedding_model,
         tokenizer=tokenizer,
         emb_annoy_path=Path(pickle_path) / f"{name}_embeddings.ann",
+        emb_dtype=data_params.query_embeddings_dtype,
+        emb_batch_size=data_params.query_embeddings_batch_size,
+        emb_chunk_size=data_params.query_embeddings_chunk_size,
+        emb_processes=data_params.query_embeddings_processes,
+        mmap_path=Path(pickle_path) / f"{name}_arrays" if data_params.mmap_samples else None,
     )
     logger.debug(f"Loaded {name} lang dataset [{len(dataset)} samples]")
     return dataset
@@ -465,7 +470,8 @@ def parse_data_file_ast_tokenizer(
     ast_parser: TreeSitterParser,
     query_token: str,
     pickle_path: Path,
-) -> Tuple[str, pd.DataFrame]:
+) -> Tuple[str, Path]:
+    """Parse & tokenize data_file into a DataFrame shard pickled in pickle_path, return (language, shard path)"""
     logger.info(f"Reading samples from {data_file}")
     filename = os.path.basename(data_file)
     file_language = filename.split("_")[0]
@@ -473,13 +479,17 @@ def parse_data_file_ast_tokenizer(
     pickle_file = pickle_path / f"{file_id}.p"
 
     if pickle_file.exists():
-        df = pd.read_pickle(pickle_path / f"{file_id}.p")
-        return (file_language, df)
+        return (file_language, pickle_file)
 
     samples = list(read_file_samples(data_file))
 
+    structural_ids: Optional[StructuralTokenIds] = None
+    if data_params.ast_structural_ids:
+        structural_ids = StructuralTokenIds(tokenizer, load_special_tokens(data_params))
+
     # ds: List[Dict[str, Union[str, int]]] = []
     codes: List[List[str]] = []
+    code_streams: List[List[Tuple[str, bool]]] = []
     funcs: List[List[str]] = []
     docstrings: List[List[str]] = []
     for idx, raw_sample in enumerate(tqdm(samples)):
@@ -493,7 +503,14 @@ def parse_data_file_ast_tokenizer(
 
         function_name = raw_sample.get("func_name")
 
-        code: List[str] = ast_parser.parse(language, raw_sample["code"], max_tokens=data_params.code_max_num_tokens)
+        code: List[str] = []
+        code_stream: List[Tuple[str, bool]] = []
+        if structural_ids is not None:
+            code_stream = ast_parser.parse_stream(
+                language, raw_sample["code"], max_tokens=data_params.code_max_num_tokens
+            )
+        else:
+            code = ast_parser.parse(language, raw_sample["code"], max_tokens=data_params.code_max_num_tokens)
 
         # Skip samples where the function name is very short, because it probably has too little information
         # to be a good search query.
@@ -504,9 +521,14 @@ def parse_data_file_ast_tokenizer(
         ):
             func = [query_token] + split_identifier_into_parts(function_name)
             code = [tokenizer.unk_token() if token == function_name else token for token in code]
+            code_stream = [
+                (tokenizer.unk_token(), False) if token == function_name else (token, is_structural)
+                for token, is_structural in code_stream
+            ]
             docstring = [query_token] + [d.lower() for d in raw_sample["docstring_tokens"]]
 
             codes.append(code)
+            code_streams.append(code_stream)
             funcs.append(func)
             docstrings.append(docstring)
 
@@ -517,10 +539,16 @@ def parse_data_file_ast_tokenizer(
     docstring_toks: List[List[int]] = []
     docstring_masks: List[List[int]] = []
 
-    for batch in batch_iter(codes, batch_size=100):
-        toks, masks = tokenizer.encode_tokens(batch, max_length=data_params.code_max_num_tokens)
-        code_toks.extend(toks)
-        code_masks.extend(masks)
+    if structural_ids is not None:
+        for code_stream in code_streams:
+            toks, masks = structural_ids.encode(code_stream, max_length=data_params.code_max_num_tokens)
+            code_toks.append(toks)
+            code_masks.append(masks)
+    else:
+        for batch in batch_iter(codes, batch_size=100):
+            toks, masks = tokenizer.encode_tokens(batch, max_length=data_params.code_max_num_tokens)
+            code_toks.extend(toks)
+            code_masks.extend(masks)
 
     for batch in batch_iter(funcs, batch_size=100):
         toks, masks = tokenizer.encode_tokens(batch, max_length=data_params.query_max_num_tokens)
@@ -556,7 +584,29 @@ def parse_data_file_ast_tokenizer(
 
     logger.debug(f"Saved file {data_file}: language {file_language} [{df.shape}] to {pickle_file}")
 
-    return (file_language, df)
+    return (file_language, pickle_file)
+
+
+# Tokenizer reloaded once per AST worker process
+_AST_WORKER_TOKENIZERS: Dict[Tuple[int, str], TokenizerRecordable] = {}
+
+
+def _ast_worker_tokenizer(tokenizer_path: Path, special_tokens_ids: Dict[str, int]) -> TokenizerRecordable:
+    """
+    Reload tokenizer saved in tokenizer_path and add it the AST special tokens again (recordables only save their base
+    vocabulary). Special tokens must get the same ids as in the parent tokenizer so that parallel & sequential builds
+    give identical ids.
+    """
+    key = (os.getpid(), str(tokenizer_path))
+    if key not in _AST_WORKER_TOKENIZERS:
+        tokenizer = cast(TokenizerRecordable, runtime_load_recordable(tokenizer_path))
+        special_tokens = list(special_tokens_ids.keys())
+        tokenizer.add_special_tokens(special_tokens)
+        worker_ids = dict(zip(special_tokens, tokenizer.convert_tokens_to_ids(special_tokens)))
+        if worker_ids != special_tokens_ids:
+            raise ValueError(f"Tokenizer reloaded from {tokenizer_path} gives different ids to AST special tokens")
+        _AST_WORKER_TOKENIZERS[key] = tokenizer
+    return _AST_WORKER_TOKENIZERS[key]
 
 
 def load_data_from_files_ast(
@@ -565,18 +615,49 @@ def load_data_from_files_ast(
     tokenizer: TokenizerRecordable,
     ast_parser: TreeSitterParser,
     # humm that is not very nice type signature... need to create interface for that
-    parse_callback: Callable[[Path, DatasetParams, TokenizerRecordable, TreeSitterParser], Tuple[str, pd.DataFrame]],
+    parse_callback: Callable[[Path, DatasetParams, TokenizerRecordable, TreeSitterParser], Tuple[str, Path]],
+    tokenizer_path: Optional[Path] = None,
 ) -> Dict[str, pd.DataFrame]:
-    tasks_as_args = [[data_file, data_params, tokenizer, ast_parser] for data_file in data_files]
-
-    per_file_results = [parse_callback(*task_args) for task_args in tasks_as_args]  # type: ignore
+    """
+    Parse data files into per-language DataFrames.
+
+    parse_callback writes the DataFrame shard (pickle) of a file and returns (language, shard path).
+    If data_params.parallelize and tokenizer_path (tokenizer saved without its AST special tokens) are given,
+    files are parsed in a process pool, largest first: each worker reloads its own tokenizer once (adding AST special
+    tokens checked to get the same ids as in tokenizer), creates its own tree-sitter parsers and writes its shards
+    itself. Only shard paths come back from workers, shards are loaded here and DataFrames are concatenated in
+    data_files order.
+    """
+    data_files = list(data_files)
+    per_file_results: List[Tuple[str, Path]]
+    if data_params.parallelize and tokenizer_path is not None and len(data_files) > 1:
+        special_tokens = load_special_tokens(data_params)
+        special_tokens_ids = dict(zip(special_tokens, tokenizer.convert_tokens_to_ids(special_tokens)))
+        pool = ProcessPool()
+        file_ids = {data_file: i for i, data_file in enumerate(data_files)}
+
+        def cb(data_file: Path) -> Tuple[int, Tuple[str, Path]]:
+            worker_tokenizer = _ast_worker_tokenizer(tokenizer_path, special_tokens_ids)  # type: ignore
+            return file_ids[data_file], parse_callback(data_file, data_params, worker_tokenizer, ast_parser)
+
+        try:
+            results = dict(pool.uimap(cb, sort_files_by_size(data_files)))
+        finally:
+            pool.close()
+            pool.join()
+            pool.clear()
+        per_file_results = [results[i] for i in range(len(data_files))]
+    else:
+        per_file_results = [
+            parse_callback(data_file, data_params, tokenizer, ast_parser) for data_file in data_files
+        ]
 
     lang_samples_iter: Dict[str, List[pd.DataFrame]] = {}
-    for (lang, df) in per_file_results:
+    for (lang, shard_path) in per_file_results:
         if lang not in lang_samples_iter:
             lang_samples_iter[lang] = []
         dfs = lang_samples_iter[lang]
-        dfs.append(df)
+        dfs.append(pd.read_pickle(shard_path))
         lang_samples_iter[lang] = dfs
 
     lang_samples: Dict[str, pd.DataFrame] = {}
@@ -592,7 +673,8 @@ def load_data_from_dirs_ast(
     tokenizer: TokenizerRecordable,
     ast_parser: TreeSitterParser,
     data_params: DatasetParams,
-    parse_callback: Callable[[Path, DatasetParams, TokenizerRecordable, TreeSitterParser], Tuple[str, pd.DataFrame]],
+    parse_callback: Callable[[Path, DatasetParams, TokenizerRecordable, TreeSitterParser], Tuple[str, Path]],
+    tokenizer_path: Optional[Path] = None,
 ) -> Dict[str, pd.DataFrame]:
     dfs: Dict[str, pd.DataFrame] = {}
     for d in data_dirs:
@@ -604,6 +686,7 @@ def load_data_from_dirs_ast(
             tokenizer=tokenizer,
             ast_parser=ast_parser,
             parse_callback=parse_callback,
+            tokenizer_path=tokenizer_path,
         )
         df = lang_samples[lg]
 
@@ -625,11 +708,11 @@ def build_lang_dataset_ast(
 ) -> LangDatasetDF:
     def parser(
         data_file: Path, data_params: DatasetParams, tokenizer: TokenizerRecordable, parser: TreeSitterParser
-    ) -> Tuple[str, pd.DataFrame]:
-        (lang, df) = parse_data_file_ast_tokenizer(
+    ) -> Tuple[str, Path]:
+        (lang, shard_path) = parse_data_file_ast_tokenizer(
             data_file, data_params, tokenizer, parser, query_token, pickle_path / name
         )
-        return (lang, df)
+        return (lang, shard_path)
 
     loaded_samples_dfs: Dict[str, pd.DataFrame]
 
@@ -640,6 +723,12 @@ def build_lang_dataset_ast(
     logger.debug(f"Adding special tokens {len(ast_special_tokens)} {ast_special_tokens} to tokenizer")
     tokenizer.add_special_tokens(ast_special_tokens)
 
+    tokenizer_path: Optional[Path] = None
+    if data_params.parallelize:
+        # parallel workers reload tokenizer & add special tokens again instead of receiving it with each file
+        tokenizer_path = pickle_path / name / "tokenizer"
+        tokenizer.save(tokenizer_path)
+
     logger.debug(f"Building dataset {name} from {dirs}")
     loaded_samples_dfs = load_data_from_dirs_ast(
         name=name,
@@ -648,6 +737,7 @@ def build_lang_dataset_ast(
         ast_parser=ast_parser,
         data_params=data_params,
         parse_callback=parser,
+        tokenizer_path=tokenizer_path,
     )
 
     lang_weights = compute_language_weightings_df(loaded_samples_dfs, data_params.lang_ids)
@@ -672,6 +762,7 @@ def build_lang_dataset_ast(
         embedding_model=None,
         tokenizer=tokenizer,
         emb_annoy_path=Path(pickle_path) / f"{name}_embeddings.ann",
+        mmap_path=Path(pickle_path) / f"{name}_arrays" if data_params.mmap_samples else None,
     )
     logger.debug(f"Loaded {name} lang dataset [{len(dataset)} samples]")
     return dataset
@@ -9,21 +9,26 @@ import time
 
 # from torch import nn
 import numpy as np
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 from transformers import AdamW
 from pyhocon import ConfigTree
 from tokenizers import BPETokenizer
 from tokenizers.normalizers import BertNormalizer
 from tokenizers.trainers import BpeTrainer
-from sentence_transformers import SentenceTransformer
 
 from codenets.recordable import Recordable, RecordableMapping, NoneRecordable, DictRecordable
 from codenets.codesearchnet.dataset_utils import ConcatNamedDataset
 from codenets.codesearchnet.data import DatasetParams
-from codenets.codesearchnet.dataset_utils import BalancedBatchSchedulerSampler, DatasetType
+from codenets.codesearchnet.dataset_utils import (
+    BalancedBatchSchedulerSampler,
+    HardNegativeBatchSchedulerSampler,
+    DatasetType,
+    log_worker_memory,
+)
 from codenets.codesearchnet.training_ctx import CodeSearchTrainingContext, DatasetType
 from codenets.codesearchnet.tokenizer_recs import TokenizerRecordable
 from codenets.codesearchnet.training_ctx import ModelAndAdamWRecordable
+from codenets.codesearchnet.batch_transfer import PackedCollate, batch_to_device
 from codenets.utils import _to_subtoken_stream
 
 from codenets.codesearchnet.query_code_siamese.model import QueryCodeSiamese
@@ -35,7 +40,7 @@ from codenets.codesearchnet.huggingface.tokenizer_recs import (
     HuggingfaceBPETokenizerRecordable,
     build_huggingface_token_files,
 )
-from codenets.codesearchnet.code_ast.ast_utils import load_special_tokens, TreeSitterParser
+from codenets.codesearchnet.code_ast.ast_utils import ast_cache_from_params, load_special_tokens, TreeSitterParser
 
 
 class QueryCodeSiameseModelAndAdamW(ModelAndAdamWRecordable):
@@ -52,8 +57,8 @@ class QueryCodeSiameseModelAndAdamW(ModelAndAdamWRecordable):
 
     model_type = QueryCodeSiamese
 
-    def __init__(self, model: QueryCodeSiamese, optimizer: AdamW):
-        super(QueryCodeSiameseModelAndAdamW, self).__init__(model, optimizer)
+    def __init__(self, model: QueryCodeSiamese, optimizer: AdamW, scaler_state: Optional[Dict] = None):
+        super(QueryCodeSiameseModelAndAdamW, self).__init__(model, optimizer, scaler_state)
 
 
 class QueryCodeSiameseCtx(CodeSearchTrainingContext):
@@ -72,10 +77,15 @@ class QueryCodeSiameseCtx(CodeSearchTrainingContext):
         self.model = model_optimizer_rec.model
         self.model = self.model.to(device=self.device)
         self.optimizer = model_optimizer_rec.optimizer
+        self.mixed_precision.load_state_dict(model_optimizer_rec.scaler_state)
+        # scaler state is recorded with model & optimizer
+        model_optimizer_rec.mixed_precision = self.mixed_precision
         # trick to pass params to refresh params on the right device
         # as there is no function for that in pytorch
         # need to find a nicer solution...
         self.optimizer.load_state_dict(self.optimizer.state_dict())
+        self.setup_gradient_checkpointing()
+        self.build_momentum_queue()
 
     @classmethod
     def from_hocon_custom(cls: Type["QueryCodeSiameseCtx"], conf: ConfigTree) -> Mapping[str, Recordable]:
@@ -120,28 +130,27 @@ class QueryCodeSiameseCtx(CodeSearchTrainingContext):
         Returns:
             Tuple[Tensor, Tensor, Tensor]: (global loss tensor for all samples in batch, losses per sample in batch, tensor matrix of similarity scores between all samples)
         """
-        idx, languages, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, code_lang_weights = (
-            batch
-        )
-        languages = languages.to(self.device)
-        similarity = similarity.to(self.device)
-        query_tokens = query_tokens.to(self.device)
-        query_tokens_mask = query_tokens_mask.to(self.device)
-        code_tokens = code_tokens.to(self.device)
-        code_tokens_mask = code_tokens_mask.to(self.device)
-        code_lang_weights = code_lang_weights.to(self.device)
-
-        (query_embedding, code_embedding) = self.model(
-            languages=languages,
-            query_tokens=query_tokens,
-            query_tokens_mask=query_tokens_mask,
-            code_tokens=code_tokens,
-            code_tokens_mask=code_tokens_mask,
-            lang_weights=code_lang_weights,
+        # no-op if batch is already on device (see DevicePrefetcher)
+        idx, languages, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, code_lang_weights = batch_to_device(
+            batch, self.device, non_blocking=True
         )
 
+        with self.mixed_precision.autocast():
+            (query_embedding, code_embedding) = self.model(
+                languages=languages,
+                query_tokens=query_tokens,
+                query_tokens_mask=query_tokens_mask,
+                code_tokens=code_tokens,
+                code_tokens_mask=code_tokens_mask,
+                lang_weights=code_lang_weights,
+            )
+        query_embedding, code_embedding = self.mixed_precision.float_embeddings(query_embedding, code_embedding)
+        extra_negatives = None
+        if self.momentum_queue is not None and self.model.training:
+            extra_negatives = self.momentum_queue.negatives_and_enqueue(languages, code_tokens, code_tokens_mask)
+
         total_loss, similarity_scores = self.losses_scores_fn(
-            query_embedding, code_embedding, similarity, code_lang_weights
+            query_embedding, code_embedding, similarity, code_lang_weights, extra_negatives=extra_negatives
         )
         # avg_loss = torch.sum(per_sample_losses) / torch.sum(code_lang_weights)
         # logger.debug(f"total_loss {total_loss}")
@@ -149,10 +158,29 @@ class QueryCodeSiameseCtx(CodeSearchTrainingContext):
 
     def backward_optimize(self, loss: Tensor) -> Tensor:
         """Perform backward pass from loss"""
-        loss.backward()
-        self.optimizer.step()
+        self.mixed_precision.backward_optimize(loss, self.optimizer)
+        if self.momentum_queue is not None:
+            self.momentum_queue.update_model(self.model)
         return loss
 
+    def grad_cache_encode(
+        self,
+        languages: Tensor,
+        query_tokens: Tensor,
+        query_tokens_mask: Tensor,
+        code_tokens: Tensor,
+        code_tokens_mask: Tensor,
+        code_lang_weights: Tensor,
+    ) -> Tuple[Tensor, Tensor]:
+        return self.model(
+            languages=languages,
+            query_tokens=query_tokens,
+            query_tokens_mask=query_tokens_mask,
+            code_tokens=code_tokens,
+            code_tokens_mask=code_tokens_mask,
+            lang_weights=code_lang_weights,
+        )
+
     def zero_grad(self) -> bool:
         """Set all necessary elements to zero_grad"""
         self.model.zero_grad()
@@ -164,6 +192,19 @@ class QueryCodeSiameseCtx(CodeSearchTrainingContext):
     def encode_code(self, lang_id: int, code_tokens, code_tokens_mask: np.ndarray) -> np.ndarray:
         return self.model.encode_code(lang_id, code_tokens, code_tokens_mask)
 
+    def encode_dataset_codes(self, lang_id: int, dataset: Dataset) -> np.ndarray:
+        """Encode all codes of a language dataset on CPU memory (used to mine hard negatives)"""
+        was_training = self.model.training
+        self.model.eval()
+        embeddings: List[np.ndarray] = []
+        with torch.no_grad():
+            for batch in DataLoader(dataset=dataset, batch_size=self.hard_negatives_batch_size):
+                code_tokens = batch[5].to(self.device)
+                code_tokens_mask = batch[6].to(self.device)
+                embeddings.append(self.encode_code(lang_id, code_tokens, code_tokens_mask).cpu().numpy())
+        self.model.train(was_training)
+        return np.concatenate(embeddings)
+
     def tokenize_query_sentences(
         self, sentences: List[str], max_length: Optional[int] = None
     ) -> Tuple[List[np.ndarray], List[np.ndarray]]:
@@ -218,10 +259,11 @@ class QueryCodeSiameseCtx(CodeSearchTrainingContext):
             common_toks = {}
             use_ast = self.test_data_params.use_ast != "none"
 
+        # SBERT model is given by name and only loaded if query embeddings need to be built
+        self.embedding_model: Optional[str] = None
         if data_params.query_embeddings == "sbert":
             logger.info(f"Activating SBERT {dataset_type.value} Embeddings")
-            model = self.conf["embeddings.sbert.model"]
-            self.embedding_model = SentenceTransformer(model)
+            self.embedding_model = self.conf["embeddings.sbert.model"]
 
         if not use_ast:
             return build_lang_dataset_siamese_tokenizer(
@@ -247,6 +289,7 @@ class QueryCodeSiameseCtx(CodeSearchTrainingContext):
                 langs=list(data_params.lang_ids.keys()),
                 added_nodes=data_params.ast_added_nodes,
                 skip_node_types=data_params.ast_skip_node_types,
+                cache=ast_cache_from_params(data_params),
             )
 
             return build_lang_dataset_ast(
@@ -273,19 +316,47 @@ class QueryCodeSiameseCtx(CodeSearchTrainingContext):
             batch_size = self.test_batch_size
 
         collate_fn = dataset.get_collate_fn()
-        if collate_fn is not None:
+        # samples are stored in shared numpy buffers so workers don't duplicate the dataset
+        workers_params = {
+            "num_workers": self.num_workers,
+            "worker_init_fn": log_worker_memory if self.num_workers > 0 else None,
+            # batches are packed in one byte buffer pinned for a single non-blocking transfer to GPU
+            "pin_memory": self.device.type == "cuda",
+        }
+        if dataset_type == DatasetType.TRAIN and "training.hard_negatives" in self.conf:
+            logger.info("Activating hard negatives mining sampler")
+            hard_negatives_conf = self.conf["training.hard_negatives"]
+            self.hard_negatives_batch_size = hard_negatives_conf.get("batch_size", batch_size)
+            sampler = HardNegativeBatchSchedulerSampler(
+                dataset=dataset,
+                batch_size=batch_size,
+                encode_codes=self.encode_dataset_codes,
+                refresh_interval=hard_negatives_conf.get("refresh_interval", 0),
+                mixing_ratio=hard_negatives_conf.get("mixing_ratio", 0.5),
+                nb_neighbours=hard_negatives_conf.get("nb_neighbours", 8),
+                nb_trees=hard_negatives_conf.get("nb_trees", 10),
+            )
+            return DataLoader(
+                dataset=dataset, batch_size=batch_size, sampler=sampler, collate_fn=PackedCollate(collate_fn), **workers_params
+            )
+        elif collate_fn is not None:
             logger.debug("Using custom collate_fn")
             return DataLoader(
                 dataset=dataset,
                 batch_size=batch_size,
-                sampler=BalancedBatchSchedulerSampler(dataset=dataset, batch_size=batch_size),
-                collate_fn=collate_fn,
+                sampler=BalancedBatchSchedulerSampler(
+                    dataset=dataset, batch_size=batch_size, mix_languages=self.mix_languages
+                ),
+                collate_fn=PackedCollate(collate_fn),
+                **workers_params,
             )
         else:
             return DataLoader(
                 dataset=dataset,
                 batch_size=batch_size,
                 # sampler=BalancedBatchSchedulerSampler(dataset=dataset, batch_size=batch_size),
+                collate_fn=PackedCollate(),
+                **workers_params,
             )
 
     def build_tokenizers(self, from_dataset_type: DatasetType) -> bool:
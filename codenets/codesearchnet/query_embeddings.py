@@ -0,0 +1,181 @@
+"""
+Query embeddings (SBERT) stored as one L2-normalized matrix memory-mapped next to the dataset pickles.
+
+Batch similarities are computed with one gathered matmul and are numerically equivalent to
+`1 - AnnoyIndex(angular).get_distance(i, j)` used before.
+"""
+
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+import torch
+from loguru import logger
+from tqdm import tqdm
+
+
+def normalize_embeddings(embeddings: np.ndarray, eps: float = 1e-12) -> np.ndarray:
+    """L2-normalize embeddings [N x D] in float32"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, eps)
+
+
+def save_query_embeddings(path: Union[str, Path], embeddings: np.ndarray, dtype: str = "float32") -> None:
+    """Save L2-normalized query embeddings matrix [N x D] as a .npy file in dtype (float16 or float32)"""
+    matrix = normalize_embeddings(embeddings).astype(np.dtype(dtype))
+    np.save(str(path), matrix)
+    logger.debug(f"Saved query embeddings {matrix.shape} {matrix.dtype} [{matrix.nbytes} bytes] to {path}")
+
+
+def load_query_embeddings(path: Union[str, Path]) -> np.ndarray:
+    """Memory-map query embeddings matrix so that dataloader workers share the same pages"""
+    matrix = np.load(str(path), mmap_mode="r")
+    logger.debug(f"Memory-mapped query embeddings {matrix.shape} {matrix.dtype} from {path}")
+    return matrix
+
+
+def convert_annoy_query_embeddings(
+    annoy_path: Union[str, Path], path: Union[str, Path], dim: int = 768, dtype: str = "float32"
+) -> None:
+    """Convert query embeddings stored in a legacy angular AnnoyIndex into a normalized matrix"""
+    from annoy import AnnoyIndex
+
+    annoy_index = AnnoyIndex(dim, "angular")
+    annoy_index.load(str(annoy_path))
+    nb = annoy_index.get_n_items()
+    logger.info(f"Converting {nb} query embeddings from AnnoyIndex {annoy_path} to {path}")
+    embeddings = np.zeros((nb, dim), dtype=np.float32)
+    for i in range(nb):
+        embeddings[i] = annoy_index.get_item_vector(i)
+    save_query_embeddings(path, embeddings, dtype)
+
+
+def angular_similarities(embeddings: np.ndarray, indices: np.ndarray) -> torch.Tensor:
+    """
+    Compute similarity matrix [B x B] between the query embeddings at indices.
+
+    Annoy angular distance between normalized vectors is sqrt(2 - 2 cos(u, v)) and similarity was `1 - distance`.
+    """
+    batch_embs = np.asarray(embeddings[indices], dtype=np.float32)
+    cos = batch_embs @ batch_embs.T
+    distances = np.sqrt(np.clip(2.0 - 2.0 * cos, 0.0, None))
+    return torch.from_numpy(1.0 - distances)
+
+
+# SentenceTransformer models loaded by current process (one per worker)
+_SBERT_MODELS: Dict[str, Any] = {}
+
+
+def _get_sbert_model(model: Union[str, Any]) -> Any:
+    if not isinstance(model, str):
+        return model
+    if model not in _SBERT_MODELS:
+        from sentence_transformers import SentenceTransformer
+
+        _SBERT_MODELS[model] = SentenceTransformer(model)
+    return _SBERT_MODELS[model]
+
+
+def _encode_chunk(
+    model: Union[str, Any], sentences: List[str], batch_size: int, chunk_file: Path, nb_threads: int = 0
+) -> Path:
+    """Encode one chunk of sentences and write it atomically so that an interrupted build can resume"""
+    if nb_threads > 0:
+        torch.set_num_threads(nb_threads)
+    embeddings = np.stack(_get_sbert_model(model).encode(sentences, batch_size=batch_size)).astype(np.float32)
+    tmp_file = chunk_file.with_suffix(".tmp.npy")
+    np.save(str(tmp_file), embeddings)
+    os.replace(tmp_file, chunk_file)
+    return chunk_file
+
+
+def build_query_embeddings(
+    sentences: List[str],
+    path: Union[str, Path],
+    model: Union[str, Any],
+    batch_size: int = 64,
+    chunk_size: int = 10000,
+    nb_processes: int = 1,
+    dtype: str = "float32",
+) -> None:
+    """
+    Encode sentences with a SentenceTransformer into the normalized query embeddings matrix at path.
+
+    Sentences are sorted by length to reduce padding then encoded in batches, chunk by chunk.
+    Each chunk is checkpointed in `{path}.chunks` so that a killed build resumes from the last chunk.
+    With nb_processes > 1 (model given by name), chunks are encoded in parallel processes on CPU.
+    """
+    path = Path(path)
+    chunks_dir = path.with_suffix(".chunks")
+    os.makedirs(chunks_dir, exist_ok=True)
+
+    order = np.argsort([len(s) for s in sentences], kind="stable")
+    chunks = [order[i : i + chunk_size] for i in range(0, len(order), chunk_size)]
+    chunk_files = [chunks_dir / f"chunk_{i:06d}.npy" for i in range(len(chunks))]
+    todo = [i for i, chunk_file in enumerate(chunk_files) if not chunk_file.exists()]
+    logger.info(
+        f"Encoding {len(sentences)} queries in {len(chunks)} chunks ({len(chunks) - len(todo)} already done) to {path}"
+    )
+
+    start = time.time()
+    if nb_processes > 1 and isinstance(model, str) and len(todo) > 1:
+        from pathos.pools import ProcessPool
+
+        nb_threads = max(1, (os.cpu_count() or 1) // nb_processes)
+        # each task only carries the sentences of its chunk (the lambda is serialized with every task)
+        tasks = [([sentences[j] for j in chunks[i]], chunk_files[i]) for i in todo]
+        pool = ProcessPool(nodes=nb_processes)
+        try:
+            for chunk_file in pool.uimap(
+                lambda task: _encode_chunk(model, task[0], batch_size, task[1], nb_threads), tasks
+            ):
+                logger.debug(f"Encoded {chunk_file}")
+        finally:
+            pool.close()
+            pool.join()
+            # pathos keeps pools cached, it must be cleared to be restarted
+            pool.clear()
+    else:
+        for i in tqdm(todo):
+            _encode_chunk(model, [sentences[j] for j in chunks[i]], batch_size, chunk_files[i])
+    logger.info(f"Encoded {len(todo)} chunks in {time.time() - start:.2f} sec")
+
+    embeddings: Optional[np.ndarray] = None
+    for chunk, chunk_file in zip(chunks, chunk_files):
+        chunk_embs = np.load(str(chunk_file))
+        if embeddings is None:
+            embeddings = np.zeros((len(sentences), chunk_embs.shape[1]), dtype=np.float32)
+        embeddings[chunk] = chunk_embs
+    if embeddings is None:
+        raise ValueError(f"No sentence to encode into {path}")
+
+    save_query_embeddings(path, embeddings, dtype)
+    shutil.rmtree(chunks_dir)
+    if isinstance(model, str):
+        # free model from mem
+        _SBERT_MODELS.pop(model, None)
+
+
+def build_query_embeddings_annoy_index(
+    path: Union[str, Path], annoy_path: Union[str, Path], nb_trees: int = 10, nb_jobs: int = -1
+) -> None:
+    """Build an angular AnnoyIndex from the query embeddings matrix (separate pass, only needed to explore it)"""
+    from annoy import AnnoyIndex
+
+    embeddings = load_query_embeddings(path)
+    annoy_index = AnnoyIndex(embeddings.shape[1], "angular")
+    for i, emb in enumerate(tqdm(embeddings)):
+        annoy_index.add_item(i, emb.astype(np.float32))
+    start = time.time()
+    try:
+        annoy_index.build(nb_trees, n_jobs=nb_jobs)
+    except TypeError:
+        # annoy < 1.17 can't build trees in parallel
+        annoy_index.build(nb_trees)
+    logger.info(f"Built AnnoyIndex with {nb_trees} trees in {time.time() - start:.2f} sec")
+    annoy_index.save(str(annoy_path))
+    logger.info(f"Saved AnnoyIndex to {annoy_path}")
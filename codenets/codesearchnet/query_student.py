@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    query_student.py [options] OUTPUT_DIR
+
+Distill the query encoder of a trained QueryCodeSiamese model (teacher) into a much smaller query encoder (student)
+aligned on teacher embedding space, so that online query encoding is faster while codes keep being encoded (and
+indexed) by the teacher:
+- mse: student query embeddings regress teacher query embeddings,
+- contrastive: teacher training loss between student query embeddings & teacher code embeddings (in-batch negatives),
+- both: sum of both.
+
+Teacher query embeddings (and code embeddings with contrastive objectives) are computed once and cached per sample in
+float16 for all epochs. With mse, teacher code embeddings are only computed on validation batches for MRR (training
+reports loss only). The best student on validation MRR is saved into OUTPUT_DIR as a `QueryStudent` that
+`QueryStudentModel`/`use_query_student` plug in place of teacher query encoder.
+Student & teacher validation MRR/NDCG and CPU query encoding latencies are reported.
+
+Options:
+    -h --help                        Show this screen.
+    --restore DIR                    specify teacher restoration dir.
+    --objective NAME                 Distillation objective: mse, contrastive or both. [default: both]
+    --epochs N                       Number of training epochs. [default: 3]
+    --lr F                           Learning rate. [default: 0.0005]
+    --hidden_size N                  Student hidden size. [default: 128]
+    --num_hidden_layers N            Student number of layers. [default: 2]
+    --num_attention_heads N          Student number of attention heads. [default: 4]
+    --intermediate_size N            Student feed-forward size. [default: 512]
+    --nb_batches N                   Number of batches of latency benchmark. [default: 50]
+    --debug                          Enable debug routines. [default: False]
+"""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Dict, MutableMapping, Optional, Tuple, Union
+
+import torch
+import torch.nn.functional as F
+from docopt import docopt
+from dpu_utils.utils import run_and_debug
+from loguru import logger
+from torch import Tensor, nn
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from transformers import AdamW, BertConfig, BertModel
+
+from codenets.codesearchnet.batch_transfer import batch_to_device
+from codenets.codesearchnet.dataset_utils import DatasetType
+from codenets.codesearchnet.huggingface.models import PreTrainedModelRecordable
+from codenets.codesearchnet.poolers import MeanWeightedPooler
+from codenets.codesearchnet.torchscript_export import benchmark, random_tokens, vocab_size
+from codenets.codesearchnet.training_ctx import (
+    BatchLoss,
+    BatchSize,
+    CodeSearchTrainingContext,
+    TotalLoss,
+    TotalMrr,
+    TotalNdcg,
+    TotalSize,
+    compute_loss_mrr_ndcg,
+)
+from codenets.recordable import (
+    Recordable,
+    RecordableTorchModule,
+    runtime_load_recordable_mapping,
+    save_recordable_mapping,
+)
+from codenets.utils import full_classname, instance_full_classname
+
+OBJECTIVES = ["mse", "contrastive", "both"]
+# teacher embeddings cache dtype (half the memory of float32, precise enough as distillation targets)
+CACHE_DTYPE = torch.float16
+
+
+class QueryStudent(RecordableTorchModule):
+    """
+    Lightweight query encoder: a small BERT encoder and a pooler projected into teacher embedding space.
+    It is recorded as a whole (default RecordableTorchModule save).
+    """
+
+    def __init__(self, encoder: RecordableTorchModule, pooler: RecordableTorchModule, projection: nn.Module):
+        super(QueryStudent, self).__init__()
+        self.encoder = encoder
+        self.pooler = pooler
+        self.projection = projection
+
+    @classmethod
+    def build(
+        cls,
+        vocab_size: int,
+        embedding_size: int,
+        max_length: int,
+        hidden_size: int = 128,
+        num_hidden_layers: int = 2,
+        num_attention_heads: int = 4,
+        intermediate_size: int = 512,
+    ) -> QueryStudent:
+        bert_config = BertConfig(
+            vocab_size=vocab_size,
+            hidden_size=hidden_size,
+            num_hidden_layers=num_hidden_layers,
+            num_attention_heads=num_attention_heads,
+            intermediate_size=intermediate_size,
+            max_position_embeddings=max(max_length, 64),
+        )
+        return cls(
+            encoder=PreTrainedModelRecordable(BertModel(bert_config)),
+            pooler=MeanWeightedPooler(input_size=hidden_size),
+            projection=nn.Linear(hidden_size, embedding_size),
+        )
+
+    def forward(self, query_tokens: Tensor, query_tokens_mask: Tensor) -> Tensor:  # type: ignore
+        return self.encode_query(query_tokens, query_tokens_mask)
+
+    def encode_query(self, query_tokens: Tensor, query_tokens_mask: Tensor) -> Tensor:
+        query_seq_outputs = self.encoder(query_tokens, query_tokens_mask)
+        return self.projection(self.pooler(query_seq_outputs[0], query_tokens_mask))
+
+
+class QueryStudentModel(RecordableTorchModule):
+    """Drop-in code search model encoding queries with a distilled QueryStudent and codes with the teacher model"""
+
+    def __init__(self, model: RecordableTorchModule, query_student: QueryStudent):
+        super(QueryStudentModel, self).__init__()
+        self.model = model
+        self.query_student = query_student
+
+    def save(self, output_dir: Union[Path, str]) -> bool:
+        d = Path(output_dir) / instance_full_classname(self)
+        records: MutableMapping[str, Recordable] = {"model": self.model, "query_student": self.query_student}
+        return save_recordable_mapping(output_dir=d, records=records)
+
+    @classmethod
+    def load(cls, restore_dir: Union[Path, str]) -> QueryStudentModel:
+        d = Path(restore_dir) / full_classname(cls)
+        records = runtime_load_recordable_mapping(d)
+        return cls(**records)
+
+    def forward(  # type: ignore
+        self,
+        languages: Tensor,
+        query_tokens: Tensor,
+        query_tokens_mask: Tensor,
+        code_tokens: Tensor,
+        code_tokens_mask: Tensor,
+        **kwargs,
+    ) -> Tuple[Tensor, Tensor]:
+        if hasattr(self.model, "encode_codes"):
+            code_embeddings = self.model.encode_codes(languages, code_tokens, code_tokens_mask)
+        else:
+            code_embeddings = self.model.encode_code(int(languages[0].item()), code_tokens, code_tokens_mask)
+        return self.encode_query(query_tokens, query_tokens_mask), code_embeddings
+
+    def encode_query(self, query_tokens: Tensor, query_tokens_mask: Tensor) -> Tensor:
+        return self.query_student.encode_query(query_tokens, query_tokens_mask)
+
+    def encode_code(self, lang_id: int, code_tokens: Tensor, code_tokens_mask: Tensor) -> Tensor:
+        return self.model.encode_code(lang_id, code_tokens, code_tokens_mask)
+
+
+def use_query_student(
+    training_ctx: CodeSearchTrainingContext, student_dir: Union[Path, str]
+) -> CodeSearchTrainingContext:
+    """
+    Replace query encoder of training context model by a QueryStudent saved in student_dir
+    Please note that IT MUTATES training_ctx
+    """
+    query_student = QueryStudent.load(student_dir).to(training_ctx.device)
+    training_ctx.model = QueryStudentModel(training_ctx.model, query_student)
+    logger.info(f"Encoding queries with student from {student_dir}")
+    return training_ctx
+
+
+class QueryDistillationCtx:
+    """
+    Training context distilling query encoder of a teacher training context into a QueryStudent.
+    Teacher embeddings are cached per (language, sample index) of each dataset type (code embeddings only with
+    contrastive objectives).
+    """
+
+    def __init__(
+        self,
+        teacher_ctx: CodeSearchTrainingContext,
+        student: QueryStudent,
+        objective: str = "both",
+        lr: float = 0.0005,
+    ):
+        if objective not in OBJECTIVES:
+            raise ValueError(f"objective can be {OBJECTIVES}")
+        self.teacher_ctx = teacher_ctx
+        self.device = teacher_ctx.device
+        self.student = student.to(self.device)
+        self.objective = objective
+        self.cache_codes = objective in ["contrastive", "both"]
+        self.optimizer = AdamW(self.student.parameters(), lr=lr, correct_bias=False)
+        # (dataset type, lang_id) => (query embeddings, optional code embeddings, cached flags) on CPU
+        self.teacher_cache: Dict[Tuple[DatasetType, int], Tuple[Tensor, Optional[Tensor], Tensor]] = {}
+
+    @torch.no_grad()
+    def teacher_embeddings(
+        self, dataset_type: DatasetType, dataloader: DataLoader, batch: Tuple[Tensor, ...], with_code: bool
+    ) -> Tuple[Tensor, Optional[Tensor]]:
+        """
+        Teacher (query, code) embeddings of batch samples, query (and code with contrastive objectives) embeddings
+        being computed once & cached. Without cached codes, code embeddings are computed only if with_code.
+        """
+        idx, languages, _, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, _ = batch
+        teacher = self.teacher_ctx.model
+        teacher.eval()
+        query_embeddings: Optional[Tensor] = None
+        code_embeddings: Optional[Tensor] = None
+        idx = idx.view(-1).cpu()
+        languages = languages.view(-1).cpu()
+        for lang_id in languages.unique().tolist():
+            in_lang = (languages == lang_id).nonzero().view(-1)
+            sample_idx = idx[in_lang]
+            key = (dataset_type, lang_id)
+            if key not in self.teacher_cache:
+                nb = len(dataloader.dataset.get_dataset_by_lang_id(lang_id))
+                dim = teacher.encode_query(query_tokens[:1], query_tokens_mask[:1]).shape[-1]
+                self.teacher_cache[key] = (
+                    torch.zeros(nb, dim, dtype=CACHE_DTYPE),
+                    torch.zeros(nb, dim, dtype=CACHE_DTYPE) if self.cache_codes else None,
+                    torch.zeros(nb, dtype=torch.bool),
+                )
+            cached_query, cached_code, cached = self.teacher_cache[key]
+            missing = in_lang[~cached[sample_idx]]
+            if len(missing) > 0:
+                on_device = missing.to(self.device)
+                missing_idx = idx[missing]
+                cached_query[missing_idx] = (
+                    teacher.encode_query(query_tokens[on_device], query_tokens_mask[on_device]).to(CACHE_DTYPE).cpu()
+                )
+                if cached_code is not None:
+                    cached_code[missing_idx] = (
+                        teacher.encode_code(lang_id, code_tokens[on_device], code_tokens_mask[on_device])
+                        .to(CACHE_DTYPE)
+                        .cpu()
+                    )
+                cached[missing_idx] = True
+
+            lang_query = cached_query[sample_idx].float()
+            lang_code: Optional[Tensor] = None
+            if cached_code is not None:
+                lang_code = cached_code[sample_idx].float()
+            elif with_code:
+                on_device = in_lang.to(self.device)
+                lang_code = (
+                    teacher.encode_code(lang_id, code_tokens[on_device], code_tokens_mask[on_device]).float().cpu()
+                )
+
+            if query_embeddings is None:
+                query_embeddings = torch.zeros(len(idx), lang_query.shape[1])
+            query_embeddings[in_lang] = lang_query
+            if lang_code is not None:
+                if code_embeddings is None:
+                    code_embeddings = torch.zeros(len(idx), lang_code.shape[1])
+                code_embeddings[in_lang] = lang_code
+        assert query_embeddings is not None
+        return (
+            query_embeddings.to(self.device),
+            code_embeddings.to(self.device) if code_embeddings is not None else None,
+        )
+
+    def distillation_loss(
+        self,
+        student_query: Tensor,
+        teacher_query: Tensor,
+        teacher_code: Optional[Tensor],
+        similarity: Tensor,
+        weights: Tensor,
+    ) -> Tensor:
+        loss = torch.zeros((), device=self.device)
+        if self.objective in ["mse", "both"]:
+            loss = loss + F.mse_loss(student_query, teacher_query)
+        # teacher codes are always there with contrastive objectives (cached)
+        if self.objective in ["contrastive", "both"] and teacher_code is not None:
+            contrastive_loss, _ = self.teacher_ctx.losses_scores_fn(student_query, teacher_code, similarity, weights)
+            loss = loss + contrastive_loss
+        return loss
+
+    def run_epoch(self, dataset_type: DatasetType, dataloader: DataLoader, is_train: bool) -> Dict[str, float]:
+        """Train (or evaluate) student for one epoch and return losses, student & teacher MRR/NDCG"""
+        self.student.train(is_train)
+        totals = {
+            name: (TotalLoss(0.0), TotalMrr(0.0), TotalNdcg(0.0), TotalSize(0)) for name in ["student", "teacher"]
+        }
+        averages: Dict[str, float] = {}
+        with torch.set_grad_enabled(is_train), tqdm(total=len(dataloader)) as t_batch:
+            for batch in dataloader:
+                batch = batch_to_device(batch, self.device, non_blocking=True)
+                _, _, similarity, query_tokens, query_tokens_mask, _, _, weights = batch
+                # with mse, teacher codes are only needed for MRR, not computed during training
+                teacher_query, teacher_code = self.teacher_embeddings(
+                    dataset_type, dataloader, batch, with_code=not is_train
+                )
+                student_query = self.student.encode_query(query_tokens, query_tokens_mask)
+                loss = self.distillation_loss(student_query, teacher_query, teacher_code, similarity, weights)
+                if is_train:
+                    loss.backward()
+                    self.optimizer.step()
+                    self.optimizer.zero_grad()
+
+                batch_size = BatchSize(query_tokens.size()[0])
+                if teacher_code is None:
+                    total_loss, total_mrr, total_ndcg, total_size = totals["student"]
+                    total_size = TotalSize(total_size + batch_size)
+                    total_loss = TotalLoss(total_loss + loss.item() * batch_size)
+                    totals["student"] = (total_loss, total_mrr, total_ndcg, total_size)
+                    averages["student_loss"] = total_loss / total_size
+                    t_batch.set_postfix({"loss": f"{averages['student_loss']:10}"})
+                    t_batch.update(1)
+                    continue
+                with torch.no_grad():
+                    for name, query in [("student", student_query.detach()), ("teacher", teacher_query)]:
+                        batch_loss, scores = self.teacher_ctx.losses_scores_fn(query, teacher_code, similarity, weights)
+                        if name == "student":
+                            batch_loss = loss.detach()
+                        total_loss, total_mrr, total_ndcg, total_size = totals[name]
+                        (total_loss, avg_loss, total_mrr, avg_mrr, total_ndcg, avg_ndcg, total_size) = (
+                            compute_loss_mrr_ndcg(
+                                batch,
+                                scores,
+                                BatchLoss(batch_loss.item()),
+                                batch_size,
+                                total_loss,
+                                total_mrr,
+                                total_ndcg,
+                                total_size,
+                                self.device,
+                            )
+                        )
+                        totals[name] = (total_loss, total_mrr, total_ndcg, total_size)
+                        averages.update(
+                            {f"{name}_loss": avg_loss, f"{name}_mrr": avg_mrr, f"{name}_ndcg": avg_ndcg}
+                        )
+                t_batch.set_postfix({"loss": f"{averages['student_loss']:10}", "mrr": f"{averages['student_mrr']:6}"})
+                t_batch.update(1)
+        return averages
+
+
+def run(args, tag_in_vcs=False) -> None:
+    os.environ["WANDB_MODE"] = "dryrun"
+
+    output_dir = Path(args["OUTPUT_DIR"])
+    os.makedirs(output_dir, exist_ok=True)
+
+    restore_dir = args["--restore"]
+    logger.info(f"Restoring Teacher Training Context from directory {restore_dir}")
+    teacher_ctx = CodeSearchTrainingContext.build_context_from_dir(restore_dir)
+    teacher = teacher_ctx.model
+    teacher.eval()
+
+    query_max_length = teacher_ctx.train_data_params.query_max_num_tokens
+    query_inputs = [t.to(teacher_ctx.device) for t in random_tokens(1, query_max_length, vocab_size(teacher))]
+    with torch.no_grad():
+        embedding_size = teacher.encode_query(*query_inputs).shape[-1]
+    student = QueryStudent.build(
+        vocab_size=vocab_size(teacher),
+        embedding_size=embedding_size,
+        max_length=query_max_length,
+        hidden_size=int(args["--hidden_size"]),
+        num_hidden_layers=int(args["--num_hidden_layers"]),
+        num_attention_heads=int(args["--num_attention_heads"]),
+        intermediate_size=int(args["--intermediate_size"]),
+    )
+    nb_student_params = sum(p.numel() for p in student.parameters())
+    nb_teacher_params = sum(p.numel() for p in teacher.parameters())
+    logger.info(f"Student has {nb_student_params} parameters (teacher model {nb_teacher_params})")
+
+    distillation_ctx = QueryDistillationCtx(teacher_ctx, student, objective=args["--objective"], lr=float(args["--lr"]))
+    train_dataloader = teacher_ctx.build_lang_dataloader(DatasetType.TRAIN)
+    val_dataloader = teacher_ctx.build_lang_dataloader(DatasetType.VAL)
+
+    best_mrr: Optional[float] = None
+    for epoch in range(int(args["--epochs"])):
+        train_results = distillation_ctx.run_epoch(DatasetType.TRAIN, train_dataloader, is_train=True)
+        val_results = distillation_ctx.run_epoch(DatasetType.VAL, val_dataloader, is_train=False)
+        logger.info(f"epoch {epoch} train {train_results}")
+        logger.info(f"epoch {epoch} val {val_results}")
+        if best_mrr is None or val_results["student_mrr"] > best_mrr:
+            best_mrr = val_results["student_mrr"]
+            student.save(output_dir)
+            logger.info(f"New best student MRR:{best_mrr} (teacher MRR:{val_results['teacher_mrr']}) saved")
+
+    # online latency is measured on CPU
+    student = QueryStudent.load(output_dir).cpu().eval()
+    teacher = teacher.cpu()
+    nb_batches = int(args["--nb_batches"])
+    with torch.no_grad():
+        for batch_size in [1, 32]:
+            inputs = random_tokens(batch_size, query_max_length, vocab_size(teacher))
+            teacher_t = benchmark(
+                f"teacher query encoder [B={batch_size}]", lambda: teacher.encode_query(*inputs), nb_batches
+            )
+            student_t = benchmark(
+                f"student query encoder [B={batch_size}]", lambda: student.encode_query(*inputs), nb_batches
+            )
+            logger.info(f"=> query encoding latency speedup x{teacher_t / student_t:.2f} [B={batch_size}]")
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    run_and_debug(lambda: run(args), args["--debug"])
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    repo_index.py [options] REPO_DIR OUTPUT_DIR
+
+Index a local source repository for code search with a trained model:
+- walk REPO_DIR and detect languages by file extension,
+- extract function/method definitions with tree-sitter in a process pool,
+- encode them with the model code encoder and build an AnnoyIndex per language.
+
+OUTPUT_DIR receives per language the same columnar definitions as predictions use (`{lang}_definitions.pkl` with
+identifier, url & function_tokens columns), code embeddings (`{lang}_code_embeddings.npy`) and `{lang}_index.ann`.
+
+Options:
+    -h --help                        Show this screen.
+    --restore DIR                    specify restoration dir.
+    --nb_processes N                 Number of processes extracting definitions (0 for all CPUs). [default: 0]
+    --files_per_task N               Number of files parsed per process task. [default: 256]
+    --max_file_size N                Skip bigger files (generated, minified...) in bytes. [default: 1000000]
+    --batch_length N                 Number of definitions encoded per batch. [default: 512]
+    --nb_trees N                     Number of trees of AnnoyIndex. [default: 10]
+    --debug                          Enable debug routines. [default: False]
+"""
+
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+from docopt import docopt
+from dpu_utils.utils import run_and_debug
+from loguru import logger
+from pathos.pools import ProcessPool
+
+from codenets.codesearchnet.code_ast.ast_utils import TreeSitterParser
+from codenets.codesearchnet.predictions import build_code_index, encode_code_tokens
+from codenets.codesearchnet.training_ctx import CodeSearchTrainingContext
+from codenets.utils import sort_files_by_size
+
+EXTENSION_LANGUAGES: Dict[str, str] = {
+    ".go": "go",
+    ".java": "java",
+    ".js": "javascript",
+    ".jsx": "javascript",
+    ".mjs": "javascript",
+    ".py": "python",
+    ".php": "php",
+    ".rb": "ruby",
+}
+
+SKIPPED_DIRS = {"node_modules", "vendor", "__pycache__", "build", "dist", "venv"}
+
+# (file path, identifier, start line, function tokens)
+Definition = Tuple[str, str, int, List[str]]
+
+
+def walk_source_files(repo_dir: Path, languages: List[str], max_file_size: int) -> List[Tuple[Path, str]]:
+    """Source files of repo_dir in languages (hidden & dependencies directories are skipped)"""
+    files: List[Tuple[Path, str]] = []
+    for root, dirs, filenames in os.walk(repo_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and d not in SKIPPED_DIRS]
+        for filename in filenames:
+            lang = EXTENSION_LANGUAGES.get(os.path.splitext(filename)[1])
+            if lang is None or lang not in languages:
+                continue
+            path = Path(root) / filename
+            if os.path.getsize(path) <= max_file_size:
+                files.append((path, lang))
+    return files
+
+
+def extract_files_definitions(files: List[Tuple[Path, str]], parser: TreeSitterParser) -> List[Definition]:
+    """Extract definitions of a batch of files (tree-sitter parsers are created once per process)"""
+    definitions: List[Definition] = []
+    for path, lang in files:
+        try:
+            with open(path, "rb") as f:
+                source = f.read()
+            for (identifier, line, tokens) in parser.extract_definitions(lang, source):
+                definitions.append((str(path), identifier, line, tokens))
+        except Exception as e:
+            logger.warning(f"Skipping {path}: {e}")
+    return definitions
+
+
+def extract_repo_definitions(
+    repo_dir: Path,
+    languages: List[str],
+    nb_processes: int = 0,
+    files_per_task: int = 256,
+    max_file_size: int = 1000000,
+) -> Dict[str, pd.DataFrame]:
+    """Extract definitions of all source files of repo_dir into a definitions DataFrame per language"""
+    start = time.time()
+    files = walk_source_files(repo_dir, languages, max_file_size)
+    file_langs = {str(path): lang for path, lang in files}
+    logger.info(f"Found {len(files)} source files in {repo_dir}")
+
+    # files are parsed by batches of files to amortize inter-process transfers, largest files being dealt
+    # round-robin so that every batch gets a similar share of large & small files to balance workers
+    files_by_size = [(path, file_langs[str(path)]) for path in sort_files_by_size([path for path, _ in files])]
+    nb_tasks = -(-len(files_by_size) // files_per_task)
+    tasks = [files_by_size[i::nb_tasks] for i in range(nb_tasks)]
+    parser = TreeSitterParser(langs=languages, added_nodes={}, skip_node_types={})
+
+    definitions: List[Definition] = []
+    if len(tasks) > 1 and nb_processes != 1:
+        pool = ProcessPool(nodes=nb_processes) if nb_processes > 1 else ProcessPool()
+        try:
+            for task_definitions in pool.uimap(lambda task: extract_files_definitions(task, parser), tasks):
+                definitions.extend(task_definitions)
+        finally:
+            pool.close()
+            pool.join()
+            pool.clear()
+    else:
+        for task in tasks:
+            definitions.extend(extract_files_definitions(task, parser))
+    logger.info(f"Extracted {len(definitions)} definitions in {time.time() - start:.2f} sec")
+
+    return definitions_dataframes(definitions, file_langs, repo_dir)
+
+
+def definitions_dataframes(
+    definitions: List[Definition], file_langs: Dict[str, str], repo_dir: Path
+) -> Dict[str, pd.DataFrame]:
+    """Columnar definitions (identifier, url, function_tokens) per language, urls being `relative path#Lline`"""
+    lang_definitions: Dict[str, pd.DataFrame] = {}
+    if len(definitions) == 0:
+        return lang_definitions
+    df = pd.DataFrame(
+        {
+            "language": [file_langs[path] for (path, _, _, _) in definitions],
+            "identifier": [identifier for (_, identifier, _, _) in definitions],
+            "url": [f"{os.path.relpath(path, repo_dir)}#L{line}" for (path, _, line, _) in definitions],
+            "function_tokens": [tokens for (_, _, _, tokens) in definitions],
+        }
+    )
+    # stable order whatever the processes scheduling
+    df = df.sort_values("url", kind="mergesort").reset_index(drop=True)
+    for lang, lang_df in df.groupby("language"):
+        lang_definitions[lang] = lang_df.drop(columns=["language"]).reset_index(drop=True)
+    return lang_definitions
+
+
+def encode_definitions(
+    training_ctx: CodeSearchTrainingContext,
+    language: str,
+    definitions_df: pd.DataFrame,
+    batch_length: int = 512,
+    lang_token: str = "<lg>",
+) -> np.ndarray:
+    """Encode definitions function tokens (prefixed by language & lang token) into float32 embeddings"""
+    return encode_code_tokens(
+        training_ctx,
+        training_ctx.train_data_params.lang_ids[language],
+        ([language, lang_token] + tokens for tokens in definitions_df["function_tokens"]),
+        batch_length=batch_length,
+    ).astype(np.float32)
+
+
+def run(args, tag_in_vcs=False) -> None:
+    os.environ["WANDB_MODE"] = "dryrun"
+
+    repo_dir = Path(args["REPO_DIR"])
+    output_dir = Path(args["OUTPUT_DIR"])
+    os.makedirs(output_dir, exist_ok=True)
+
+    restore_dir = args["--restore"]
+    logger.info(f"Restoring Training Context from directory {restore_dir}")
+    training_ctx = CodeSearchTrainingContext.build_context_from_dir(restore_dir)
+    lang_ids = training_ctx.train_data_params.lang_ids
+
+    lang_definitions = extract_repo_definitions(
+        repo_dir,
+        languages=list(lang_ids.keys()),
+        nb_processes=int(args["--nb_processes"]),
+        files_per_task=int(args["--files_per_task"]),
+        max_file_size=int(args["--max_file_size"]),
+    )
+
+    training_ctx.eval_mode()
+    with torch.no_grad():
+        for language, definitions_df in lang_definitions.items():
+            logger.info(f"Encoding {len(definitions_df)} {language} definitions")
+            definitions_df.to_pickle(output_dir / f"{language}_definitions.pkl")
+
+            start = time.time()
+            code_embeddings = encode_definitions(
+                training_ctx, language, definitions_df, batch_length=int(args["--batch_length"])
+            )
+            logger.info(f"Encoded {language} definitions in {time.time() - start:.2f} sec")
+            np.save(str(output_dir / f"{language}_code_embeddings.npy"), code_embeddings)
+
+            indices = build_code_index(code_embeddings, nb_trees=int(args["--nb_trees"]))
+            indices.save(str(output_dir / f"{language}_index.ann"))
+            logger.info(f"Saved {language} index to {output_dir}")
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    run_and_debug(lambda: run(args), args["--debug"])
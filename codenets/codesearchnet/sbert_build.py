@@ -18,6 +18,9 @@ azure://semanticcodesearch/csharpdata/split/csharpCrawl-train
 Options:
     -h --help                        Show this screen.
     --config FILE                    Specify HOCON config file.
+    --annoy                          Build AnnoyIndex of val query embeddings in a separate pass. [default: False]
+    --nb_trees N                     Number of trees of AnnoyIndex. [default: 10]
+    --nb_jobs N                      Number of threads building AnnoyIndex (annoy>=1.17, -1 for all). [default: -1]
     --debug                          Enable debug routines. [default: False]
 """
 
@@ -45,6 +48,7 @@ from codenets.codesearchnet.dataset_utils import BalancedBatchSchedulerSampler,
 from codenets.codesearchnet.data import DatasetParams
 from codenets.codesearchnet.training_ctx import CodeSearchTrainingContext
 from codenets.codesearchnet.query_code_siamese.dataset import load_data_from_dirs
+from codenets.codesearchnet.query_embeddings import build_query_embeddings_annoy_index
 
 """Evaluating SBert."""
 
@@ -85,19 +89,11 @@ def run(args, tag_in_vcs=False) -> None:
 
     # z = df.iloc[0][0]
     # print("z", z.shape)
-    from annoy import AnnoyIndex
-
-    t = AnnoyIndex(768, "angular")
-    # for index, row in df.iterrows():
-    #     print(row.shape)
-    #     t.add_item(index, row[0])
-    # t.build(10)  # 10 trees
-    # t.save("./pickles/train_qc_30k_embeddings.ann")
-
-    t.load("./pickles/val_qc_30k_embeddings.ann")
-
-    # for i in range(0, 100):
-    #     print(i, 99, 1.0 - t.get_distance(i, 99))
+    if args["--annoy"]:
+        emb_path = training_ctx.pickle_path / f"val_{training_ctx.training_tokenizer_type}_embeddings.npy"
+        build_query_embeddings_annoy_index(
+            emb_path, emb_path.with_suffix(".ann"), nb_trees=int(args["--nb_trees"]), nb_jobs=int(args["--nb_jobs"])
+        )
 
     for batch in val_dataloader:  # itertools.islice(val_dataloader, 0, 1000):
         indices, languages, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, code_lang_weights = (
@@ -21,6 +21,23 @@ from codenets.codesearchnet.data import DatasetParams
 from codenets.codesearchnet.copied_code.metadata import Metadata, append_metadata, build_tokenizer_metadata
 
 
+# masks only contain 0/1
+MASK_DTYPE = np.uint8
+
+
+def ids_dtype(vocab_size: int) -> np.dtype:
+    """
+    Smallest dtype holding token ids of a vocabulary.
+    int16 is preferred to uint16 when possible as pytorch has no uint16 tensors.
+    """
+    if vocab_size <= np.iinfo(np.int16).max + 1:
+        return np.dtype(np.int16)
+    elif vocab_size <= np.iinfo(np.uint16).max + 1:
+        return np.dtype(np.uint16)
+    else:
+        return np.dtype(np.int32)
+
+
 class TokenizerRecordable(ABC, Recordable):
     @abstractmethod
     def tokenize(self, text: str, **kwargs) -> List[str]:
@@ -66,6 +83,10 @@ class TokenizerRecordable(ABC, Recordable):
     def add_special_tokens(self, special_tokens: List[str]) -> bool:
         pass
 
+    def ids_dtype(self) -> np.dtype:
+        """Dtype of encoded token ids (widened to long only at embedding lookup)"""
+        return np.dtype(np.int32)
+
 
 class BpeVocabularyTokenizerRecordable(TokenizerRecordable):
     def __init__(self, vocab: BpeVocabulary):
@@ -115,15 +136,9 @@ class BpeVocabularyTokenizerRecordable(TokenizerRecordable):
             token_idss = list(self.vocab.transform(tokens, fixed_length=max_length))
         else:
             token_idss = list(self.vocab.transform(tokens, fixed_length=None))
-        # token_mask = np.array([1 if token_ids[i] > 0 else 0 for i in range(len(token_ids))])
-        token_masks = []
-        for i in range(len(token_idss)):
-            token_masks.append([1 if token_idss[i][j] > 0 else 0 for j in range(len(token_idss[i]))])
-        # np.array(
-        #     [[1 if token_idss[i][j] > 0 else 0 for j in range(len(token_idss[i]))] for i in range(len(token_idss))]
-        # )
-        token_masks = [np.array(m) for m in token_masks]
-        token_idss = [np.array(e) for e in token_idss]
+        dtype = self.ids_dtype()
+        token_idss = [np.array(e, dtype=dtype) for e in token_idss]
+        token_masks = [(e > 0).astype(MASK_DTYPE) for e in token_idss]
 
         return token_idss, token_masks
 
@@ -137,6 +152,11 @@ class BpeVocabularyTokenizerRecordable(TokenizerRecordable):
         self.vocab.add_special_tokens(special_tokens)
         return True
 
+    def ids_dtype(self) -> np.dtype:
+        # bpe ids start at word_vocab_size (not at len(word_vocab)) so dtype is sized on the largest id
+        max_id = max(list(self.vocab.word_vocab.values()) + list(self.vocab.bpe_vocab.values()), default=0)
+        return ids_dtype(max(self.vocab.vocab_size, max_id + 1))
+
 
 def build_most_common_tokens(
     data_dirs: List[Path],
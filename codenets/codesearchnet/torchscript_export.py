@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    torchscript_export.py [options] OUTPUT_DIR
+
+Export query & code encoders (encoder + pooler, one code branch per language for multi-branch models) of a trained
+model as standalone TorchScript artifacts for CPU serving, then check them against the eager model & benchmark both.
+
+Serving only needs OUTPUT_DIR and torch (see `TorchScriptEncoders`), tokens being padded to exported lengths.
+
+Options:
+    -h --help                        Show this screen.
+    --restore DIR                    specify restoration dir.
+    --batch_size N                   Batch size of validation & benchmark. [default: 32]
+    --nb_batches N                   Number of benchmarked batches. [default: 20]
+    --nb_threads N                   Number of CPU threads (0 for torch default). [default: 0]
+    --atol F                         Max absolute difference tolerated with eager model. [default: 1e-4]
+    --debug                          Enable debug routines. [default: False]
+"""
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Union
+
+import numpy as np
+import torch
+from docopt import docopt
+from dpu_utils.utils import run_and_debug
+from loguru import logger
+from torch import nn
+
+from codenets.codesearchnet.training_ctx import CodeSearchTrainingContext
+
+
+class QueryEncoderModule(nn.Module):
+    """Traceable query branch of a code search model"""
+
+    def __init__(self, model: nn.Module):
+        super(QueryEncoderModule, self).__init__()
+        self.model = model
+
+    def forward(self, tokens: torch.Tensor, tokens_mask: torch.Tensor) -> torch.Tensor:  # type: ignore
+        return self.model.encode_query(tokens, tokens_mask)
+
+
+class CodeEncoderModule(nn.Module):
+    """Traceable code branch of a code search model for one language"""
+
+    def __init__(self, model: nn.Module, lang_id: int):
+        super(CodeEncoderModule, self).__init__()
+        self.model = model
+        self.lang_id = lang_id
+
+    def forward(self, tokens: torch.Tensor, tokens_mask: torch.Tensor) -> torch.Tensor:  # type: ignore
+        return self.model.encode_code(self.lang_id, tokens, tokens_mask)
+
+
+def vocab_size(model: nn.Module) -> int:
+    """Smallest word embeddings size of model encoders (random valid token ids are drawn below it)"""
+    sizes = [m.num_embeddings for n, m in model.named_modules() if n.endswith("word_embeddings")]
+    if len(sizes) == 0:
+        sizes = [m.num_embeddings for m in model.modules() if isinstance(m, nn.Embedding)]
+    return min(sizes)
+
+
+def random_tokens(batch_size: int, max_length: int, vocab: int, seed: int = 0) -> List[torch.Tensor]:
+    """Random token ids & masks (with random lengths) of shape [B x max_length]"""
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(1, max_length + 1, size=batch_size)
+    mask = (np.arange(max_length)[None, :] < lengths[:, None]).astype(np.int64)
+    tokens = rng.randint(1, vocab, size=(batch_size, max_length)) * mask
+    return [torch.from_numpy(tokens), torch.from_numpy(mask)]
+
+
+def export_torchscript(
+    training_ctx: CodeSearchTrainingContext, output_dir: Path, batch_size: int = 8
+) -> Dict[str, Union[str, int, Dict[str, str]]]:
+    """Trace encoders on CPU into output_dir and write a `torchscript.json` description of artifacts"""
+    os.makedirs(output_dir, exist_ok=True)
+    model = training_ctx.model.cpu().eval()
+    query_max_length = training_ctx.conf["dataset.common_params.query_max_num_tokens"]
+    code_max_length = training_ctx.conf["dataset.common_params.code_max_num_tokens"]
+    vocab = vocab_size(model)
+    lang_ids: Dict[str, int] = training_ctx.train_data_params.lang_ids
+
+    with torch.no_grad():
+        query_inputs = random_tokens(batch_size, query_max_length, vocab)
+        traced = torch.jit.trace(QueryEncoderModule(model), query_inputs)
+        traced.save(str(output_dir / "query.pt"))
+        embedding_size = traced(*query_inputs).shape[-1]
+        logger.info(f"Exported query encoder to {output_dir / 'query.pt'}")
+
+        code_inputs = random_tokens(batch_size, code_max_length, vocab, seed=1)
+        code_files: Dict[str, str] = {}
+        # multi-branch models have one code encoder per language, others share one code encoder
+        per_language = hasattr(model, "code_encoders")
+        for language, lang_id in lang_ids.items():
+            code_file = f"code_{language}.pt" if per_language else "code.pt"
+            if code_file not in code_files.values():
+                traced = torch.jit.trace(CodeEncoderModule(model, lang_id), code_inputs)
+                traced.save(str(output_dir / code_file))
+                logger.info(f"Exported {language} code encoder to {output_dir / code_file}")
+            code_files[language] = code_file
+
+    description: Dict[str, Union[str, int, Dict[str, str]]] = {
+        "query": "query.pt",
+        "code": code_files,
+        "query_max_length": query_max_length,
+        "code_max_length": code_max_length,
+        "embedding_size": int(embedding_size),
+    }
+    with open(output_dir / "torchscript.json", "w") as f:
+        json.dump(description, f, indent=2)
+    training_ctx.model.to(training_ctx.device)
+    return description
+
+
+class TorchScriptEncoders:
+    """Standalone CPU encoders loaded from TorchScript artifacts (no training context, config or transformers)"""
+
+    def __init__(self, export_dir: Union[str, Path], nb_threads: int = 0):
+        export_dir = Path(export_dir)
+        if nb_threads > 0:
+            torch.set_num_threads(nb_threads)
+        with open(export_dir / "torchscript.json", "r") as f:
+            self.description = json.load(f)
+        self.query_max_length: int = self.description["query_max_length"]
+        self.code_max_length: int = self.description["code_max_length"]
+        self.query_encoder = torch.jit.load(str(export_dir / self.description["query"]), map_location="cpu")
+        modules: Dict[str, torch.jit.ScriptModule] = {}
+        self.code_encoders: Dict[str, torch.jit.ScriptModule] = {}
+        for language, code_file in self.description["code"].items():
+            if code_file not in modules:
+                modules[code_file] = torch.jit.load(str(export_dir / code_file), map_location="cpu")
+            self.code_encoders[language] = modules[code_file]
+
+    @staticmethod
+    def _encode(
+        encoder: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+        tokens: np.ndarray,
+        tokens_mask: np.ndarray,
+        max_length: int,
+        batch_size: int,
+    ) -> np.ndarray:
+        tokens = np.asarray(tokens)
+        tokens_mask = np.asarray(tokens_mask)
+        if tokens.shape[1] != max_length:
+            raise ValueError(f"Tokens must be padded to exported length {max_length} (got {tokens.shape[1]})")
+        embeddings: List[np.ndarray] = []
+        with torch.no_grad():
+            for i in range(0, len(tokens), batch_size):
+                embeddings.append(
+                    encoder(
+                        torch.from_numpy(tokens[i : i + batch_size].astype(np.int64)),
+                        torch.from_numpy(tokens_mask[i : i + batch_size].astype(np.int64)),
+                    ).numpy()
+                )
+        return np.concatenate(embeddings)
+
+    def encode_query(self, tokens: np.ndarray, tokens_mask: np.ndarray, batch_size: int = 32) -> np.ndarray:
+        return self._encode(self.query_encoder, tokens, tokens_mask, self.query_max_length, batch_size)
+
+    def encode_code(
+        self, language: str, tokens: np.ndarray, tokens_mask: np.ndarray, batch_size: int = 32
+    ) -> np.ndarray:
+        return self._encode(self.code_encoders[language], tokens, tokens_mask, self.code_max_length, batch_size)
+
+
+def benchmark(name: str, fn: Callable[[], None], nb: int) -> float:
+    fn()  # warmup
+    start = time.time()
+    for _ in range(nb):
+        fn()
+    t = (time.time() - start) / nb
+    logger.info(f"{name}: {t * 1000:.2f} ms/batch")
+    return t
+
+
+def run(args, tag_in_vcs=False) -> None:
+    os.environ["WANDB_MODE"] = "dryrun"
+
+    output_dir = Path(args["OUTPUT_DIR"])
+    batch_size = int(args["--batch_size"])
+    nb_batches = int(args["--nb_batches"])
+    nb_threads = int(args["--nb_threads"])
+    atol = float(args["--atol"])
+    if nb_threads > 0:
+        torch.set_num_threads(nb_threads)
+
+    restore_dir = args["--restore"]
+    logger.info(f"Restoring Training Context from directory {restore_dir}")
+    training_ctx = CodeSearchTrainingContext.build_context_from_dir(restore_dir)
+    training_ctx.eval_mode()
+
+    export_torchscript(training_ctx, output_dir)
+    encoders = TorchScriptEncoders(output_dir, nb_threads=nb_threads)
+
+    # compare with eager model on CPU
+    model = training_ctx.model.cpu().eval()
+    vocab = vocab_size(model)
+    query_inputs = random_tokens(batch_size, encoders.query_max_length, vocab, seed=2)
+    code_inputs = random_tokens(batch_size, encoders.code_max_length, vocab, seed=3)
+    failed: List[str] = []
+    with torch.no_grad():
+        eager_query = model.encode_query(*query_inputs).numpy()
+        script_query = encoders.encode_query(query_inputs[0].numpy(), query_inputs[1].numpy(), batch_size)
+        diff = float(np.abs(eager_query - script_query).max())
+        logger.info(f"query: max abs diff with eager {diff:.2e}")
+        if diff > atol:
+            failed.append("query")
+        for language, lang_id in training_ctx.train_data_params.lang_ids.items():
+            eager_code = model.encode_code(lang_id, *code_inputs).numpy()
+            script_code = encoders.encode_code(language, code_inputs[0].numpy(), code_inputs[1].numpy(), batch_size)
+            diff = float(np.abs(eager_code - script_code).max())
+            logger.info(f"code {language}: max abs diff with eager {diff:.2e}")
+            if diff > atol:
+                failed.append(language)
+
+        eager_t = benchmark("eager query encoder", lambda: model.encode_query(*query_inputs), nb_batches)
+        script_t = benchmark(
+            "torchscript query encoder",
+            lambda: encoders.encode_query(query_inputs[0].numpy(), query_inputs[1].numpy(), batch_size),
+            nb_batches,
+        )
+        logger.info(f"=> query speedup x{eager_t / script_t:.2f}")
+        language, lang_id = next(iter(training_ctx.train_data_params.lang_ids.items()))
+        eager_t = benchmark(
+            f"eager {language} code encoder", lambda: model.encode_code(lang_id, *code_inputs), nb_batches
+        )
+        script_t = benchmark(
+            f"torchscript {language} code encoder",
+            lambda: encoders.encode_code(language, code_inputs[0].numpy(), code_inputs[1].numpy(), batch_size),
+            nb_batches,
+        )
+        logger.info(f"=> code speedup x{eager_t / script_t:.2f}")
+
+    if len(failed) > 0:
+        logger.error(f"TorchScript encoders {failed} differ from eager model by more than {atol}")
+        sys.exit(1)
+    logger.info(f"Exported TorchScript encoders to {output_dir}")
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    run_and_debug(lambda: run(args), args["--debug"])
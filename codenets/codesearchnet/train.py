@@ -15,6 +15,7 @@ import sys
 import time
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional
 
 import torch
 from docopt import docopt
@@ -25,7 +26,12 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm, trange
 import wandb
 
-from codenets.codesearchnet.dataset_utils import BalancedBatchSchedulerSampler, DatasetType
+from codenets.codesearchnet.dataset_utils import (
+    BalancedBatchSchedulerSampler,
+    HardNegativeBatchSchedulerSampler,
+    DatasetType,
+)
+from codenets.codesearchnet.batch_transfer import DevicePrefetcher
 from codenets.save import save_records_best, save_records_last
 from codenets.codesearchnet.training_ctx import (
     CodeSearchTrainingContext,
@@ -80,14 +86,32 @@ def run_epoch(
         logger.debug("Eval Mode")
         training_ctx.eval_mode()
 
+    hard_negatives: Optional[HardNegativeBatchSchedulerSampler] = None
+    if is_train and isinstance(dataloader.sampler, HardNegativeBatchSchedulerSampler):
+        hard_negatives = dataloader.sampler
+
     training_ctx.zero_grad()
     with tqdm(total=len(dataloader)) as t_batch:
-        for batch_idx, batch in enumerate(dataloader):
-            batch_total_loss, similarity_scores = training_ctx.forward(batch, batch_idx)
-
-            if is_train:
-                training_ctx.backward_optimize(batch_total_loss)
+        for batch_idx, batch in enumerate(
+            DevicePrefetcher(dataloader, training_ctx.device, prefetch=training_ctx.prefetch_batches)
+        ):
+            if is_train and training_ctx.grad_cache_chunk_size > 0:
+                # large batch loss with gradients computed chunk by chunk
+                batch_total_loss, similarity_scores = training_ctx.grad_cache_optimize(batch, batch_idx)
                 training_ctx.zero_grad()
+            else:
+                batch_total_loss, similarity_scores = training_ctx.forward(batch, batch_idx)
+
+                if is_train:
+                    training_ctx.backward_optimize(batch_total_loss)
+                    training_ctx.zero_grad()
+
+            if (
+                hard_negatives is not None
+                and hard_negatives.refresh_interval > 0
+                and (batch_idx + 1) % hard_negatives.refresh_interval == 0
+            ):
+                hard_negatives.refresh()
 
             batch_size = BatchSize(batch[0].size()[0])
             batch_loss = BatchLoss(batch_total_loss.item())
@@ -130,6 +154,9 @@ def run_epoch(
                         step=training_ctx.train_global_step,
                     )
     used_time = UsedTime(time.time() - epoch_start)
+    if hard_negatives is not None and hard_negatives.refresh_interval == 0:
+        # mined batches of next epoch use embeddings of this epoch
+        hard_negatives.refresh()
     if training_ctx.tensorboard is not None:  # mypy needs that
         training_ctx.tensorboard.add_scalars(
             {
@@ -40,6 +40,11 @@ from codenets.codesearchnet.data import DatasetParams
 from codenets.codesearchnet.dataset_utils import ConcatNamedDataset, DatasetType
 from codenets.utils import expand_data_path, instance_full_classname, full_classname, runtime_import
 from codenets.losses import load_loss_and_similarity_function
+from codenets.codesearchnet.mixed_precision import MixedPrecision
+from codenets.codesearchnet.momentum_queue import MomentumQueue
+from codenets.codesearchnet.batch_transfer import batch_to_device
+from codenets.codesearchnet.grad_cache import grad_cache_backward
+from codenets.codesearchnet.huggingface.models import enable_gradient_checkpointing
 
 
 def default_sample_update(tpe: str, lang: str, tokens: List[str]) -> str:
@@ -100,8 +105,8 @@ def compute_loss_mrr_ndcg(
     total_samples: TotalSize,
     device: torch.device,
 ) -> Tuple[TotalLoss, AvgLoss, TotalMrr, AvgMrr, TotalNdcg, AvgNdcg, TotalSize]:
-    _, _, similarity, _, _, _, _, _ = batch
-    similarity = similarity.to(device)
+    # similarity is 3rd field of batches with sample index & 2nd without
+    similarity = batch[-6].to(device)
     # compute total loss, avg loss, total MRR, avg MRR, total size
     # extract the logits from the diagonal of the matrix, which are the logits corresponding to the ground-truth
     correct_scores = similarity_scores.diagonal()
@@ -220,10 +225,13 @@ class ModelAndAdamWRecordable(Generic[Model_T], Recordable):
 
     model_type: Model_T
 
-    def __init__(self, model: Model_T, optimizer: AdamW):  # type: ignore
+    def __init__(self, model: Model_T, optimizer: AdamW, scaler_state: Optional[Dict] = None):  # type: ignore
         super().__init__()
         self.model = model
         self.optimizer = optimizer
+        # gradient scaler state of mixed precision training (recorded state until training context sets its scaler)
+        self.scaler_state = scaler_state
+        self.mixed_precision: Optional[MixedPrecision] = None
 
     def save(self, output_dir: Union[Path, str]) -> bool:
         full_dir = Path(output_dir) / instance_full_classname(self)
@@ -231,6 +239,10 @@ class ModelAndAdamWRecordable(Generic[Model_T], Recordable):
         os.makedirs(full_dir, exist_ok=True)
         self.model.save(full_dir)
         torch.save(self.optimizer.state_dict(), full_dir / "adamw_state_dict.pth")
+        scaler_state = self.mixed_precision.state_dict() if self.mixed_precision is not None else None
+        scaler_state = scaler_state if scaler_state is not None else self.scaler_state
+        if scaler_state is not None:
+            torch.save(scaler_state, full_dir / "scaler_state_dict.pth")
         return True
 
     @classmethod
@@ -242,7 +254,11 @@ class ModelAndAdamWRecordable(Generic[Model_T], Recordable):
         state_dict = torch.load(full_dir / "adamw_state_dict.pth")
         optimizer = AdamW(model.parameters())
         optimizer.load_state_dict(state_dict)
-        return cls(model, optimizer)
+
+        scaler_state = None
+        if (full_dir / "scaler_state_dict.pth").exists():
+            scaler_state = torch.load(full_dir / "scaler_state_dict.pth")
+        return cls(model, optimizer, scaler_state)
 
 
 CodeSearchTrainingContext_T = TypeVar("CodeSearchTrainingContext_T", bound="CodeSearchTrainingContext")
@@ -304,8 +320,23 @@ class CodeSearchTrainingContext(RecordableMapping):
         self.test_batch_size: int = self.conf["training.batch_size.test"]
 
         self.queries_file = self.conf["dataset.queries_file"]
+        self.num_workers: int = self.conf["training.num_workers"] if "training.num_workers" in self.conf else 0
+        self.prefetch_batches: bool = (
+            self.conf["training.prefetch_batches"] if "training.prefetch_batches" in self.conf else True
+        )
+        # balanced batches mixing languages instead of single-language batches
+        self.mix_languages: bool = (
+            self.conf["training.mix_languages"] if "training.mix_languages" in self.conf else False
+        )
 
         self.losses_scores_fn = load_loss_and_similarity_function(self.conf["training.loss"], self.device)
+        self.mixed_precision = MixedPrecision.from_conf(self.conf, self.device)
+        # built by build_momentum_queue once model is loaded
+        self.momentum_queue: Optional[MomentumQueue] = None
+        # encode large training batches by chunks of that size with gradient cache (0 to deactivate)
+        self.grad_cache_chunk_size: int = (
+            self.conf["training.grad_cache.chunk_size"] if "training.grad_cache.chunk_size" in self.conf else 0
+        )
 
         self.training_params = cast(DictRecordable, records["training_params"])
         self.epoch = self.training_params["epoch"]
@@ -376,6 +407,96 @@ class CodeSearchTrainingContext(RecordableMapping):
         """Perform backward pass from loss"""
         pass
 
+    def setup_gradient_checkpointing(self) -> None:
+        """Activate gradient checkpointing of model HuggingFace encoders if configured"""
+        if "training.model.gradient_checkpointing" not in self.conf:
+            return
+        checkpointing_conf = self.conf["training.model.gradient_checkpointing"]
+        enable_gradient_checkpointing(
+            self.model,
+            enabled=checkpointing_conf.get_bool("enabled", True),
+            granularity=checkpointing_conf.get_string("granularity", "layer"),
+            every=checkpointing_conf.get_int("every", 1),
+        )
+
+    def build_momentum_queue(self) -> None:
+        """Build momentum queue of negative codes if configured (once model is on device)"""
+        self.momentum_queue = MomentumQueue.from_conf(self.conf, self.model)
+        if self.momentum_queue is not None and not self.losses_scores_fn.supports_extra_negatives:
+            raise ValueError(f"Loss {self.conf['training.loss.type']} can't use negatives of momentum queue")
+        if self.momentum_queue is not None and self.momentum_queue.per_language and self.mix_languages:
+            raise ValueError("training.momentum_queue.per_language can't be used with training.mix_languages")
+
+    def grad_cache_encode(
+        self,
+        languages: Tensor,
+        query_tokens: Tensor,
+        query_tokens_mask: Tensor,
+        code_tokens: Tensor,
+        code_tokens_mask: Tensor,
+        code_lang_weights: Tensor,
+    ) -> Tuple[Tensor, Tensor]:
+        """(query, code) embeddings of a chunk of batch with gradient cache (overridden for models with other inputs)"""
+        return self.model(
+            languages=languages,
+            query_tokens=query_tokens,
+            query_tokens_mask=query_tokens_mask,
+            code_tokens=code_tokens,
+            code_tokens_mask=code_tokens_mask,
+        )
+
+    def grad_cache_loss(
+        self,
+        query_embedding: Tensor,
+        code_embedding: Tensor,
+        similarity: Tensor,
+        code_lang_weights: Tensor,
+        extra_negatives: Optional[Tensor],
+    ) -> Tuple[Tensor, Tensor]:
+        """(batch loss, similarity scores) of embeddings of whole batch with gradient cache (same loss as forward)"""
+        return self.losses_scores_fn(
+            query_embedding, code_embedding, similarity, code_lang_weights, extra_negatives=extra_negatives
+        )
+
+    def grad_cache_optimize(self, batch: List[Tensor], batch_idx: int) -> Tuple[Tensor, Tensor]:
+        """
+        Perform forward & backward passes of a large batch by chunks of grad_cache_chunk_size with gradient cache
+        then optimizer step
+        
+        Returns:
+            Tuple[Tensor, Tensor]: (global loss tensor for all samples in batch, similarity scores between all samples)
+        """
+        # batches with or without leading sample indices
+        languages, similarity, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, code_lang_weights = batch_to_device(
+            batch, self.device, non_blocking=True
+        )[-7:]
+
+        extra_negatives = None
+        if self.momentum_queue is not None:
+            extra_negatives = self.momentum_queue.negatives_and_enqueue(
+                languages, code_tokens, code_tokens_mask, chunk_size=self.grad_cache_chunk_size
+            )
+
+        def encode(chunk: List[Tensor]) -> Tuple[Tensor, Tensor]:
+            with self.mixed_precision.autocast():
+                (query_embedding, code_embedding) = self.grad_cache_encode(*chunk)
+            return self.mixed_precision.float_embeddings(query_embedding, code_embedding)
+
+        def loss_fn(query_embedding: Tensor, code_embedding: Tensor) -> Tuple[Tensor, Tensor]:
+            return self.grad_cache_loss(query_embedding, code_embedding, similarity, code_lang_weights, extra_negatives)
+
+        batch_total_loss, similarity_scores = grad_cache_backward(
+            encode,
+            loss_fn,
+            [languages, query_tokens, query_tokens_mask, code_tokens, code_tokens_mask, code_lang_weights],
+            chunk_size=self.grad_cache_chunk_size,
+            mixed_precision=self.mixed_precision,
+        )
+        self.mixed_precision.step(self.optimizer)
+        if self.momentum_queue is not None:
+            self.momentum_queue.update_model(self.model)
+        return (batch_total_loss, similarity_scores)
+
     def zero_grad(self) -> bool:
         """Set all necessary elements to zero_grad"""
         pass
@@ -4,12 +4,20 @@ from torch import nn
 import torch
 from pyhocon import ConfigTree
 from loguru import logger
-from typing import Tuple
+from typing import Optional, Tuple
 
 
 class LossAndSimilarityScore(nn.Module):
+    # True if loss can use extra negative codes (from a momentum queue for example)
+    supports_extra_negatives = False
+
     def forward(  # type: ignore
-        self, x1: torch.Tensor, x2: torch.Tensor, ground_similarity: torch.Tensor, code_lang_weights: torch.Tensor
+        self,
+        x1: torch.Tensor,
+        x2: torch.Tensor,
+        ground_similarity: torch.Tensor,
+        code_lang_weights: torch.Tensor,
+        extra_negatives: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Compute Loss and similarity score between x1 and x2
@@ -18,6 +26,7 @@ class LossAndSimilarityScore(nn.Module):
             x1 (torch.Tensor): The first tensor [B x T x D].
             x2 (torch.Tensor): The second tensor [B x T x D].
             ground_similarityx2 (torch.Tensor): The second tensor [B x T x 1].
+            extra_negatives (Optional[torch.Tensor]): extra negatives of x1 [K x D] (if supports_extra_negatives).
 
         Returns:
             Tuple[torch.tensor, torch.tensor]: total loss for batch [1], loss per sample [B x 1], similarity [B x 1]
@@ -44,6 +53,7 @@ class CosineSimilarityScoreAndMarginLoss(LossAndSimilarityScore):
         code_embeddings: torch.Tensor,
         ground_similarity: torch.Tensor,
         code_lang_weights: torch.Tensor,
+        extra_negatives: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         cos_sims = cosine_similarities(query_embeddings, code_embeddings)  # B x B
         similarity_scores = cos_sims
@@ -59,6 +69,8 @@ class CosineSimilarityScoreAndMarginLoss(LossAndSimilarityScore):
 
 
 class SoftmaxCrossEntropyLossAndSimilarityScore(LossAndSimilarityScore):
+    supports_extra_negatives = True
+
     def __init__(self, device: torch.device, margin: float = 1.0):
         super(SoftmaxCrossEntropyLossAndSimilarityScore, self).__init__()
         self.device = device
@@ -70,9 +82,13 @@ class SoftmaxCrossEntropyLossAndSimilarityScore(LossAndSimilarityScore):
         code_embeddings: torch.Tensor,
         ground_similarity: torch.Tensor,
         code_lang_weights: torch.Tensor,
+        extra_negatives: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         logits = torch.mm(query_embeddings, code_embeddings.t())  # B x B
         similarity_scores = logits
+        if extra_negatives is not None:
+            # positives stay on diagonal of first B columns
+            logits = torch.cat([logits, torch.mm(query_embeddings, extra_negatives.t())], dim=1)  # B x (B + K)
         per_sample_losses = torch.nn.functional.cross_entropy(
             input=logits.to(self.device),
             target=torch.arange(0, code_embeddings.size()[0]).to(self.device),
@@ -87,6 +103,8 @@ class SoftmaxCrossEntropyLossAndSimilarityScore(LossAndSimilarityScore):
 
 
 class LogSoftmaxLossAndSimilarityScore(LossAndSimilarityScore):
+    supports_extra_negatives = True
+
     def __init__(self, device: torch.device, margin: float = 1.0):
         super(LogSoftmaxLossAndSimilarityScore, self).__init__()
         self.device = device
@@ -98,12 +116,16 @@ class LogSoftmaxLossAndSimilarityScore(LossAndSimilarityScore):
         code_embeddings: torch.Tensor,
         ground_similarity: torch.Tensor,
         code_lang_weights: torch.Tensor,
+        extra_negatives: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         # basic vector product
 
         logits = torch.mm(query_embeddings, code_embeddings.t())  # B x B
         # keep them as similarity score (the highest the most similar)
         similarity_scores = logits
+        if extra_negatives is not None:
+            # positives stay on diagonal of first B columns (fill_diagonal_ & diagonal below work on B x (B + K))
+            logits = torch.cat([logits, torch.mm(query_embeddings, extra_negatives.t())], dim=1)  # B x (B + K)
 
         # make it probabilistic
         logprobs = torch.nn.functional.log_softmax(logits, dim=-1)
@@ -205,16 +227,18 @@ class LambdaLossAndSimilarityScore(LossAndSimilarityScore):
         code_embeddings: torch.Tensor,
         ground_similarity: torch.Tensor,
         code_lang_weights: torch.Tensor,
+        extra_negatives: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         # basic vector product
         # y_pred = torch.mm(query_embeddings, code_embeddings.t())  # B x B
         y_pred = cosine_similarities(query_embeddings, code_embeddings)
         # we are in the binary case
         # y_true = torch.diag(torch.diagonal(ground_similarity))
+        # ranking computations (pow, log2, sigmoid of differences) are kept in float32 whatever autocast dtype
         if len(ground_similarity.shape) == 1:
-            y_true = torch.diag(ground_similarity)
+            y_true = torch.diag(ground_similarity).float()
         else:
-            y_true = ground_similarity
+            y_true = ground_similarity.float()
 
         # keep them as similarity score (the highest the most similar)
         similarity_scores = y_pred
@@ -310,6 +334,7 @@ class ApproxNDCGLossAndSimilarityScore(LossAndSimilarityScore):
         code_embeddings: torch.Tensor,
         ground_similarity: torch.Tensor,
         code_lang_weights: torch.Tensor,
+        extra_negatives: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         # basic vector product
         # y_pred = torch.mm(query_embeddings, code_embeddings.t())  # B x B
@@ -3,8 +3,11 @@
 import json
 import os
 import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Mapping, Type, TypeVar, Union, MutableMapping, List, Generic
+from typing import Any, Callable, Dict, Iterable, Iterator, Mapping, Type, TypeVar, Union, MutableMapping, List, Generic
 from loguru import logger
 import torch
 from torch import nn
@@ -269,3 +272,116 @@ class RecordableTorchModuleMapping(nn.ModuleDict, Recordable):
             logger.debug(f"Loading {subdir}")
             records[subdir] = runtime_load_recordable_module(d / subdir)
         return cls(records)
+
+
+LazyRecordableTorchModuleMapping_T = TypeVar(
+    "LazyRecordableTorchModuleMapping_T", bound="LazyRecordableTorchModuleMapping"
+)
+
+
+class LazyRecordableTorchModuleMapping(nn.Module, Recordable):
+    """
+    Read-only variant of a RecordableTorchModuleMapping for inference: modules are only loaded from their saved
+    directory when first accessed and, with max_resident > 0, the least recently used ones are evicted when more than
+    max_resident modules are loaded. Several modules can be loaded in parallel with preload.
+
+    It is saved in the format of RecordableTorchModuleMapping (not loaded modules being copied from restore directory)
+    so that records can be loaded eagerly or lazily. As evicted modules are reloaded from disk, their parameters
+    shouldn't be trained.
+    """
+
+    def __init__(self, restore_dir: Union[Path, str], max_resident: int = 0, nb_workers: int = 4):
+        super(LazyRecordableTorchModuleMapping, self).__init__()
+        self.restore_dir = Path(restore_dir)
+        self.names: List[str] = sorted(os.listdir(self.restore_dir))
+        self.max_resident = max_resident
+        self.nb_workers = nb_workers
+        self.resident = nn.ModuleDict()
+        # resident module names from least to most recently used
+        self.lru: "OrderedDict[str, None]" = OrderedDict()
+        # to/cuda/half... applied to mapping are replayed on modules loaded afterwards
+        self.applied_fns: List[Callable[[torch.Tensor], torch.Tensor]] = []
+        self.lock = threading.RLock()
+
+    def _apply(self, fn):
+        super(LazyRecordableTorchModuleMapping, self)._apply(fn)
+        self.applied_fns.append(fn)
+        return self
+
+    def load_module(self, name: str) -> RecordableTorchModule:
+        """Load module from its directory (without making it resident)"""
+        if name not in self.names:
+            raise KeyError(f"Unknown module {name} in {self.restore_dir}")
+        logger.info(f"Lazy loading {self.restore_dir / name}")
+        module = runtime_load_recordable_module(self.restore_dir / name)
+        for fn in self.applied_fns:
+            module._apply(fn)
+        return module.train(self.training)
+
+    def make_resident(self, name: str, module: RecordableTorchModule) -> RecordableTorchModule:
+        with self.lock:
+            if name not in self.resident:
+                self.resident[name] = module
+            self.lru[name] = None
+            self.lru.move_to_end(name)
+            while self.max_resident > 0 and len(self.lru) > self.max_resident:
+                evicted, _ = self.lru.popitem(last=False)
+                logger.debug(f"Evicting {evicted} (max resident modules {self.max_resident})")
+                del self.resident[evicted]
+            return self.resident[name]
+
+    def __getitem__(self, name: str) -> RecordableTorchModule:
+        with self.lock:
+            if name in self.resident:
+                self.lru.move_to_end(name)
+                return self.resident[name]
+        return self.make_resident(name, self.load_module(name))
+
+    def preload(self, names: Iterable[str]) -> None:
+        """Load modules which aren't resident yet in parallel (at most max_resident of them)"""
+        with self.lock:
+            missing = [name for name in dict.fromkeys(names) if name not in self.resident]
+        if self.max_resident > 0:
+            missing = missing[: self.max_resident]
+        if len(missing) == 0:
+            return
+        if len(missing) == 1 or self.nb_workers <= 1:
+            modules = [self.load_module(name) for name in missing]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.nb_workers, len(missing))) as executor:
+                modules = list(executor.map(self.load_module, missing))
+        for name, module in zip(missing, modules):
+            self.make_resident(name, module)
+
+    def keys(self) -> List[str]:
+        return list(self.names)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.names
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def save(self, output_dir: Union[Path, str]) -> bool:
+        d = Path(output_dir) / full_classname(RecordableTorchModuleMapping)
+        with self.lock:
+            for name in self.names:
+                if name in self.resident:
+                    self.resident[name].save(d / name)
+                elif (d / name).resolve() != (self.restore_dir / name).resolve():
+                    shutil.copytree(self.restore_dir / name, d / name)
+        return True
+
+    @classmethod
+    def load(
+        cls: Type[LazyRecordableTorchModuleMapping_T],
+        restore_dir: Union[Path, str],
+        max_resident: int = 0,
+        nb_workers: int = 4,
+    ) -> LazyRecordableTorchModuleMapping_T:
+        """Lazy mapping of modules saved by a RecordableTorchModuleMapping in restore_dir (nothing loaded yet)"""
+        d = Path(restore_dir) / full_classname(RecordableTorchModuleMapping)
+        return cls(d, max_resident=max_resident, nb_workers=nb_workers)
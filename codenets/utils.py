@@ -102,6 +102,11 @@ def get_data_files_from_directory(data_dirs: List[Path], max_files_per_dir: Opti
     return files
 
 
+def sort_files_by_size(files: List[Path]) -> List[Path]:
+    """Sort files largest first so that parallel workers are balanced (longest tasks are scheduled first)"""
+    return sorted(files, key=lambda f: os.path.getsize(f), reverse=True)
+
+
 # Some streaming pickles (not used)
 
 